@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of autodeploy: builds local "upstream" bare repos of a
+# given size in a temp dir, writes a config for them, starts autodeployd and
+# autodeploy-webd from this source tree, and fires signed Gitea-style push
+# webhooks at them at a given rate and concurrency. Each webhook is preceded by
+# a push (moving master upstream to the next prepared commit), so every deploy
+# really fetches and checks out new objects.
+#
+# Reports end-to-end latency percentiles (POST until answered, ie deployed
+# unless async = true), deploys per second and per-stage timings from the
+# daemon's metrics, optionally as JSON to compare runs:
+#
+#   python benchmarks/e2e.py --files 2000 --history 50 --pushes 50 --json before.json
+#   python benchmarks/e2e.py ... --json after.json
+#   python benchmarks/e2e.py --compare before.json after.json
+
+from typing import List, Dict, Tuple, Optional
+
+import argparse
+import hmac
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+SECRET = 'benchsecret'
+IDENT = 'Bench <bench@localhost>'
+
+
+def git(*args: str, cwd: str, input: Optional[bytes] = None) -> str:
+    return subprocess.run(('git',) + args, cwd=cwd, input=input, check=True,
+                          stdout=subprocess.PIPE).stdout.decode().strip()
+
+
+def blob(size: int, rng: random.Random) -> bytes:
+    """ @size bytes of text, random enough not to delta or compress away """
+    line = 64
+    out = bytearray()
+    while len(out) < size:
+        out += b'%x\n' % rng.getrandbits(line * 4)
+    return bytes(out[:size])
+
+
+def make_upstream(path: str, files: int, history: int, pushes: int, blob_size: int,
+                  seed: int) -> List[str]:
+    """ Create a bare repo at @path whose master has @history commits over
+        @files files, plus @pushes more commits on top (each changing a few
+        files) that are not on master yet. Returns the hashes of master
+        followed by those of each commit to push
+    """
+
+    rng = random.Random(seed)
+    git('init', '-q', '--bare', path, cwd='.')
+    stream = bytearray()
+    mark = 0
+    when = 1600000000
+    changed = max(1, files // 50)
+    for n in range(history + pushes):
+        mark += 1
+        ref = 'refs/heads/master' if n < history else 'refs/bench/next'
+        stream += f'commit {ref}\nmark :{mark}\ncommitter {IDENT} {when + n} +0000\n'.encode()
+        text = f'Commit {n}\n'.encode()
+        stream += b'data %d\n%s' % (len(text), text)
+        if n == history:
+            stream += f'from :{mark - 1}\n'.encode()
+        names = range(files) if n == 0 else rng.sample(range(files), min(changed, files))
+        for f in names:
+            data = blob(blob_size, rng)
+            stream += f'M 100644 inline dir{f % 32}/file{f}\n'.encode()
+            stream += b'data %d\n%s\n' % (len(data), data)
+    marks = os.path.join(path, 'bench-marks')
+    git('fast-import', '--quiet', f'--export-marks={marks}', cwd=path, input=bytes(stream))
+    with open(marks) as fp:
+        hashes = dict(line.split() for line in fp)
+    return [hashes[f':{i}'] for i in range(history, history + pushes + 1)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_config(path: str, tmp: str, repos: int, args) -> Tuple[str, int]:
+    """ Write the config for the benchmark, returning its socket and webport """
+    sock, port = os.path.join(tmp, 'gitsync.socket'), free_port()
+    lines = [f'socket = {sock}', f'webport = {port}', 'daemonkey = benchkey',
+             f'workers = {args.workers or args.concurrency}',
+             f'loglevel = {args.loglevel}', f'loglocation = {os.path.join(tmp, "autodeploy.log")}',
+             f'webd_mode = {args.mode}']
+    lines += args.set
+    for i in range(repos):
+        lines += ['', f'[bench/repo{i}]', f'url = {os.path.join(tmp, f"upstream{i}.git")}',
+                  f'local = {os.path.join(tmp, f"deploy{i}")}', f'secret = {SECRET}',
+                  'branch = master']
+        if args.postscript:
+            lines.append(f'postscript = {args.postscript}')
+        lines += args.set_repo
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.chmod(path, 0o640)
+    return sock, port
+
+
+def start(module: str, env: Dict[str, str], log: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, '-c', f'from autodeploy.{module} import daemon_main; daemon_main()'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=open(log, 'ab'))
+
+
+def wait_for(check, what: str, timeout: float = 20) -> None:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f'Timed out waiting for {what}')
+
+
+def payload(repo: str, before: str, after: str) -> bytes:
+    return json.dumps({
+        'ref': 'refs/heads/master', 'before': before, 'after': after,
+        'repository': {'full_name': repo},
+        'pusher': {'login': 'bench', 'full_name': 'Bench', 'email': 'bench@localhost'},
+    }).encode()
+
+
+def post(port: int, data: bytes) -> Tuple[int, str, float]:
+    """ POST a signed webhook, returning status, body and seconds taken """
+    sig = hmac.new(SECRET.encode(), data, 'sha256').hexdigest()
+    req = urllib.request.Request(f'http://127.0.0.1:{port}/', data=data,
+                                 headers={'X-Gitea-Signature': sig,
+                                          'Content-Type': 'application/json'})
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=600) as r:
+            code, body = r.status, r.read().decode('utf8', 'replace')
+    except urllib.error.HTTPError as e:
+        code, body = e.code, e.read().decode('utf8', 'replace')
+    except OSError as e:
+        code, body = 0, str(e)
+    return code, body, time.monotonic() - start
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """ Nearest-rank percentile """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def parse_metrics(text: str) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+    """ Samples by name from Prometheus text format """
+    out: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+    for line in text.splitlines():
+        m = SAMPLE.match(line)
+        if not m:
+            continue
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', m.group(2) or ''))
+        out.setdefault(m.group(1), []).append((labels, float(m.group(3))))
+    return out
+
+
+def stage_timings(metrics: Dict[str, List[Tuple[Dict[str, str], float]]]) -> Dict[str, dict]:
+    """ Count, total and mean seconds of each deploy stage over all repos """
+    stages: Dict[str, dict] = {}
+    for name, key in (('autodeploy_stage_seconds', 'stage'), ('autodeploy_webhook_stage_seconds', 'stage')):
+        prefix = 'webd_' if name.startswith('autodeploy_webhook') else ''
+        for suffix in ('sum', 'count'):
+            for labels, value in metrics.get(f'{name}_{suffix}', []):
+                s = stages.setdefault(prefix + labels[key], {'count': 0, 'total': 0.0})
+                s['count' if suffix == 'count' else 'total'] += value
+    for s in stages.values():
+        s['count'] = int(s['count'])
+        s['mean'] = s['total'] / s['count'] if s['count'] else None
+    return stages
+
+
+def run(args) -> dict:
+    tmp = tempfile.mkdtemp(prefix='autodeploy-bench-')
+    procs: List[subprocess.Popen] = []
+    try:
+        print(f'Building {args.repos} upstream repo(s) in {tmp}', file=sys.stderr)
+        chains = [make_upstream(os.path.join(tmp, f'upstream{i}.git'), args.files, args.history,
+                                args.pushes, args.blob_size, args.seed + i)
+                  for i in range(args.repos)]
+
+        cfg = os.path.join(tmp, 'autodeploy.cfg')
+        sock, port = write_config(cfg, tmp, args.repos, args)
+        env = dict(os.environ, AUTODEPLOYCFG=cfg,
+                   PYTHONPATH=os.pathsep.join([SRC] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+        log = os.path.join(tmp, 'autodeploy.log')
+        procs.append(start('daemon', env, log))
+        wait_for(lambda: os.path.exists(sock), 'autodeployd socket')
+        procs.append(start('webserver', env, log))
+        wait_for(lambda: socket.create_connection(('127.0.0.1', port), 1).close() or True,
+                 'autodeploy-webd port')
+
+        # The first deploy of each repo clones it, which is not what is measured
+        if not args.no_warmup:
+            for i, chain in enumerate(chains):
+                code, body, _ = post(port, payload(f'bench/repo{i}', chain[0], chain[0]))
+                if code not in (200, 202):
+                    raise RuntimeError(f'Warmup deploy failed ({code}): {body}')
+
+        results: List[Tuple[str, int, str, float]] = []
+        lock = threading.Lock()
+
+        def fire(repo: str, before: str, after: str) -> None:
+            code, body, secs = post(port, payload(repo, before, after))
+            with lock:
+                results.append((repo, code, body, secs))
+
+        # Pushes to each repo are interleaved round-robin, paced at args.rate
+        order = [(i, k) for k in range(1, args.pushes + 1) for i in range(args.repos)]
+        interval = 1 / args.rate if args.rate else 0
+        print(f'Firing {len(order)} webhooks, concurrency {args.concurrency}, '
+              f'rate {args.rate or "unlimited"}/s', file=sys.stderr)
+        begin = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            pending = []
+            for n, (i, k) in enumerate(order):
+                if interval:
+                    delay = begin + n * interval - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                chain = chains[i]
+                git('update-ref', 'refs/heads/master', chain[k], cwd=os.path.join(tmp, f'upstream{i}.git'))
+                pending.append(pool.submit(fire, f'bench/repo{i}', chain[k - 1], chain[k]))
+            for f in pending:
+                f.result()
+        elapsed = time.monotonic() - begin
+
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=30) as r:
+                metrics = parse_metrics(r.read().decode())
+        except OSError as e:
+            print(f'Could not read metrics: {e}', file=sys.stderr)
+            metrics = {}
+
+        latencies = [r[3] for r in results if r[1] in (200, 202)]
+        codes: Dict[str, int] = {}
+        outcomes = {'deployed': 0, 'superseded': 0, 'failed': 0}
+        for _, code, body, _ in results:
+            codes[str(code)] = codes.get(str(code), 0) + 1
+            if code not in (200, 202):
+                outcomes['failed'] += 1
+            elif 'superseded' in body:
+                outcomes['superseded'] += 1
+            else:
+                outcomes['deployed'] += 1
+
+        git_commands = {labels['how']: int(v) for labels, v in metrics.get('autodeploy_git_commands_total', [])}
+        return {
+            'params': {k: v for k, v in vars(args).items() if k not in ('compare', 'json', 'keep')},
+            'environment': {'python': platform.python_version(), 'git': git('--version', cwd='.'),
+                            'platform': platform.platform(), 'cpus': os.cpu_count(),
+                            'revision': revision()},
+            'webhooks': len(results),
+            'codes': codes,
+            'outcomes': outcomes,
+            'seconds': elapsed,
+            'webhooks_per_second': len(results) / elapsed if elapsed else None,
+            'deploys_per_second': outcomes['deployed'] / elapsed if elapsed else None,
+            'latency': {'mean': sum(latencies) / len(latencies) if latencies else None,
+                        'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                        'p99': percentile(latencies, 99), 'max': max(latencies, default=None)},
+            'stages': stage_timings(metrics),
+            'git_commands': git_commands,
+        }
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        if args.keep:
+            print(f'Kept {tmp}', file=sys.stderr)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def revision() -> Optional[str]:
+    try:
+        return git('describe', '--always', '--dirty', cwd=SRC)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def fmt(v) -> str:
+    if v is None:
+        return '-'
+    return f'{v:.4f}' if isinstance(v, float) else str(v)
+
+
+def report(res: dict) -> None:
+    print(f"{res['webhooks']} webhooks in {res['seconds']:.2f}s: "
+          f"{fmt(res['deploys_per_second'])} deploys/s, outcomes {res['outcomes']}, codes {res['codes']}")
+    print('latency (s): ' + ', '.join(f'{k} {fmt(v)}' for k, v in res['latency'].items()))
+    print(f"{'stage':<20}{'count':>8}{'mean s':>12}{'total s':>12}")
+    for name, s in res['stages'].items():
+        print(f"{name:<20}{s['count']:>8}{fmt(s['mean']):>12}{fmt(s['total']):>12}")
+    if res['git_commands']:
+        print('git commands: ' + ', '.join(f'{k} {v}' for k, v in res['git_commands'].items()))
+
+
+def flatten(res: dict) -> Dict[str, float]:
+    """ The numbers of a result worth comparing, by dotted name """
+    out = {'deploys_per_second': res['deploys_per_second'],
+           'webhooks_per_second': res['webhooks_per_second']}
+    out.update({f'latency.{k}': v for k, v in res['latency'].items()})
+    out.update({f'stages.{k}.mean': s['mean'] for k, s in res['stages'].items()})
+    out.update({f'git_commands.{k}': v for k, v in res['git_commands'].items()})
+    return out
+
+
+def compare(before: str, after: str) -> None:
+    with open(before) as fp:
+        a = flatten(json.load(fp))
+    with open(after) as fp:
+        b = flatten(json.load(fp))
+    print(f"{'metric':<32}{'before':>12}{'after':>12}{'change':>10}")
+    for key in list(a) + [k for k in b if k not in a]:
+        va, vb = a.get(key), b.get(key)
+        change = f'{(vb - va) / va * 100:+.1f}%' if va and vb is not None else '-'
+        print(f'{key:<32}{fmt(va):>12}{fmt(vb):>12}{change:>10}')
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description=__doc__ or 'End-to-end autodeploy benchmark')
+    p.add_argument('--repos', type=int, default=1, help='upstream repos to deploy from')
+    p.add_argument('--files', type=int, default=200, help='files per repo')
+    p.add_argument('--history', type=int, default=20, help='commits already in each repo')
+    p.add_argument('--blob-size', type=int, default=4096, help='bytes per file')
+    p.add_argument('--pushes', type=int, default=20, help='pushes (webhooks) per repo')
+    p.add_argument('--rate', type=float, default=0, help='webhooks per second, 0 for as fast as possible')
+    p.add_argument('--concurrency', type=int, default=4, help='webhooks in flight at once')
+    p.add_argument('--workers', type=int, default=0, help='daemon workers, default the concurrency')
+    p.add_argument('--mode', choices=['http', 'asyncio'], default='http', help='webd_mode')
+    p.add_argument('--postscript', help='postscript to run for each deploy')
+    p.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                   help='extra global setting, eg --set gitbatch=true')
+    p.add_argument('--set-repo', action='append', default=[], metavar='KEY=VALUE',
+                   help='extra setting for each repo, eg --set-repo fetch=targeted')
+    p.add_argument('--loglevel', default='warning')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--no-warmup', action='store_true', help='measure the initial clones too')
+    p.add_argument('--keep', action='store_true', help='keep the temp dir and logs')
+    p.add_argument('--json', help='write the results as JSON to this file')
+    p.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                   help='compare two JSON results instead of running')
+    args = p.parse_args()
+    if args.history < 1:
+        p.error('--history must be at least 1')
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    res = run(args)
+    report(res)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(res, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
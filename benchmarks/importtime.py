@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Cold start benchmark of the CGI receiver path: runs what deploy-cgi.py does
+# before handling a webhook (imports, reading the config) in a fresh Python
+# process many times, with and without the config cache (AUTODEPLOYCACHE).
+# Reports the median wall time and -X importtime total of each, the slowest
+# imports, and checks them against budgets, exiting 1 if over one of them or
+# if a module only the daemons need got imported:
+#
+#   python benchmarks/importtime.py --config /etc/autodeploy.cfg --budget-ms 60
+#   python benchmarks/importtime.py --json after.json
+
+from typing import List, Dict, Tuple
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# What deploy-cgi.py does before reading the webhook
+STARTUP = '''
+import sys
+from autodeploy import get_config
+from autodeploy.webhook import WebhookIngest
+from autodeploy.message import Message, send_message, send_command
+get_config()['DEFAULT'].getboolean('async', False)
+print(' '.join(sorted(sys.modules)))
+'''
+
+# Modules the CGI path should never need
+DAEMON_ONLY = ['asyncio', 'smtplib', 'email.message', 'subprocess', 'socketserver',
+               'concurrent.futures', 'http.server']
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def sample_config(path: str) -> None:
+    """ A config like a real one with a hundred repos """
+    lines = ['socket = /run/autodeploy/gitsync.socket', 'loglevel = warning',
+             'loglocation = stderr', 'daemonkey = benchkey']
+    for i in range(100):
+        lines += ['', f'[org/repo{i}]', f'url = https://git.example.com/org/repo{i}.git',
+                  f'local = /srv/deploy/repo{i}', f'secret = secret{i}', 'branch = master',
+                  'postscript = /usr/local/bin/reload']
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.chmod(path, 0o640)
+
+
+def run_once(env: Dict[str, str]) -> Tuple[float, int, Dict[str, int], List[str]]:
+    """ Wall seconds, total import microseconds, cumulative microseconds by
+        top-level import, and modules loaded of one cold start
+    """
+    start = time.monotonic()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP], env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    wall = time.monotonic() - start
+    total, top = 0, {}
+    for line in p.stderr.decode().splitlines():
+        m = LINE.match(line)
+        if m and not m.group(3):
+            top[m.group(4)] = int(m.group(2))
+            total += int(m.group(2))
+    return wall, total, top, p.stdout.decode().split()
+
+
+def measure(env: Dict[str, str], runs: int) -> dict:
+    walls, totals, tops = [], [], {}
+    modules: List[str] = []
+    for _ in range(runs):
+        wall, total, top, modules = run_once(env)
+        walls.append(wall)
+        totals.append(total)
+        for name, us in top.items():
+            tops.setdefault(name, []).append(us)
+    slowest = sorted(((statistics.median(v), k) for k, v in tops.items()), reverse=True)[:8]
+    return {'wall_ms': statistics.median(walls) * 1000,
+            'import_ms': statistics.median(totals) / 1000,
+            'slowest_imports_ms': {k: us / 1000 for us, k in slowest},
+            'modules': len(modules),
+            'daemon_only_imported': [m for m in DAEMON_ONLY if m in modules]}
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description='Cold start benchmark of the CGI receiver path')
+    p.add_argument('--config', help='config file to use, default a generated one with 100 repos')
+    p.add_argument('--runs', type=int, default=20)
+    p.add_argument('--budget-ms', type=float, default=0, help='max median wall time of a cold start')
+    p.add_argument('--import-budget-ms', type=float, default=0, help='max median total import time')
+    p.add_argument('--json', help='write the results as JSON to this file')
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='autodeploy-importtime-') as tmp:
+        cfg = args.config
+        if not cfg:
+            cfg = os.path.join(tmp, 'autodeploy.cfg')
+            sample_config(cfg)
+        env = dict(os.environ, AUTODEPLOYCFG=cfg, PYTHONPATH=SRC)
+        env.pop('AUTODEPLOYCACHE', None)
+        results = {'python': sys.version.split()[0], 'runs': args.runs,
+                   'uncached': measure(env, args.runs),
+                   'cached': measure(dict(env, AUTODEPLOYCACHE=os.path.join(tmp, 'cache.json')),
+                                     args.runs)}
+
+    failed = False
+    for name in ('uncached', 'cached'):
+        r = results[name]
+        print(f"{name:<9} wall {r['wall_ms']:.1f}ms, imports {r['import_ms']:.1f}ms, "
+              f"{r['modules']} modules")
+        print('          slowest: ' + ', '.join(f'{k} {v:.1f}ms' for k, v in r['slowest_imports_ms'].items()))
+        if r['daemon_only_imported']:
+            print(f"          imports daemon-only modules: {', '.join(r['daemon_only_imported'])}")
+            failed = True
+        if args.budget_ms and r['wall_ms'] > args.budget_ms:
+            print(f'          over the wall time budget of {args.budget_ms}ms')
+            failed = True
+        if args.import_budget_ms and r['import_ms'] > args.import_budget_ms:
+            print(f'          over the import time budget of {args.import_budget_ms}ms')
+            failed = True
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,152 @@
+# The config file is only read (and logging set up) the first time it is
+# needed, and modules only import what they need up front, so short-lived
+# processes like the CGI script start quickly. The legacy module attributes
+# (config, socket_path...) are looked up on access.
+
+from typing import Optional, TYPE_CHECKING
+
 import logging
-import configparser
+import threading
 import os
 import sys
-import itertools
 
-__all__ = ['config', 'socket_path', 'mail_host', 'daemon_key', 'webd_port']
+if TYPE_CHECKING:
+    import configparser
+
+__all__ = ['config', 'socket_path', 'mail_host', 'daemon_key', 'webd_port',
+           'get_config', 'load_config', 'reload_config']
 
 cfgfile = os.getenv('AUTODEPLOYCFG', '/etc/autodeploy.cfg')
 
-# Emulate a "DEFAULT" section by injecting it before the first line of file
+# Optional cache of the parsed config, see load_cached_config
+cfgcache_path = os.getenv('AUTODEPLOYCACHE')
+
+log = logging.getLogger(__name__)
+
+# Settings that only take effect when the daemons are restarted
+RESTART_ONLY = ['socket', 'webport', 'listen', 'workers', 'loglevel', 'loglocation',
+                'gitbatch', 'job_history', 'journal', 'journal_keep', 'daemon_connections',
+                'idle_timeout', 'smtphost', 'mail_digest', 'mail_retries', 'max_queue', 'owner_workers',
+                'prefetch_concurrency', 'prefetch_jitter', 'reconcile_on_start', 'webd_mode',
+                'webd_workers', 'webd_header_timeout', 'webd_read_timeout']
+
+# Legacy module attributes and the global setting each one is
+_LEGACY = {'socket_path': 'socket', 'mail_host': 'smtphost',
+           'daemon_key': 'daemonkey', 'webd_port': 'webport'}
+
+
+def load_config(path: str = cfgfile) -> 'configparser.ConfigParser':
+    """ Read and validate the config file at @path, raising ValueError (or the
+        parser's own errors) if it is not usable
+    """
+    import configparser
+    import itertools
+    from .postscripts import parse_postscripts
+    from .util import parse_targets
+
+    mode = os.stat(path).st_mode
+    if mode & 0b110:
+        raise Warning('Config file %s is world-readable/writable' % path)
+
+    # Emulate a "DEFAULT" section by injecting it before the first line of file
+    cfg = configparser.ConfigParser()
+    with open(path, 'r') as fp:
+        cfg.read_file(itertools.chain(['[DEFAULT]'], fp), source=path)
+
+    for key in ('socket', 'daemonkey'):
+        if not cfg['DEFAULT'].get(key):
+            raise ValueError(f'{path}: missing required global setting {key}')
+    for name in cfg.sections():
+        sec = cfg[name]
+        for key in ('url', 'local', 'secret'):
+            if not sec.get(key):
+                raise ValueError(f'{path}: section [{name}] is missing {key}')
+        if sec.get('targets'):
+            if sec.getboolean('bare', False) or sec.getint('releases', 0):
+                raise ValueError(f'{path}: section [{name}] cannot have targets if bare or with releases')
+            try:
+                parse_targets(sec['targets'])
+            except ValueError as e:
+                raise ValueError(f'{path}: section [{name}]: {e}') from None
+        elif not sec.getboolean('bare', False) and not sec.get('branch'):
+            raise ValueError(f'{path}: section [{name}] needs a branch unless bare')
+        try:
+            parse_postscripts(sec)
+        except ValueError as e:
+            raise ValueError(f'{path}: {e}') from None
+        try:
+            sec.getfloat('prefetch_interval', 0)
+        except ValueError:
+            raise ValueError(f'{path}: section [{name}] prefetch_interval is not a number') from None
+    return cfg
 
-mode = os.stat(cfgfile).st_mode
-if mode & 0b110:
-    raise Warning('Config file %s is world-readable/writable' % cfgfile)
 
-config = configparser.ConfigParser()
-with open(cfgfile, 'r') as fp:
-    config.read_file(itertools.chain(['[DEFAULT]'], fp), source=cfgfile)
+def load_cached_config(path: str, cache: str):
+    """ The config at @path from the cache file @cache if that was made from
+        the current version of it (same mtime, size and inode), otherwise load
+        it and refresh the cache. The cache holds the values as read, so using
+        it saves parsing and validating the file and importing configparser
+    """
+    from .cfgcache import read_cache, write_cache
 
+    st = os.stat(path)
+    if st.st_mode & 0b110:
+        raise Warning('Config file %s is world-readable/writable' % path)
+    stamp = [st.st_mtime_ns, st.st_size, st.st_ino]
+    cfg = read_cache(cache, stamp)
+    if cfg is None:
+        cfg = load_config(path)
+        write_cache(cache, stamp, cfg)
+    return cfg
 
-def setup_logging():
-    loglevel = 'debug' if '-d' in sys.argv else config['DEFAULT'].get('loglevel', 'info')
+
+_config: Optional['configparser.ConfigParser'] = None
+_config_lock = threading.Lock()
+
+
+def get_config() -> 'configparser.ConfigParser':
+    """ The current config, read on first use. Callers handling a request
+        should get it once and stick to it, so a reload halfway through does
+        not mix two configs
+    """
+    global _config
+
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                cfg = load_cached_config(cfgfile, cfgcache_path) if cfgcache_path else load_config()
+                setup_logging(cfg)
+                _config = cfg
+    return _config
+
+
+def reload_config() -> 'configparser.ConfigParser':
+    """ Re-read the config file and swap it in if valid, otherwise raise and
+        keep the current one
+    """
+    global _config
+
+    old = get_config()
+    with _config_lock:
+        new = _config = load_config()
+
+    added = set(new.sections()) - set(old.sections())
+    removed = set(old.sections()) - set(new.sections())
+    log.info("Reloaded %s: %d repos, added %s, removed %s", cfgfile,
+             len(new.sections()), sorted(added) or 'none', sorted(removed) or 'none')
+    for key in RESTART_ONLY:
+        if old['DEFAULT'].get(key) != new['DEFAULT'].get(key):
+            log.warning("Changed setting %s only takes effect after a restart", key)
+    return new
+
+
+def setup_logging(cfg) -> None:
+    loglevel = 'debug' if '-d' in sys.argv else cfg['DEFAULT'].get('loglevel', 'info')
     lvl = getattr(logging, loglevel.upper())
 
     c = {'level': lvl, 'format': r'%(asctime)-15s %(name)s %(levelname)s %(message)s'}
 
-    loc = config['DEFAULT'].get('loglocation', 'stderr')
+    loc = cfg['DEFAULT'].get('loglocation', 'stderr')
     if loc == 'stdout':
         c['stream'] = sys.stdout
     elif loc == 'stderr':
@@ -35,9 +156,17 @@ def setup_logging():
     logging.basicConfig(**c)
 
 
-socket_path = config['DEFAULT']['socket']
-mail_host = config['DEFAULT'].get('smtphost')
-daemon_key = config['DEFAULT']['daemonkey']
-webd_port = config['DEFAULT'].get('webport')
+def __getattr__(name: str):
+    """ Legacy attributes, from the current config """
+    if name == 'config':
+        return get_config()
+    if name in _LEGACY:
+        return get_config()['DEFAULT'].get(_LEGACY[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
-setup_logging()
+# Before Python 3.7 modules cannot have __getattr__, so load everything now.
+# Those attributes are then not updated by reload_config
+if sys.version_info < (3, 7):
+    config = get_config()
+    globals().update({k: config['DEFAULT'].get(v) for k, v in _LEGACY.items()})
@@ -0,0 +1,86 @@
+# Admission control for the webhook receiver. A webhook is turned away before
+# its body is even read if it is larger than allowed, if too many are already
+# waiting for their deploy, or if its repo is over its rate limit, so that a
+# misbehaving sender (a CI job or replay loop gone wrong) cannot starve real
+# deploys. The settings are read from the config at each request, from the
+# section of the repo if known (the webhook URL names it, eg /org/repo) so
+# that they can be set per repo, falling back to the global ones.
+
+from typing import Optional, Dict, NamedTuple
+
+import threading
+import time
+
+__all__ = ['TokenBucket', 'Rejection', 'Admission']
+
+
+class TokenBucket(object):
+    """ Allow @rate events per second on average, in bursts of up to @burst """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self) -> float:
+        """ Take a token, returning 0, or if there is none the seconds until
+            there will be one
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Rejection(NamedTuple):
+    code: int
+    reason: str
+    retry_after: Optional[float] = None     # Seconds, for the Retry-After header
+
+
+class Admission(object):
+    """ Counts the webhooks admitted and not yet answered, and keeps a token
+        bucket per repo (and one shared by webhooks of unknown repo)
+    """
+
+    def __init__(self):
+        self.pending = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def admit(self, config, repo: Optional[str], length: int) -> Optional[Rejection]:
+        """ Whether to take a webhook for @repo (None if not known yet) with a
+            body of @length bytes: None if so, and then release must be called
+            once it is answered, otherwise why not
+        """
+        settings = config[repo] if repo else config['DEFAULT']
+        max_body = settings.getint('webd_max_body', 1 << 20)
+        if max_body and length > max_body:
+            return Rejection(413, 'Payload too large')
+
+        max_pending = config['DEFAULT'].getint('webd_max_pending', 0)
+        rate = settings.getfloat('webd_rate', 0)
+        with self._lock:
+            if max_pending and self.pending >= max_pending:
+                return Rejection(503, 'Too many pending deploys',
+                                 config['DEFAULT'].getfloat('webd_retry_after', 5))
+            if rate:
+                wait = self._bucket(repo or '', rate, settings.getfloat('webd_burst', 10)).take()
+                if wait:
+                    return Rejection(429, 'Rate limit exceeded', wait)
+            self.pending += 1
+        return None
+
+    def release(self) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def _bucket(self, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        # A new one if the limits were changed by a config reload
+        if bucket is None or (bucket.rate, bucket.burst) != (rate, max(1.0, burst)):
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
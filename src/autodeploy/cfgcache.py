@@ -0,0 +1,126 @@
+# Cache of the parsed config file, for processes like the CGI script that
+# start for every webhook and would otherwise parse the whole config (and
+# import configparser) each time. The cache is a JSON file with the value of
+# every setting of every section, as read from the config (ie already
+# interpolated and with the global settings filled in), along with the mtime,
+# size and inode of the config file it was made from.
+#
+# It holds the same secrets as the config file, so it is written readable by
+# its owner only, and ignored unless that is still the case.
+
+from typing import Dict, List, Optional, Iterator
+
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+__all__ = ['CachedConfig', 'read_cache', 'write_cache']
+
+VERSION = 1
+
+# As configparser understands booleans
+BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
+                  '0': False, 'no': False, 'false': False, 'off': False}
+
+
+class CachedSection(object):
+    """ Read-only stand-in for a configparser SectionProxy """
+
+    def __init__(self, name: str, values: Dict[str, str]):
+        self.name = name
+        self._values = values
+
+    def __getitem__(self, key: str) -> str:
+        return self._values[key.lower()]
+
+    def __contains__(self, key: str) -> bool:
+        return key.lower() in self._values
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def get(self, key: str, fallback: Optional[str] = None) -> Optional[str]:
+        return self._values.get(key.lower(), fallback)
+
+    def _convert(self, key, fallback, conv):
+        value = self._values.get(key.lower())
+        return fallback if value is None else conv(value)
+
+    def getint(self, key: str, fallback: Optional[int] = None) -> Optional[int]:
+        return self._convert(key, fallback, int)
+
+    def getfloat(self, key: str, fallback: Optional[float] = None) -> Optional[float]:
+        return self._convert(key, fallback, float)
+
+    def getboolean(self, key: str, fallback: Optional[bool] = None) -> Optional[bool]:
+        def boolean(value: str) -> bool:
+            if value.lower() not in BOOLEAN_STATES:
+                raise ValueError(f'Not a boolean: {value}')
+            return BOOLEAN_STATES[value.lower()]
+        return self._convert(key, fallback, boolean)
+
+
+class CachedConfig(object):
+    """ Read-only stand-in for the configparser.ConfigParser of a config,
+        with a DEFAULT section like it
+    """
+
+    def __init__(self, sections: Dict[str, Dict[str, str]]):
+        self._sections = {name: CachedSection(name, values) for name, values in sections.items()}
+
+    def __getitem__(self, name: str) -> CachedSection:
+        return self._sections[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sections
+
+    def sections(self) -> List[str]:
+        return [name for name in self._sections if name != 'DEFAULT']
+
+    def has_section(self, name: str) -> bool:
+        return name != 'DEFAULT' and name in self._sections
+
+
+def read_cache(path: str, stamp: list) -> Optional[CachedConfig]:
+    """ The config cached at @path if it was made from the config file version
+        @stamp, and the cache file is private to us. None otherwise
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd) as fp:
+        st = os.fstat(fd)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            log.warning("Ignoring config cache %s, not private to this user", path)
+            return None
+        try:
+            data = json.load(fp)
+        except ValueError:
+            log.warning("Ignoring corrupt config cache %s", path)
+            return None
+    if data.get('version') != VERSION or data.get('stamp') != stamp:
+        return None
+    return CachedConfig(data['sections'])
+
+
+def write_cache(path: str, stamp: list, cfg) -> None:
+    """ Cache the values of config @cfg (made from config file version
+        @stamp) at @path, atomically. Failure is only logged
+    """
+    sections = {name: dict(cfg[name]) for name in ['DEFAULT'] + cfg.sections()}
+    data = json.dumps({'version': VERSION, 'stamp': stamp, 'sections': sections})
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("Could not write config cache %s: %s", path, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
+# Runs as a new process for each webhook, so it only imports what it needs.
+# Set AUTODEPLOYCACHE in the environment to a file path writable by the CGI
+# user (eg SetEnv in apache) to cache the parsed config between runs.
 import sys
 import os
-import traceback
 
-from autodeploy.webhook import process_webhook_output
-from autodeploy.message import Message, send_message
+from autodeploy import get_config
+from autodeploy.webhook import WebhookIngest, url_repo, refusal
+from autodeploy.message import Message, send_message, send_command
 
 print("Content-type: text/plain")
 
+config = get_config()
+
+# Return 202 and the job id once the daemon accepted the deploy
+async_mode = config['DEFAULT'].getboolean('async', False)
+
 
 def err_exit(message: str = 'An error occured', status: int = 400) -> None:
     print(f'Status: {status}\n\n{message}')
@@ -21,23 +29,45 @@ def get_signature():
         err_exit('No signature header found', 401)
 
 
-def recieve_and_submit(data: bytes, sig: str):
+def recieve_and_submit(length: int, sig: str):
 
-    json = process_webhook_output(data, sig)
+    # The signature is computed while reading, and the body only parsed if
+    # valid. A webhook URL naming a repo (PATH_INFO ending in its name, or a
+    # repo query parameter) checks it against that repo's secret only
+    repo = url_repo(os.environ.get('PATH_INFO', '') + '?' + os.environ.get('QUERY_STRING', ''),
+                    config)
+    refused = refusal(config, repo)
+    if refused:
+        err_exit(refused, 403)
+    ingest = WebhookIngest(config, repo)
+    ingest.read(sys.stdin.buffer.read, length)
+    json = ingest.result(sig)
     if not json:
         err_exit('Invalid signature, repo, or branch', 403)
         return
-    return send_message(Message.from_json(json).as_bytes())
+    packet = Message.from_json(json).as_bytes()
+    if async_mode:
+        return send_command('submit', payload=packet.decode('utf8'))
+    return send_message(packet)
 
 
 if __name__ == '__main__':
+    length = int(os.environ.get('CONTENT_LENGTH') or 0)
+    max_body = config['DEFAULT'].getint('webd_max_body', 1 << 20)
+    if max_body and length > max_body:
+        err_exit('Payload too large', 413)
     try:
-        out, ok = recieve_and_submit(sys.stdin.buffer.read(), get_signature())
+        out, ok = recieve_and_submit(length, get_signature())
     except Exception as e:
+        import traceback
         err_exit('CGI Exception occured: %s\n%s' %
                  (str(e), '\n'.join(traceback.format_tb(e.__traceback__))), 501)
 
-    if not ok:
+    if not ok and out.startswith('Daemon busy'):
+        err_exit(out, 503)
+    elif not ok:
         err_exit('Error occured processing hook: %s' % out, 500)
+    elif async_mode:
+        print(f'Status: 202\n\n{out}')
     else:
         print(f'Status: 200\n\n{out}')
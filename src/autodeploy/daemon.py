@@ -9,111 +9,927 @@
 # daemon can run as root or another user who will actually own the files in the
 # end...
 
-from typing import Optional, Union
+from typing import Optional, Union, Dict, Tuple, List, Callable, Deque
+from collections import deque
 
+import json
+import functools
+import hashlib
+import re
 import socket
 import logging
+import threading
 import stat
+import time
 import os
 
-from socketserver import UnixStreamServer, BaseRequestHandler
+from socketserver import UnixStreamServer, TCPServer, BaseRequestHandler
+from configparser import ConfigParser, SectionProxy
+from concurrent.futures import ThreadPoolExecutor, Executor, Future
 
-from .message import Message
-from . import config, mail_host
+from .message import Message, Command, is_command
+from .message import FRAME_MAGIC, FRAME_HEADER, FRAME_REQUEST, FRAME_REPLY, FRAME_OUTPUT
+from .message import read_frame, write_frame, recv_exact, recv_all
+from .jobs import JobTable
+from .journal import Journal
+from .release import Releases
+from .postscripts import Postscript, LinePrefixer, parse_postscripts, select, run_graph
+from .mailer import Mailer
+from .prefetch import Prefetcher
+from .metrics import Counter, Gauge, Histogram
+from . import metrics
+from . import privsep
+from . import get_config, reload_config
 
-from .repo import GitRepo, GitExcept
-from .util import get_output, send_email, run_serverclass_thread
+from .repo import GitRepo, GitExcept, GitStats, LazyDiff, Mirror
+from .util import stream_output, run_serverclass_thread, parse_address, parse_targets, ThreadPoolMixIn
 
 log = logging.getLogger(__name__)
 
-email = mail_host is not None
+# Global settings as of startup, for those that need a restart to change
+settings = get_config()['DEFAULT']
 
+email = settings.get('smtphost') is not None
 
-class SyncRequestHandler(BaseRequestHandler):
+# Notifications are sent in the background so the SMTP relay never delays a
+# deploy, optionally merged per recipient and repo over mail_digest seconds
+mailer = Mailer(settings['smtphost'], digest=settings.getfloat('mail_digest', 0),
+                retries=settings.getint('mail_retries', 5)) if email else None
+
+
+# Where deploy time goes, exposed by the stats command. Stages are decode and
+# verify of the message, queue (waiting for the repo), mirror (fetching the
+# shared mirror), fetch, checkout, postscript, and the diff and notify for the
+# email
+STAGE_SECONDS = Histogram('autodeploy_stage_seconds', 'Time spent in each stage of a deploy',
+                          ['repo', 'stage'])
+DEPLOY_SECONDS = Histogram('autodeploy_deploy_seconds',
+                           'Time from receiving a deploy to the repo being deployed, '
+                           'including waiting and the postscript', ['repo'])
+DEPLOYS = Counter('autodeploy_deploys_total',
+                  'Deploys by outcome: ok, failed, postscript_failed, superseded or skipped',
+                  ['repo', 'outcome'])
+REQUESTS = Counter('autodeploy_daemon_requests_total', 'Requests answered by outcome: ok or error',
+                   ['outcome'])
+QUEUE_DEPTH = Gauge('autodeploy_queue_depth', 'Deploys waiting for their repo to be free')
+IN_FLIGHT = Gauge('autodeploy_deploys_in_flight', 'Deploys running')
+JOBS_PENDING = Gauge('autodeploy_jobs_pending', 'Async jobs waiting for their repo or a worker')
+GIT_COMMANDS = Counter('autodeploy_git_commands_total',
+                       'Git queries run as their own process or by the batch helper',
+                       ['repo', 'how'])
+PREFETCHES = Counter('autodeploy_prefetches_total',
+                     'Background fetches by outcome: ok, failed or skipped (repo busy)',
+                     ['repo', 'outcome'])
+PREFETCH_SECONDS = Histogram('autodeploy_prefetch_seconds', 'Time spent in background fetches',
+                             ['repo'])
+
+
+class RepoQueue(object):
+    """ Serialize all work on one local repo and coalesce deploys waiting for
+        it: a deploy that is still queued when a newer push for the same
+        branch arrives is dropped in favor of the newest state. Deploys wait
+        here rather than in a worker, and use at most one worker at a time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()     # Held while a deploy runs
+        self._guard = threading.Lock()   # Protects the bookkeeping below
+        self._seq = 0
+        self._latest: Dict[str, Tuple[int, Message]] = {}  # branch -> newest
+        self._base: Dict[str, str] = {}  # branch -> before of oldest waiting
+        self._waiting: Deque[Callable[[], None]] = deque()
+        self._pool: Optional[Executor] = None   # Running the waiting work if set
+
+    def enqueue(self, msg: Message) -> int:
+        """ Register @msg as the newest deploy for its branch, return ticket """
+        with self._guard:
+            self._seq += 1
+            self._latest[msg.branch] = (self._seq, msg)
+            self._base.setdefault(msg.branch, msg.before)
+            return self._seq
+
+    def superseded_by(self, ticket: int, msg: Message) -> Optional[Message]:
+        """ Newer message replacing ticket @ticket, or None if it is newest """
+        with self._guard:
+            seq, newest = self._latest[msg.branch]
+            return newest if seq != ticket else None
+
+    def start(self, msg: Message) -> str:
+        """ Mark the deploy of @msg as started and return the state the repo
+            should be in, ie the before-state of the oldest coalesced push
+        """
+        with self._guard:
+            return self._base.pop(msg.branch, msg.before)
 
-    # Overwrite parent setup to read input for us since we are message-based
-    def setup(self):
-        self.data = b''
+    def run(self, work: Callable[[], None], pool: Executor) -> None:
+        """ Run @work in @pool after the work given before it, which must not
+            raise. Work waiting for the repo waits here, not in @pool
+        """
+        with self._guard:
+            self._waiting.append(work)
+            if self._pool:
+                return
+            self._pool = pool
+        pool.submit(self._drain)
+
+    def _drain(self) -> None:
         while True:
-            chunk = self.request.recv(4096)
-            if not chunk:
-                break
-            self.data += chunk
+            with self._guard:
+                work = self._waiting.popleft()
+            work()
+            with self._guard:
+                if not self._waiting:
+                    self._pool = None
+                    return
+                pool = self._pool
+            try:
+                # Give other repos a turn at the worker before the next
+                pool.submit(self._drain)
+                return
+            except RuntimeError:
+                # Shutting down, finish what is waiting here
+                continue
+
+
+_repo_queues: Dict[str, RepoQueue] = {}
+_repo_queues_guard = threading.Lock()
+
+
+def repo_queue(path: str) -> RepoQueue:
+    """ Return the queue serializing all work on the repo at @path """
+
+    with _repo_queues_guard:
+        return _repo_queues.setdefault(os.path.realpath(path), RepoQueue())
+
+
+# Deploys run here once their repo is free, each repo using one worker at a
+# time so that a busy repo cannot hold up the others
+deploy_pool = ThreadPoolExecutor(max_workers=settings.getint('workers', 1))
+
 
-    # Handle method does the actual work and sends reponse back to client
+class SyncRequestHandler(BaseRequestHandler):
+
+    # Connections sending nothing for longer than this are closed
+    idle_timeout: float = settings.getfloat('idle_timeout', 60)
+
+    # Handle method reads a request and sends the reponse back to the client.
+    # A framed connection is then parked with the server, which hands it to a
+    # new handler when the next request comes, so idle connections do not
+    # hold a worker
     def handle(self):
+        self.sink = None
+        self.request.settimeout(self.idle_timeout)
+        try:
+            magic = recv_exact(self.request, len(FRAME_MAGIC))
+        except socket.timeout:
+            log.debug("Closing idle connection")
+            return
+        if magic != FRAME_MAGIC:
+            # Legacy client: a single message ended by shutting down its side
+            self.data = magic + recv_all(self.request)
+            self.respond(self.request.sendall, keep=False)
+            return
+
+        self.sink = self.send_output
+        try:
+            ftype, self.data = read_frame(self.request, magic=False, limit=1 << 20)
+        except socket.timeout:
+            log.error("Timed out reading a frame from client")
+            return
+        except (ValueError, ConnectionError) as e:
+            log.error("Bad frame from client: %s", e)
+            return
+        if ftype != FRAME_REQUEST:
+            log.error("Unexpected frame type %d from client", ftype)
+            return
+        self.respond(lambda answer: write_frame(self.request, FRAME_REPLY, answer), keep=True)
+
+    def send_output(self, chunk: bytes) -> None:
+        """ Stream postscript output to a framed client as it is produced """
+        if self.sink is None:
+            return
+        try:
+            write_frame(self.request, FRAME_OUTPUT, chunk)
+        except OSError as e:
+            log.warning("Client gone, no longer streaming output: %s", e)
+            self.sink = None
+
+    def respond(self, send: Callable[[bytes], None], keep: bool) -> None:
+        """ Send the answer to the request in self.data with @send, then park
+            the connection if @keep. Deploys are answered by the deploy worker
+            once done, the connection being detached from this one meanwhile
+        """
+        # The whole request sees the config as it was when it came in
+        self.config = get_config()
         try:
-            data = self.do_request()
+            result = self.do_request()
         except Exception as e:
-            log.error("Exception while handling request: %s", e)
-            self.request.sendall(str(e).encode('utf8'))
-        else:
-            self.request.sendall(b'OK\n' + data)
+            result = failed(e)
+        if isinstance(result, bytes):
+            result = done(result)
+        detached = not result.done()
+        if detached:
+            self.server.detach(self.request)
+
+        def reply(result: Future) -> None:
+            try:
+                send(answer_of(result))
+            except OSError as e:
+                log.warning("Client gone before its answer: %s", e)
+                ok = False
+            else:
+                ok = keep
+            if detached:
+                self.server.resume(self.request, self.client_address, ok)
+            elif ok:
+                self.server.park(self.request)
+        result.add_done_callback(reply)
 
-    def do_request(self) -> bytes:
+    def do_request(self) -> Union[bytes, Future]:
         """ Dispatch the request by putting repo in the requested state,
-            returning any output of the postscript if available, and raising
-            an exception on any errors
+            returning any output of the postscript if available (or a future
+            of it), and raising an exception on any errors
         """
 
         # Already read all data in to self.data at this point
         log.debug("Daemon got raw data: %s", self.data)
+        if is_command(self.data):
+            return run_command(self.data, self.config)
+        received = time.monotonic()
+        return queue_deploy(*parse_message(self.data, self.config), sink=self.sink,
+                            received=received)
+
+
+def done(result: bytes) -> Future:
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+
+def failed(error: Exception) -> Future:
+    future: Future = Future()
+    future.set_exception(error)
+    return future
+
+
+def answer_of(result: Future) -> bytes:
+    """ The answer for the client to the request with @result """
+    try:
+        data = result.result()
+    except Exception as e:
+        log.error("Exception while handling request: %s", e)
+        REQUESTS.inc(outcome='error')
+        return str(e).encode('utf8')
+    REQUESTS.inc(outcome='ok')
+    return b'OK\n' + data
+
+
+def parse_message(data: bytes, config: ConfigParser) -> Tuple[Message, SectionProxy]:
+    """ Decode and validate a message packet, returning it along with the
+        section of @config for the repo it targets
+    """
+    start = time.monotonic()
+    try:
+        msg = Message.from_bytes(data)
+    except Exception as e:
+        raise ValueError('Error decoding / invalid message sent') from e
+
+    # Section names in the config file are repo names
+    if msg.repo not in config:
+        raise KeyError(f'Got a repo ({msg.repo}) not found in cfg=f{config}')
+    sec = config[msg.repo]
+    decoded = time.monotonic()
+    STAGE_SECONDS.observe(decoded - start, repo=msg.repo, stage='decode')
+
+    # Validate HMAC of "message" bytes from the client
+    if not msg.verify(config['DEFAULT']['daemonkey']):
+        raise ValueError(f'Invalid signature on {msg.repo}')
+    STAGE_SECONDS.observe(time.monotonic() - decoded, repo=msg.repo, stage='verify')
+    return msg, sec
+
+
+def queue_deploy(msg: Message, sec: SectionProxy,
+                 sink: Optional[Callable[[bytes], None]] = None,
+                 received: Optional[float] = None,
+                 on_start: Optional[Callable[[], None]] = None) -> Future:
+    """ Queue a deploy putting the repo of @sec in the state requested by
+        @msg and running its postscript, returning the future reply for the
+        client. The deploy runs in the deploy pool once its repo is free,
+        calling @on_start first. Postscript output is also passed to @sink as
+        it is produced. @received is when the request came in
+        (time.monotonic), for the deploy latency metric
+    """
+
+    received = received or time.monotonic()
+    if sec.get('targets'):
+        return queue_targets(msg, sec, sink, received, on_start)
+    queue = repo_queue(sec['local'])
+    ticket = queue.enqueue(msg)
+    queued = time.monotonic()
+    QUEUE_DEPTH.inc()
+    future: Future = Future()
+
+    def work() -> None:
+        QUEUE_DEPTH.dec()
+        if on_start:
+            on_start()
         try:
-            msg = Message.from_bytes(self.data)
+            future.set_result(run_deploy(msg, sec, queue, ticket, sink, received, queued))
         except Exception as e:
-            raise ValueError('Error decoding / invalid message sent') from e
+            future.set_exception(e)
+
+    queue.run(work, deploy_pool)
+    return future
+
+
+def deploy(msg: Message, sec: SectionProxy,
+           sink: Optional[Callable[[bytes], None]] = None,
+           received: Optional[float] = None) -> bytes:
+    """ Deploy like queue_deploy, waiting for the reply. Not for use by the
+        deploy pool itself
+    """
+    return queue_deploy(msg, sec, sink, received).result()
+
+
+def run_deploy(msg: Message, sec: SectionProxy, queue: RepoQueue, ticket: int,
+               sink: Optional[Callable[[bytes], None]], received: float, queued: float) -> bytes:
+    """ The deploy of @msg queued in @queue with @ticket at @queued (time.monotonic),
+        once its turn
+    """
+
+    target = sec['local'] if sec.get('target_of') else None
+    coalesce = sec.getboolean('coalesce', True)
+    queue.lock.acquire()
+    started = time.monotonic()
+    STAGE_SECONDS.observe(started - queued, repo=msg.repo, stage='queue')
+
+    def record(outcome: str, before: str = msg.before, **fields) -> None:
+        if target:
+            fields['target'] = target
+        if journal:
+            journal.record(msg.repo, msg.branch, before, msg.state, outcome,
+                           pusher=msg.pusher, queued_seconds=started - received,
+                           run_seconds=time.monotonic() - started, **fields)
+
+    try:
+        newer = queue.superseded_by(ticket, msg) if coalesce else None
+        if newer:
+            log.info("Deploy of %s to %s superseded by %s",
+                     msg.state, sec['local'], newer.state)
+            DEPLOYS.inc(repo=msg.repo, outcome='superseded')
+            record('superseded', superseded_by=newer.state)
+            return (f"Deploy of {msg.state} superseded by queued deploy of "
+                    f"{newer.state} pushed by {newer.pusher}\n").encode('utf8')
+        before = queue.start(msg) if coalesce else msg.before
+
+        # A redelivered or replayed webhook for what is already deployed
+        if (journal and sec.getboolean('skip_applied', True) and os.path.exists(sec['local'])
+                and journal.applied(msg.repo, msg.branch, target) == msg.state):
+            log.info("Repo %s already at %s, skipping deploy", msg.repo, msg.state)
+            DEPLOYS.inc(repo=msg.repo, outcome='skipped')
+            record('skipped', before)
+            return f"Repo in {sec['local']} already at state {msg.state}\n".encode('utf8')
+
+        with IN_FLIGHT.track():
+            diff, release = None, None
+            try:
+                if sec.getboolean('bare'):
+                    log.info("Bare repo fetch...")
+                    git = update_repo(sec, msg.branch, msg.state)
+                    count_git(msg.repo, git)
+                    log.debug("Deploy of %s used %s", sec['local'], git.stats)
+                elif sec.getint('releases', 0):
+                    release, diff = make_release(sec, msg.branch, before, msg.state)
+                else:
+                    diff = make_repo_state(sec, msg.branch, before, msg.state)
+                log.info("GitRepo at %s synced %s --> %s by %s <%s>",
+                         sec['local'], before, msg.state, msg.fullname, msg.email)
+                postscript, rc, ran = run_postscript_and_notify(msg, sec, diff, sink, release,
+                                                                before)
+            except Exception as e:
+                DEPLOYS.inc(repo=msg.repo, outcome='failed')
+                record('failed', before, error=str(e), release=release)
+                if isinstance(e, GitExcept):
+                    log.exception("Exception with git: %s", e)
+                raise
+            # Not applied if a postscript failed, so a retry runs it again
+            outcome = 'postscript_failed' if rc else 'ok'
+            record(outcome, before, postscript_rc=rc, release=release)
+    finally:
+        queue.lock.release()
+    DEPLOYS.inc(repo=msg.repo, outcome=outcome)
+    DEPLOY_SECONDS.observe(time.monotonic() - received, repo=msg.repo)
+    reply = f"Repo in {sec['local']} updated to state {msg.state}\n"
+    if release:
+        reply += f"Release {release} is live at {releases_of(sec).link}\n"
+    if postscript:
+        reply += f"\nPost script {ran} returns:\n"
+    return reply.encode('utf8') + postscript
+
+
+def targets_of(sec: SectionProxy) -> List[SectionProxy]:
+    """ Sections like @sec for each of its targets, with the branch and local
+        path of the target, and target_of the local path of @sec, whose clone
+        the target is a worktree of
+    """
+
+    targets = []
+    for branch, path in parse_targets(sec['targets']):
+        values = dict(sec, branch=branch, local=path, target_of=sec['local'])
+        del values['targets']
+        cfg = ConfigParser(interpolation=None)
+        cfg.read_dict({sec.name: values})
+        targets.append(cfg[sec.name])
+    return targets
+
 
-        # Section names in the config file are repo names
-        if msg.repo not in config:
-            raise KeyError(f'Got a repo ({msg.repo}) not found in cfg=f{config}')
-        sec = config[msg.repo]
+def queue_targets(msg: Message, sec: SectionProxy,
+                  sink: Optional[Callable[[bytes], None]] = None,
+                  received: Optional[float] = None,
+                  on_start: Optional[Callable[[], None]] = None) -> Future:
+    """ Queue the deploy of @msg to each target of @sec for its branch,
+        fetching it only once (in the queue of the repo of @sec) and then
+        updating the targets in parallel, each like a repo of its own. The
+        future reply has the replies of all of them, failing with those if
+        one failed
+    """
 
-        # Validate HMAC of "message" bytes from the client
-        if not msg.verify():
-            raise ValueError(f'Invalid signature on {msg.repo}')
+    targets = [t for t in targets_of(sec) if msg.branch == f"refs/heads/{t['branch']}"]
+    if not targets:
+        return failed(ValueError(f'No target of {msg.repo} for {msg.branch}'))
+    queue = repo_queue(sec['local'])
+    future: Future = Future()
+    results: Dict[str, Tuple[bool, bytes]] = {}
+    lock = threading.Lock()
 
-        diff = None
+    def finish(target: SectionProxy, prefixed: Optional[LinePrefixer], result: Future) -> None:
+        if prefixed:
+            prefixed.flush()
         try:
-            if sec.getboolean('bare'):
-                log.info("Bare repo fetch...")
-                update_repo(sec['local'], sec['url'], True, sec.get('owner'))
+            res = True, result.result()
+        except Exception as e:
+            log.error("Deploy of %s to target %s failed: %s", msg.repo, target['local'], e)
+            res = False, str(e).encode('utf8') + b'\n'
+        with lock:
+            results[target['local']] = res
+            if len(results) < len(targets):
+                return
+        outcomes = [(t, results[t['local']]) for t in targets]
+        reply = b''.join(f"== {t['branch']} -> {t['local']}: {'ok' if ok else 'FAILED'}\n".encode('utf8') + out
+                         for t, (ok, out) in outcomes)
+        if all(ok for _, (ok, _) in outcomes):
+            future.set_result(reply)
+        else:
+            future.set_exception(RuntimeError(reply.decode('utf8', 'replace')))
+
+    def fetch() -> None:
+        if on_start:
+            on_start()
+        try:
+            with queue.lock:
+                update_repo(sec, msg.branch, msg.state)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        for target in targets:
+            prefixed = LinePrefixer(sink, target['local']) if sink and len(targets) > 1 else None
+            queue_deploy(msg, target, prefixed or sink, received).add_done_callback(
+                functools.partial(finish, target, prefixed))
+
+    queue.run(fetch, deploy_pool)
+    return future
+
+
+# Handlers for Command packets, keyed by verb. Each takes the (verified)
+# command and the config to use, and returns the reply for the client or
+# raises on error
+COMMANDS: Dict[str, Callable[[Command, ConfigParser], bytes]] = {}
+
+
+def command(verb: str):
+    """ Decorator registering a handler for Commands with @verb """
+    def register(func):
+        COMMANDS[verb] = func
+        return func
+    return register
+
+
+def run_command(data: bytes, config: ConfigParser) -> bytes:
+    try:
+        cmd = Command.from_bytes(data)
+    except Exception as e:
+        raise ValueError('Error decoding / invalid command sent') from e
+    if not cmd.verify(config['DEFAULT']['daemonkey']):
+        raise ValueError(f'Invalid signature on command {cmd.verb}')
+    if cmd.verb not in COMMANDS:
+        raise KeyError(f'Unknown command {cmd.verb}')
+    return COMMANDS[cmd.verb](cmd, config)
+
+
+# Record of the deploys done, if configured, to skip those already done and
+# answer the history command
+journal = Journal(settings['journal'], settings.getint('journal_keep', 100)) \
+    if settings.get('journal') else None
+
+# Deploys accepted in async mode run in the background as jobs
+jobs = JobTable(settings.getint('job_history', 100))
+
+
+@command('submit')
+def submit_job(cmd: Command, config: ConfigParser) -> bytes:
+    """ Validate the message in the payload and deploy it in the background,
+        answering with just the id of the job right away
+    """
+    received = time.monotonic()
+    msg, sec = parse_message(cmd.payload.encode('utf8'), config)
+    job = jobs.new(msg, cap=sec.getint('postscript_output_cap', 1 << 20))
+
+    def start() -> None:
+        JOBS_PENDING.dec()
+        job.start()
+
+    def finish(result: Future) -> None:
+        error = result.exception()
+        if error:
+            job.finish(error=error)
+        else:
+            job.finish(result.result())
+
+    JOBS_PENDING.inc()
+    queue_deploy(msg, sec, sink=job.progress, received=received, on_start=start).add_done_callback(finish)
+    log.info("Accepted job %s for %s state %s", job.id, msg.repo, msg.state)
+    return f'{job.id}\n'.encode('utf8')
+
+
+@command('job')
+def job_status(cmd: Command, config: ConfigParser) -> bytes:
+    """ JSON dump of the job with the id given as argument """
+    job = jobs.get(cmd.args[0]) if cmd.args else None
+    if not job:
+        raise LookupError(f'No such job {" ".join(cmd.args)}')
+    return json.dumps(job.as_dict()).encode('utf8')
+
+
+@command('history')
+def deploy_history(cmd: Command, config: ConfigParser) -> bytes:
+    """ JSON list of the recent deploys of the repo given as first argument,
+        oldest first, optionally only as many as the second argument
+    """
+    if not journal:
+        raise LookupError('No journal configured')
+    if not cmd.args:
+        raise ValueError('Usage: history <repo> [count]')
+    count = int(cmd.args[1]) if len(cmd.args) > 1 else None
+    return json.dumps(journal.history(cmd.args[0], count)).encode('utf8')
+
+
+@command('rollback')
+def rollback(cmd: Command, config: ConfigParser) -> bytes:
+    """ Make the release before the live one of the repo given as first
+        argument live again, or the release named by the second argument
+    """
+    if not cmd.args:
+        raise ValueError('Usage: rollback <repo> [release]')
+    repo = cmd.args[0]
+    if repo not in config.sections() or not config[repo].getint('releases', 0):
+        raise LookupError(f'No repo {repo} deployed as releases')
+    sec = config[repo]
+    releases = releases_of(sec)
+    with repo_queue(sec['local']).lock:
+        current = releases.current()
+        name = cmd.args[1] if len(cmd.args) > 1 else releases.previous()
+        if not name:
+            raise LookupError(f'No release of {repo} before {current}')
+        releases.activate(name)
+
+        def state_of(release: Optional[str]) -> Optional[str]:
+            if not release:
+                return None
+            return GitRepo(releases.path(release), runas=sec.get('owner')).rev_parse('HEAD')
+
+        state = state_of(name)
+        if journal:
+            journal.record(repo, 'refs/heads/' + sec['branch'], state_of(current), state,
+                           'rollback', release=name, rolled_back=current)
+    log.info("Rolled back %s from release %s to %s", repo, current, name)
+    return f'Rolled back {repo} from release {current} to {name} ({state})\n'.encode('utf8')
+
+
+@command('stats')
+def stats(cmd: Command, config: ConfigParser) -> bytes:
+    """ All metrics of the daemon in Prometheus text format """
+    return metrics.render().encode('utf8')
+
+
+@command('reconcile')
+def reconcile_repos(cmd: Command, config: ConfigParser) -> bytes:
+    """ Deploy what the repos given as arguments (default all) are behind
+        their upstream on, answering with a summary
+    """
+    return reconcile(config, cmd.args or None)
+
+
+# The all-zero hash stands for a branch that did not exist before
+ZERO_STATE = '0' * 40
+
+
+def behind(sec: SectionProxy) -> List[Tuple[SectionProxy, str, str, str]]:
+    """ (section, branch, deployed state, upstream state) of each branch the
+        repo of @sec, or its targets, is behind its upstream on (any branch if
+        bare). Repos, targets and releases not deployed yet are left to their
+        first push
+    """
+
+    if not os.path.exists(sec['local']):
+        return []
+    git = GitRepo(sec['local'], runas=sec.get('owner'))
+    if sec.getboolean('bare', False):
+        heads = git.remote_heads(sec['url'])
+        local = {ref: git.rev_parse(ref) or ZERO_STATE for ref in heads}
+        return [(sec, ref, local[ref], state) for ref, state in heads.items() if local[ref] != state]
+
+    deployed = []
+    for view in targets_of(sec) if sec.get('targets') else [sec]:
+        path = view['local']
+        if view.getint('releases', 0):
+            current = releases_of(view).current()
+            path = releases_of(view).path(current) if current else None
+        if path and os.path.exists(path):
+            state = GitRepo(path, runas=view.get('owner')).rev_parse('HEAD')
+            if state:
+                deployed.append((view, 'refs/heads/' + view['branch'], state))
+    if not deployed:
+        return []
+    heads = git.remote_heads(sec['url'], sorted({ref for _, ref, _ in deployed}))
+    return [(view, ref, state, heads[ref]) for view, ref, state in deployed
+            if ref in heads and heads[ref] != state]
+
+
+def reconcile(config: ConfigParser, repos: Optional[List[str]] = None) -> bytes:
+    """ Deploy what the repos of @config (those named in @repos if given) are
+        behind their upstream on, eg pushes missed while the daemon was down,
+        like pushes of their upstream state. Up to reconcile_workers repos are
+        checked and deployed at once. Returns a summary, which is also logged
+    """
+
+    names = repos or config.sections()
+    unknown = [name for name in names if not config.has_section(name)]
+    if unknown:
+        raise LookupError(f'No such repo {", ".join(unknown)}')
+    settings = config['DEFAULT']
+    start = time.monotonic()
+
+    def run(name: str) -> List[Tuple[str, str]]:
+        """ (outcome, line for the summary) of each deploy of repo @name """
+        sec = config[name]
+        try:
+            stale = behind(sec)
+        except Exception as e:
+            log.error("Cannot reconcile %s: %s", name, e)
+            return [('failed', f'{name}: cannot check upstream: {e}')]
+        results = []
+        for view, ref, before, state in stale:
+            m = Message()
+            m.repo, m.branch, m.before, m.state = name, ref, before, state
+            m.pusher, m.fullname, m.email = 'autodeploy', 'reconcile', settings.get('reconcile_email', '')
+            what = f"{name} {ref} -> {view['local']}: {before[:12]}..{state[:12]}"
+            try:
+                if view.get('target_of'):
+                    # What queue_targets does, for this target only
+                    with repo_queue(sec['local']).lock:
+                        update_repo(sec, ref, state)
+                deploy(m, view)
+                results.append(('deployed', f'{what} deployed'))
+            except Exception as e:
+                log.error("Reconciling %s failed: %s", what, e)
+                results.append(('failed', f'{what} FAILED: {e}'))
+        return results or [('current', '')]
+
+    with ThreadPoolExecutor(max_workers=settings.getint('reconcile_workers', 8)) as pool:
+        results = [r for rs in pool.map(run, names) for r in rs]
+    count = {outcome: sum(1 for o, _ in results if o == outcome)
+             for outcome in ('current', 'deployed', 'failed')}
+    summary = (f"Reconciled {len(names)} repos in {time.monotonic() - start:.1f}s: "
+               f"{count['deployed']} deploys done, {count['failed']} failed, "
+               f"{count['current']} repos up to date")
+    (log.warning if count['failed'] else log.info)("%s", summary)
+    return '\n'.join([summary] + [line for o, line in results if line]).encode('utf8') + b'\n'
+
+
+def make_repo_state(sec: SectionProxy, ref: str, oldhash: str, newhash: str) -> LazyDiff:
+    """ Make sure the git repo of config section @sec is in state @newhash,
+        returning the diff from @oldhash, which is only computed if used
+    """
+
+    git = update_repo(sec, ref, newhash)
+    with STAGE_SECONDS.time(repo=sec.name, stage='checkout'):
+        current_hash = git.rev_parse('HEAD')
+        if oldhash != current_hash:
+            log.warning("Repo in unexpected state (%s) != upstream (%s)",
+                        current_hash, oldhash)
+        # With update = merge only the files changed since HEAD are touched
+        if sec.get('update', 'reset') == 'merge' and current_hash:
+            git.update(newhash)
+        else:
+            git.reset(newhash)
+    count_git(sec.name, git)
+    log.debug("Deploy of %s used %s", sec['local'], git.stats)
+    return LazyDiff(git, oldhash, newhash)
+
+
+def releases_of(sec: SectionProxy) -> Releases:
+    """ The release directories of the repo of @sec """
+    local = sec['local'].rstrip('/')
+    return Releases(sec.get('release_dir', local + '.releases'),
+                    sec.get('release_link', local + '.current'))
+
+
+def make_release(sec: SectionProxy, ref: str, oldhash: str, newhash: str) -> Tuple[str, LazyDiff]:
+    """ Check out @newhash into a new release of the repo of config section
+        @sec, returning its name and the diff from @oldhash. The release is
+        only made live by switch_release
+    """
+
+    git = update_repo(sec, ref, newhash)
+    releases = releases_of(sec)
+    name = releases.new_name(newhash)
+    with STAGE_SECONDS.time(repo=sec.name, stage='checkout'):
+        git.add_worktree(releases.path(name), newhash)
+    count_git(sec.name, git)
+    log.debug("Release %s of %s used %s", name, sec['local'], git.stats)
+    return name, LazyDiff(git, oldhash, newhash)
+
+
+def switch_release(sec: SectionProxy, name: str) -> None:
+    """ Make release @name of the repo of @sec live and prune old ones,
+        keeping as many as the releases setting says
+    """
+
+    releases = releases_of(sec)
+    releases.activate(name)
+    stale = releases.stale(sec.getint('releases'))
+    if stale:
+        git = get_repo(sec)
+        for old in stale:
+            log.info("Pruning release %s of %s", old, sec.name)
+            git.remove_worktree(releases.path(old))
+
+
+def update_repo(sec: SectionProxy, ref: Optional[str] = None, state: Optional[str] = None) -> GitRepo:
+    """ Run a fetch in the repo of config section @sec. With fetch = targeted
+        only @ref is fetched, and nothing at all if @state is already local
+    """
+
+    mirror = mirror_of(sec) if not sec.get('target_of') else None
+    if mirror:
+        with STAGE_SECONDS.time(repo=sec.name, stage='mirror'):
+            mirror.refresh(state)
+    git = get_repo(sec)
+    if sec.get('target_of'):
+        # Already fetched once for all targets, by queue_targets
+        return git
+    with STAGE_SECONDS.time(repo=sec.name, stage='fetch'):
+        if sec.get('fetch', 'all') == 'targeted':
+            git.fetch(ref, state)
+        else:
+            git.fetch()
+    return git
+
+
+def count_git(repo: str, git: GitRepo) -> None:
+    """ Add the git commands of a deploy to the metrics """
+    GIT_COMMANDS.inc(git.stats.spawned, repo=repo, how='spawned')
+    GIT_COMMANDS.inc(git.stats.batched, repo=repo, how='batched')
+
+
+# Shared mirrors of the upstreams, by url, when mirror_dir is set
+_mirrors: Dict[str, Mirror] = {}
+_mirrors_guard = threading.Lock()
+
+
+def mirror_of(sec: SectionProxy) -> Optional[Mirror]:
+    """ The mirror of the upstream of @sec under its mirror_dir, if set. It
+        is named after the url, so all sections with the same url share it
+    """
+
+    mirror_dir = sec.get('mirror_dir')
+    if not mirror_dir:
+        return None
+    url = sec['url']
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', url.rstrip('/'))[-60:].strip('._')
+    path = os.path.join(mirror_dir, f"{name}-{hashlib.sha1(url.encode('utf8')).hexdigest()[:10]}.git")
+    with _mirrors_guard:
+        mirror = _mirrors.get(path)
+        if mirror is None:
+            mirror = _mirrors[path] = Mirror(path, url)
+    return mirror
+
+
+def prefetch(sec: SectionProxy) -> None:
+    """ Fetch the upstream of @sec ahead of deploys: refresh its mirror if it
+        has one, or else fetch into its clone, unless a deploy is using it.
+        Repos not cloned yet are left to their first deploy
+    """
+
+    mirror = mirror_of(sec)
+    lock = None
+    if not mirror:
+        if not os.path.exists(sec['local']):
+            return
+        lock = repo_queue(sec['local']).lock
+        if not lock.acquire(blocking=False):
+            log.debug("Not prefetching %s, a deploy is running", sec.name)
+            PREFETCHES.inc(repo=sec.name, outcome='skipped')
+            return
+    try:
+        with PREFETCH_SECONDS.time(repo=sec.name):
+            if mirror:
+                mirror.refresh()
             else:
-                diff = make_repo_state(sec['local'], sec['url'], msg.before, msg.state, sec.get('owner'))
-            log.info("GitRepo at %s synced %s --> %s by %s <%s>",
-                     sec['local'], msg.before, msg.state, msg.fullname, msg.email)
-        except GitExcept as e:
-            log.exception("Exception with git: %s", e)
-            raise
-
-        postscript = run_postscript_and_notify(msg, sec['local'], sec.get('postscript'), diff)
-        reply = f"Repo in {sec['local']} updated to state {msg.state}\n"
-        if postscript:
-            reply += f"\nPost script {sec.get('postscript')} returns:\n"
-        return reply.encode('utf8') + postscript
-
-
-def make_repo_state(path: str, url: str, oldhash: str, newhash: str, user: Optional[str]) -> str:
-    """ Make sure git repo from @url is in state @newhash in folder @path """
-
-    git = update_repo(path, url, False, user)
-    current_hash = git.rev_parse('HEAD')
-    if oldhash != current_hash:
-        log.warning("Repo in unexpected state (%s) != upstream (%s)",
-                    current_hash, oldhash)
-    diff = git.diff(oldhash, newhash, stat=True)
-    git.reset(newhash)
-    return diff
-
-
-def update_repo(path: str, url: str, bare: bool, owner: Optional[str]) -> GitRepo:
-    """ Run a fetch in the repo given """
-
-    git = GitRepo(path, url, bare, runas=owner)
-    git.fetch()
+                get_repo(sec).prefetch()
+        PREFETCHES.inc(repo=sec.name, outcome='ok')
+    except GitExcept:
+        PREFETCHES.inc(repo=sec.name, outcome='failed')
+        raise
+    finally:
+        if lock:
+            lock.release()
+
+
+# Running as root, git commands for repos with an owner are run by worker
+# processes already running as that owner instead of through sudo
+privsep.use_workers(settings.getint('owner_workers', 2))
+
+# With persistent git, GitRepo objects (and their helper processes) are kept
+# around between deploys instead of being set up again for each request
+persistent_git = settings.getboolean('gitbatch', False)
+_git_repos: Dict[Tuple[str, str, bool, Optional[str]], GitRepo] = {}
+_git_repos_guard = threading.Lock()
+
+
+def get_repo(sec: SectionProxy) -> GitRepo:
+    """ GitRepo for the repo of @sec, reusing the one from earlier deploys if
+        possible. Only called with the repo lock held, and its stats are reset
+        so they cover the current deploy only
+    """
+
+    path, url, bare, owner = sec['local'], sec['url'], sec.getboolean('bare', False), sec.get('owner')
+    if sec.get('target_of') and not os.path.exists(path):
+        # Targets are worktrees of the clone of their section, which then
+        # has no checkout of its own
+        GitRepo(sec['target_of'], runas=owner).add_worktree(path, 'HEAD')
+    mirror = mirror_of(sec)
+    if mirror and not mirror.exists():
+        mirror.refresh()
+    clone = {'depth': sec.getint('depth'), 'filter': sec.get('filter'),
+             'checkout': not (sec.getint('releases', 0) or sec.get('targets')),
+             'mirror': mirror.dir if mirror else None}
+    if not persistent_git:
+        return GitRepo(path, url, bare, runas=owner, **clone)
+    key = (os.path.realpath(path), url, bare, owner)
+    with _git_repos_guard:
+        git = _git_repos.get(key)
+    if git is None or not git.exists():
+        git = GitRepo(path, url, bare, runas=owner, persistent=True, **clone)
+        with _git_repos_guard:
+            _git_repos[key] = git
+    git.stats = GitStats()
     return git
 
 
-def run_postscript_and_notify(m: Message, path: str, script: Optional[str], diff: Optional[str]) -> bytes:
+def run_postscript_and_notify(m: Message, sec: SectionProxy, diff: Optional[LazyDiff],
+                              sink: Optional[Callable[[bytes], None]] = None,
+                              release: Optional[str] = None, before: Optional[str] = None
+                              ) -> Tuple[bytes, Optional[int], Optional[str]]:
+    """ Run the postscripts of @sec called for by the changes since @before
+        (default that of @m) and email about the deploy, returning the
+        postscript output, exit code and what ran. A new @release runs the
+        postscripts in its directory and is only made live if they succeed,
+        raising otherwise
+    """
+
+    path = sec['local']
+    if release:
+        path = releases_of(sec).path(release)
+
+    out, rc, script = b'', None, None
+    scripts = parse_postscripts(sec)
+    if scripts:
+        with STAGE_SECONDS.time(repo=m.repo, stage='postscript'):
+            out, rc, script = run_postscripts(m, sec, scripts, before or m.before, sink,
+                                              cwd=path if release or sec.get('target_of') else '.')
+    failed = bool(release and rc)
+    if release and not failed:
+        switch_release(sec, release)
+    if failed:
+        error = (f'Post-script {script} returned {rc}, release {release} not made live:\n'
+                 + out.decode('utf8', 'replace'))
+        # Rather than have it take the place of a good one to roll back to
+        get_repo(sec).remove_worktree(path)
+    if not mailer or not m.email:
+        if failed:
+            raise RuntimeError(error)
+        return out, rc, script
 
     msg = f"""\
 Hello,
@@ -122,23 +938,117 @@ Git Deploy was done for {m.repo} on {socket.getfqdn()} in {path}
 setting state {m.state} for branch {m.branch}.
 """
     if diff:
-        msg += '\nChanges:\n\n' + diff + '\n'
-    out = b''
+        with STAGE_SECONDS.time(repo=m.repo, stage='diff'):
+            msg += '\nChanges:\n\n' + str(diff) + '\n'
     if script:
-        out, rc = get_output(script)
-        msg += f'\nPost-script {script} returned {rc}:\n{out.decode("utf8")}'
+        msg += f'\nPost-script {script} returned {rc}:\n{out.decode("utf8", "replace")}'
+    if failed:
+        msg += f'\nRelease {release} was NOT made live, and was removed.\n'
     msg += '\nGitDeploy Daemon'
 
-    subject = f'Git Deploy Done for {m.repo} on {socket.getfqdn()}'
-    if email:
-        send_email(m.email, subject, msg)
-    return out
+    subject = f'Git Deploy {"FAILED" if failed else "Done"} for {m.repo} on {socket.getfqdn()}'
+    with STAGE_SECONDS.time(repo=m.repo, stage='notify'):
+        mailer.submit(m.email, subject, msg, key=m.repo)
+    if failed:
+        raise RuntimeError(error)
+    return out, rc, script
 
 
-class SyncServer(UnixStreamServer):
+def run_postscripts(m: Message, sec: SectionProxy, scripts: List[Postscript], before: str,
+                    sink: Optional[Callable[[bytes], None]] = None,
+                    cwd: str = '.') -> Tuple[bytes, Optional[int], Optional[str]]:
+    """ Run those of @scripts whose path filters match the files changed from
+        @before to the state of @m, in parallel as far as their order and the
+        postscript_workers setting of @sec allow. Returns their output, the
+        exit code of the first that failed (0 if none) and what ran, or None
+        for both if nothing had to
+    """
+
+    # A lone plain postscript runs as it always did
+    if len(scripts) == 1 and not scripts[0].paths:
+        out, rc = run_postscript(m, sec, scripts[0].cmd, sink, cwd)
+        return out, rc, scripts[0].cmd
+
+    changed = None
+    if any(ps.paths for ps in scripts):
+        changed = get_repo(sec).changed_files(before, m.state)
+        if changed is None:
+            log.info("No list of changed files for %s, running all postscripts", m.repo)
+    torun = select(scripts, changed)
+    idle = [ps.name for ps in scripts if ps not in torun]
+    if idle:
+        log.info("Postscripts of %s not needed for %d changed files: %s",
+                 m.repo, len(changed), ', '.join(idle))
+    if not torun:
+        return b'', None, None
+
+    def run(ps: Postscript) -> Tuple[bytes, int]:
+        prefixed = LinePrefixer(sink, ps.name) if sink else None
+        try:
+            return run_postscript(m, sec, ps.cmd, prefixed, cwd, ps.name)
+        finally:
+            if prefixed:
+                prefixed.flush()
+
+    results = run_graph(torun, run, sec.getint('postscript_workers', 1))
+    out, rc = b'', 0
+    for ps in torun:
+        output, code = results[ps.name]
+        if code is None:
+            out += f'[{ps.name}] skipped, a postscript it is after failed\n'.encode('utf8')
+            continue
+        out += f'[{ps.name}] {ps.cmd} returned {code}:\n'.encode('utf8') + output
+        if output and not output.endswith(b'\n'):
+            out += b'\n'
+        if code and not rc:
+            rc = code
+    ran = ', '.join(ps.name for ps in torun)
+    if idle:
+        ran += f" (not needed: {', '.join(idle)})"
+    return out, rc, ran
+
+
+def run_postscript(m: Message, sec: SectionProxy, script: str,
+                   sink: Optional[Callable[[bytes], None]] = None,
+                   cwd: str = '.', name: Optional[str] = None) -> Tuple[bytes, int]:
+    """ Run @script in @cwd, logging its output and passing it to @sink as
+        it comes, within the timeout and output cap configured for section @sec.
+        @name tells apart the spool files of several postscripts
+    """
+
+    def output(chunk: bytes) -> None:
+        for line in chunk.decode('utf8', 'replace').splitlines():
+            log.debug("[%s] %s", m.repo, line)
+        if sink:
+            sink(chunk)
+
+    spill = None
+    spool = sec.get('postscript_spool')
+    if spool:
+        log_name = f"{m.repo.replace('/', '_')}-{m.state[:12]}-{int(time.time())}"
+        spill = os.path.join(spool, f'{log_name}-{name}.log' if name else f'{log_name}.log')
+    return stream_output(script, cwd=cwd, timeout=sec.getfloat('postscript_timeout'),
+                         cap=sec.getint('postscript_output_cap', 1 << 20),
+                         sink=output, spill=spill)
+
+
+BUSY = b'Daemon busy, too many requests queued, try again later\n'
+
+
+class SyncServer(ThreadPoolMixIn, UnixStreamServer):
 
     # Explicit string server_address
-    sa: str = config['DEFAULT']['socket']
+    sa: str = settings['socket']
+
+    # Requests for different repos are handled in parallel up to this many
+    max_workers: int = settings.getint('workers', 1)
+
+    # And the rest turned away beyond this many waiting, with a reply frame
+    # (as framed clients expect, legacy ones see the text all the same)
+    max_pending: int = settings.getint('max_queue', 0)
+    busy_answer: bytes = FRAME_MAGIC + FRAME_HEADER.pack(FRAME_REPLY, len(BUSY)) + BUSY
+
+    idle_timeout: float = SyncRequestHandler.idle_timeout
 
     def __init__(self):
         super().__init__(self.sa, SyncRequestHandler)
@@ -173,5 +1083,43 @@ class SyncServer(UnixStreamServer):
         self.server_address = self.socket.getsockname()
 
 
+class SyncTCPServer(ThreadPoolMixIn, TCPServer):
+    """ Listen for messages on TCP as well, eg from a webserver fanning out a
+        webhook to many nodes. Messages are signed with the daemon key, so all
+        nodes must share it
+    """
+
+    allow_reuse_address = True
+    max_workers: int = SyncServer.max_workers
+    max_pending: int = SyncServer.max_pending
+    busy_answer: bytes = SyncServer.busy_answer
+    idle_timeout: float = SyncServer.idle_timeout
+
+    def __init__(self, address: str):
+        super().__init__(parse_address('tcp:' + address)[1], SyncRequestHandler)
+
+
 def daemon_main():
-    run_serverclass_thread(SyncServer())
+    servers = [SyncServer()]
+    listen = settings.get('listen')
+    if listen:
+        servers.append(SyncTCPServer(listen))
+    prefetcher = Prefetcher(prefetch, settings.getint('prefetch_concurrency', 2),
+                            settings.getfloat('prefetch_jitter', 0.1))
+    config = get_config()
+    privsep.prestart({config[name]['owner'] for name in config.sections()
+                      if config[name].get('owner')})
+    prefetcher.start()
+    if settings.getboolean('reconcile_on_start', False):
+        # Catch up on pushes missed while down, without holding up serving
+        threading.Thread(target=lambda: reconcile(get_config()), name='reconcile',
+                         daemon=True).start()
+    run_serverclass_thread(servers, reload=reload_config)
+    # Finish the deploys accepted, which answer their clients if still there
+    deploy_pool.shutdown(wait=True)
+    prefetcher.stop()
+    if mailer:
+        mailer.close()
+    if journal:
+        journal.close()
+    privsep.close()
@@ -0,0 +1,134 @@
+# Bookkeeping for deploys the daemon runs in the background on behalf of a
+# client that does not wait for the result (async mode). Each accepted deploy
+# becomes a Job whose state, timings and output can be queried later by id.
+
+from typing import Optional, Dict, List, Callable
+from collections import OrderedDict
+
+import logging
+import threading
+import time
+import uuid
+
+from .message import Message
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Job', 'JobTable']
+
+
+class Job(object):
+
+    id:        str              # Opaque job identifier handed to clients
+    msg:       Message          # The deploy request
+    status:    str              # queued, running, done, or failed
+    submitted: float            # Timestamps (epoch seconds) of each phase
+    started:   Optional[float]
+    finished:  Optional[float]
+    error:     Optional[str]
+
+    def __init__(self, msg: Message, cap: Optional[int] = None):
+        """ A job for @msg, keeping at most @cap bytes of its output """
+        self.id = uuid.uuid4().hex
+        self.msg = msg
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.error = None
+        self.cap = cap
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def output(self) -> str:
+        """ Daemon reply, including postscript output, or the postscript
+            output so far if running
+        """
+        with self._lock:
+            out = b''.join(self._chunks)
+            self._chunks = [out] if out else []
+            dropped = self._dropped
+        text = out.decode('utf8', 'replace')
+        if dropped:
+            text += f'\n[... output truncated, {dropped} bytes not shown]\n'
+        return text
+
+    def progress(self, chunk: bytes) -> None:
+        """ Record output of the running job as it comes in """
+        with self._lock:
+            if self.cap is not None and self._size + len(chunk) > self.cap:
+                keep = max(0, self.cap - self._size)
+                self._dropped += len(chunk) - keep
+                chunk = chunk[:keep]
+            if chunk:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+
+    def start(self) -> None:
+        """ Mark the job as running """
+        self.status, self.started = 'running', time.time()
+
+    def finish(self, reply: bytes = b'', error: Optional[BaseException] = None) -> None:
+        """ Record the outcome of the job: its @reply, or the @error it failed
+            with
+        """
+        if error is not None:
+            log.error("Exception in job %s: %s", self.id, error)
+            self.status, self.error = 'failed', str(error)
+        else:
+            # The reply repeats the (already capped) postscript output
+            with self._lock:
+                self._chunks, self._size, self._dropped = [reply], len(reply), 0
+            self.status = 'done'
+        self.finished = time.time()
+
+    def run(self, func: Callable[[], bytes]) -> None:
+        """ Run @func as the body of this job, recording its outcome """
+
+        self.start()
+        try:
+            reply = func()
+        except Exception as e:
+            self.finish(error=e)
+        else:
+            self.finish(reply)
+
+    def as_dict(self) -> dict:
+        m = self.msg
+        d = {'id': self.id, 'repo': m.repo, 'branch': m.branch,
+             'before': m.before, 'state': m.state, 'pusher': m.pusher,
+             'status': self.status, 'submitted': self.submitted,
+             'started': self.started, 'finished': self.finished,
+             'queued_seconds': None, 'run_seconds': None,
+             'output': self.output, 'error': self.error}
+        if self.started:
+            d['queued_seconds'] = self.started - self.submitted
+        if self.started and self.finished:
+            d['run_seconds'] = self.finished - self.started
+        return d
+
+
+class JobTable(object):
+    """ Thread-safe table by id of the jobs queued or running, and of the
+        most recent @keep finished ones
+    """
+
+    def __init__(self, keep: int = 100):
+        self.keep = keep
+        self._jobs: Dict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new(self, msg: Message, cap: Optional[int] = None) -> Job:
+        job = Job(msg, cap)
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [id for id, j in self._jobs.items() if j.status in ('done', 'failed')]
+            for id in finished[:max(0, len(finished) - self.keep)]:
+                del self._jobs[id]
+        return job
+
+    def get(self, id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(id)
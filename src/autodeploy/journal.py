@@ -0,0 +1,121 @@
+# Append-only journal of the deploys done by the daemon, one JSON record per
+# line, synced to disk before the client gets its answer. On startup it is
+# read back to index the state each repo (and branch) was last deployed to,
+# so that a redelivered or replayed webhook for a state that is already
+# deployed can be answered without touching git, and to keep the recent
+# history of each repo for the history command.
+
+from typing import Optional, Dict, List, Tuple
+from collections import deque
+
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Journal']
+
+
+class Journal(object):
+    """ The journal in the file @path, keeping the @keep most recent records
+        of each repo in memory. The file is compacted to those when opened if
+        it has grown to more than twice as many
+    """
+
+    def __init__(self, path: str, keep: int = 100):
+        self.path = path
+        self.keep = keep
+        self._lock = threading.Lock()
+        # (repo, branch, target path if any) -> last ok record
+        self._applied: Dict[Tuple[str, str, Optional[str]], dict] = {}
+        self._recent: Dict[str, deque] = {}
+        lines = self._load()
+        if lines > 2 * sum(len(d) for d in self._recent.values()):
+            self._compact()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        # Finish a torn last line so the next record starts on its own
+        with open(path, 'rb') as fp:
+            if fp.seek(0, os.SEEK_END) and (fp.seek(-1, os.SEEK_END), fp.read(1))[1] != b'\n':
+                os.write(self._fd, b'\n')
+
+    def _index(self, rec: dict) -> None:
+        recent = self._recent.setdefault(rec['repo'], deque(maxlen=self.keep))
+        recent.append(rec)
+        key = (rec['repo'], rec['branch'], rec.get('target'))
+        if rec.get('outcome') in ('ok', 'rollback'):
+            self._applied[key] = rec
+        elif rec.get('outcome') in ('failed', 'postscript_failed'):
+            # Left in an unknown or unfinished state, redeploy whatever comes
+            self._applied.pop(key, None)
+
+    def _load(self) -> int:
+        """ Index the records in the file, returning how many there are """
+        n = 0
+        try:
+            fp = open(self.path, 'r', encoding='utf8')
+        except FileNotFoundError:
+            return 0
+        with fp:
+            for n, line in enumerate(fp, 1):
+                try:
+                    self._index(json.loads(line))
+                except (ValueError, KeyError):
+                    # A torn last line from a crash mid-write
+                    log.warning("Skipping bad record at %s:%d", self.path, n)
+        log.info("Journal %s has %d records, %d repo states", self.path, n, len(self._applied))
+        return n
+
+    def _compact(self) -> None:
+        """ Rewrite the file with only the records kept in memory and the last
+            successful deploy of each repo, atomically
+        """
+        records = {id(r): r for d in self._recent.values() for r in d}
+        records.update((id(r), r) for r in self._applied.values())
+        records = sorted(records.values(), key=lambda r: r['time'])
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as fp:
+            for rec in records:
+                fp.write(json.dumps(rec) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+        log.info("Compacted journal %s to %d records", self.path, len(records))
+
+    def applied(self, repo: str, branch: str, target: Optional[str] = None) -> Optional[str]:
+        """ The state @branch of @repo (in @target, for repos deployed to
+            several) was last successfully deployed to
+        """
+        with self._lock:
+            rec = self._applied.get((repo, branch, target))
+        return rec['state'] if rec else None
+
+    def record(self, repo: str, branch: str, before: str, state: str, outcome: str,
+               **fields) -> dict:
+        """ Durably append a record of a deploy. @outcome is ok, failed,
+            postscript_failed (updated, but a postscript failed), superseded,
+            skipped or rollback, and @fields can add the pusher, timings,
+            postscript rc, error...
+        """
+        rec = {'time': time.time(), 'repo': repo, 'branch': branch, 'before': before,
+               'state': state, 'outcome': outcome}
+        rec.update(fields)
+        line = (json.dumps(rec) + '\n').encode('utf8')
+        with self._lock:
+            os.write(self._fd, line)
+            os.fsync(self._fd)
+            self._index(rec)
+        return rec
+
+    def history(self, repo: str, count: Optional[int] = None) -> List[dict]:
+        """ The @count (default all kept) most recent records of @repo, oldest
+            first
+        """
+        with self._lock:
+            recent = list(self._recent.get(repo, ()))
+        return recent[-count:] if count else recent
+
+    def close(self) -> None:
+        os.close(self._fd)
@@ -0,0 +1,162 @@
+# Send notification emails from a background thread so a slow or unreachable
+# SMTP relay never holds up a deploy. One SMTP connection is kept open while
+# mail keeps coming, failed sends are retried with backoff, and in digest mode
+# notifications for the same recipient and repo are merged over a window.
+
+from typing import Optional, Dict, List, Tuple
+
+import heapq
+import logging
+import queue
+import smtplib
+import threading
+import time
+
+from .util import make_email
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Mailer']
+
+
+class Mail(object):
+
+    def __init__(self, to: str, subject: str, body: str, key: Optional[str]):
+        self.to, self.subject, self.body, self.key = to, subject, body, key
+        self.attempts = 0
+        self.merged = 1     # Number of notifications in a digest
+
+    def merge(self, other: 'Mail') -> None:
+        """ Fold @other into this mail, as a digest """
+        if self.merged == 1:
+            self.body = f'--- {self.subject}\n\n{self.body}'
+        self.merged += 1
+        self.body += f'\n\n--- {other.subject}\n\n{other.body}'
+        self.subject = f'{other.subject} ({self.merged} notifications)'
+
+
+class Mailer(object):
+    """ Queue of mails sent by a background thread through the SMTP relay at
+        @host. With @digest > 0, mails with the same recipient and key that
+        are submitted within @digest seconds of the first are sent as one.
+    """
+
+    def __init__(self, host: str, digest: float = 0, retries: int = 5,
+                 backoff: float = 5, idle: float = 30,
+                 sender: str = 'Deploy Daemon <root@localhost>'):
+        self.host, self.digest, self.retries = host, digest, retries
+        self.backoff, self.idle, self.sender = backoff, idle, sender
+        self._queue: queue.Queue = queue.Queue()
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._pending: Dict[Tuple[str, str], Tuple[float, Mail]] = {}  # digests
+        self._retry: List[Tuple[float, int, Mail]] = []                # heap by due time
+        self._seq = 0
+        self._thread = threading.Thread(target=self._run, name='mailer', daemon=True)
+        self._thread.start()
+
+    def submit(self, to: str, subject: str, body: str, key: Optional[str] = None) -> None:
+        """ Queue a mail, returning right away """
+        self._queue.put(Mail(to, subject, body, key))
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """ Send everything still queued (without waiting out digest windows
+            or retry delays) and stop the thread
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                mail = self._queue.get(timeout=self._wait())
+            except queue.Empty:
+                mail = False
+            if mail is None:
+                break
+            batch = [mail] if mail else []
+            # Drain whatever else is queued to send it over the same connection
+            while True:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    self._queue.put(None)
+                    break
+                batch.append(more)
+            self._send_due(batch)
+        self._send_due([], flush=True)
+        self._disconnect()
+
+    def _wait(self) -> Optional[float]:
+        """ How long to wait for more mail before something else is due """
+        now = time.monotonic()
+        due = [t for t, _ in self._pending.values()] + [t for t, _, _ in self._retry[:1]]
+        if self._smtp:
+            due.append(now + self.idle)
+        return max(0, min(due) - now) if due else None
+
+    def _send_due(self, batch: List[Mail], flush: bool = False) -> None:
+        now = time.monotonic()
+        ready = []
+        for mail in batch:
+            if self.digest > 0 and mail.key:
+                k = (mail.to, mail.key)
+                if k in self._pending:
+                    self._pending[k][1].merge(mail)
+                else:
+                    self._pending[k] = (now + self.digest, mail)
+            else:
+                ready.append(mail)
+        for k, (due, mail) in list(self._pending.items()):
+            if flush or due <= now:
+                ready.append(mail)
+                del self._pending[k]
+        while self._retry and (flush or self._retry[0][0] <= now):
+            ready.append(heapq.heappop(self._retry)[2])
+
+        if ready:
+            for mail in ready:
+                self._send(mail, final=flush)
+        elif self._smtp and not self._retry and not self._pending:
+            # Nothing came during the idle time, let go of the connection
+            self._disconnect()
+
+    def _send(self, mail: Mail, final: bool = False) -> None:
+        msg = make_email(mail.to, mail.subject, mail.body, self.sender)
+        mail.attempts += 1
+        try:
+            # Reconnect once if the kept-open connection went stale
+            for attempt in (1, 2):
+                try:
+                    self._connect().send_message(msg)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    self._smtp = None
+                    if attempt == 2:
+                        raise
+        except (smtplib.SMTPException, OSError) as e:
+            self._disconnect()
+            if final or mail.attempts >= self.retries:
+                log.error("Giving up sending mail to %s after %d attempts: %s",
+                          mail.to, mail.attempts, e)
+                return
+            delay = self.backoff * 2 ** (mail.attempts - 1)
+            log.warning("Error sending mail to %s, retrying in %ss: %s", mail.to, delay, e)
+            self._seq += 1
+            heapq.heappush(self._retry, (time.monotonic() + delay, self._seq, mail))
+        else:
+            log.debug("Sent mail to %s: %s", mail.to, mail.subject)
+
+    def _connect(self) -> smtplib.SMTP:
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self.host)
+        return self._smtp
+
+    def _disconnect(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
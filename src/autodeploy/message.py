@@ -6,16 +6,61 @@
 #        branch:hashofoldstate:hashofnewstate \\n
 #        username:person-name:email \\n
 #        signature
+#
+# Command format (control requests to the daemon, told apart by the '!'):
+#        !verb arg1 arg2... \\n
+#        optional payload, possibly spanning lines \\n
+#        signature
+#
+# Wire protocol: legacy clients send one packet and shut down their side of
+# the socket, then read the answer until EOF. Framed clients instead send
+# each packet in a frame, and may send many over one connection:
+#        FRAME_MAGIC (4 bytes, includes protocol version)
+#        frame type (1 byte) + payload length (4 bytes, network order)
+#        payload
+# The daemon answers each request frame with a reply frame, possibly preceded
+# by output frames streaming postscript output as it runs. Either way, the
+# answer is "OK\\n" followed by the reply, or just an error message.
 
-from typing import Tuple
+from typing import Tuple, List, Optional, Dict, Callable
 
 import socket
+import struct
+import threading
 import hmac
+import logging
+
+# asyncio and concurrent.futures are only imported by the functions needing
+# them, they are slow to import for the CGI script which does not
+
+from autodeploy import get_config
+from autodeploy.util import check_hmac, parse_address
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Message', 'Command', 'is_command', 'send_message', 'send_command',
+           'send_legacy_message', 'send_to_all', 'read_frame', 'write_frame', 'recv_exact', 'recv_all',
+           'ConnectionPool', 'asend_message', 'asend_to_all']
+
+FRAME_MAGIC = b'\x00AD\x01'
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_REQUEST = 1
+FRAME_REPLY = 2
+FRAME_OUTPUT = 3    # Output streamed by the daemon before its reply
+
+
+def daemon_key() -> str:
+    return get_config()['DEFAULT']['daemonkey']
+
 
-from autodeploy import daemon_key, socket_path
-from autodeploy.util import check_hmac
+def sign(raw: str, key: Optional[str] = None) -> str:
+    """ HMAC digest of @raw with @key, by default the key from the configfile
+        for the daemon
+    """
 
-__all__ = ['Message', 'send_message']
+    hm = hmac.new((key or daemon_key()).encode('utf8'), raw.encode('utf8'),
+                  digestmod='sha256')
+    return hm.hexdigest()
 
 
 class Message(object):
@@ -52,40 +97,334 @@ class Message(object):
         m = f"{self.repo}\n{self.branch}:{self.before}:{self.state}\n"
         return m + f"{self.pusher}:{self.fullname}:{self.email}"
 
-    def as_bytes(self) -> bytes:
+    def as_bytes(self, key: Optional[str] = None) -> bytes:
         """ Make a "message packet" (bytes) for transmitting over the wire
-            and sign it with the key from the configfile for the daemon
+            and sign it with @key, by default the key from the configfile for
+            the daemon
+        """
+        return f"{self.rawstr}\n{sign(self.rawstr, key)}".encode('utf8')
+
+    def verify(self, key: Optional[str] = None) -> bool:
+        """ Verify the signature of this message against @key, by default
+            the key in the config file
         """
-        hm = hmac.new(daemon_key.encode('utf8'), self.rawstr.encode('utf8'),
-                      digestmod='sha256')
-        return f"{self.rawstr}\n{hm.hexdigest()}".encode('utf8')
+        return check_hmac(self.rawstr.encode('utf8'), key or daemon_key(), self.digest)
+
+
+class Command(object):
+
+    verb:    str         # What the daemon should do
+    args:    List[str]   # Whitespace-separated arguments to the verb
+    payload: str         # Free-form data, eg an embedded message packet
+    digest:  str         # signature digest
+
+    def __init__(self, verb: str = '', *args: str, payload: str = ''):
+        self.verb, self.args, self.payload = verb, list(args), payload
+
+    @classmethod
+    def from_bytes(cls, msg: bytes) -> 'Command':
+        c = cls()
+        raw, c.digest = msg.decode('utf8').rsplit('\n', 1)
+        line, _, c.payload = raw.partition('\n')
+        c.verb, *c.args = line[1:].split()
+        return c
+
+    @property
+    def rawstr(self) -> str:
+        """ The packet string without the hmac at the end """
+        line = ' '.join(['!' + self.verb] + self.args)
+        return f"{line}\n{self.payload}" if self.payload else line
+
+    def as_bytes(self, key: Optional[str] = None) -> bytes:
+        return f"{self.rawstr}\n{sign(self.rawstr, key)}".encode('utf8')
+
+    def verify(self, key: Optional[str] = None) -> bool:
+        return check_hmac(self.rawstr.encode('utf8'), key or daemon_key(), self.digest)
+
+
+def is_command(packet: bytes) -> bool:
+    """ Whether @packet is a Command rather than a deploy Message """
+    return packet.startswith(b'!')
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    """ Read exactly @n bytes from @sock, or less only if it hits EOF """
+
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        r = sock.recv_into(view[got:])
+        if not r:
+            break
+        got += r
+    return bytes(buf[:got])
+
+
+def recv_all(sock: socket.socket) -> bytes:
+    """ Read from @sock until EOF """
+
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def write_frame(sock: socket.socket, ftype: int, payload: bytes) -> None:
+    sock.sendall(FRAME_MAGIC + FRAME_HEADER.pack(ftype, len(payload)) + payload)
+
+
+def read_frame(sock: socket.socket, magic: bool = True,
+               limit: Optional[int] = None) -> Optional[Tuple[int, bytes]]:
+    """ Read one frame, returning its type and payload or None on a clean EOF
+        before it. With @magic False the magic was already consumed
+    """
+
+    if magic:
+        m = recv_exact(sock, len(FRAME_MAGIC))
+        if not m:
+            return None
+        if m != FRAME_MAGIC:
+            raise ValueError('Bad frame magic / protocol version')
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if len(header) != FRAME_HEADER.size:
+        raise ConnectionError('Connection closed inside frame header')
+    ftype, length = FRAME_HEADER.unpack(header)
+    if limit is not None and length > limit:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {limit}')
+    payload = recv_exact(sock, length)
+    if len(payload) != length:
+        raise ConnectionError('Connection closed inside frame')
+    return ftype, payload
+
+
+def parse_answer(data: bytes) -> Tuple[str, bool]:
+    """ Split an answer from the daemon into reply text and status """
 
-    def verify(self) -> bool:
-        """ Verify the signature of this message against the key in the
-            config file
+    ans = data.decode('utf8').split('\n')
+    # Errors have no status line, the whole answer is the error message
+    if ans[0] != 'OK':
+        return '\n'.join(ans), False
+    return '\n'.join(ans[1:]), True
+
+
+def connect(address: Optional[str] = None) -> socket.socket:
+    if address:
+        family, addr = parse_address(address)
+    else:
+        family, addr = socket.AF_UNIX, get_config()['DEFAULT']['socket']
+    s = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        s.connect(addr)
+    except Exception:
+        s.close()
+        raise
+    return s
+
+
+OutputCallback = Optional[Callable[[bytes], None]]
+
+
+def request(sock: socket.socket, packet: bytes, on_output: OutputCallback = None) -> bytes:
+    """ Send @packet in a request frame on @sock and return the answer,
+        passing any output streamed before it to @on_output
+    """
+
+    write_frame(sock, FRAME_REQUEST, packet)
+    while True:
+        frame = read_frame(sock)
+        if frame is None:
+            raise ConnectionError('Daemon closed the connection')
+        ftype, payload = frame
+        if ftype == FRAME_REPLY:
+            return payload
+        if ftype != FRAME_OUTPUT:
+            raise ValueError(f'Unexpected frame type {ftype} from daemon')
+        if on_output:
+            on_output(payload)
+
+
+def closed_by_peer(sock: socket.socket) -> bool:
+    """ Whether the idle connection @sock was closed by the other end (or
+        has data nobody asked for), without waiting
+    """
+    try:
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class ConnectionPool(object):
+    """ Keep up to @size idle framed connections to the daemon at @address
+        open, so many messages can be sent without reconnecting
+    """
+
+    def __init__(self, address: Optional[str] = None, size: int = 4):
+        self.address = address
+        self.size = size
+        self._idle: List[socket.socket] = []
+        self._lock = threading.Lock()
+
+    def request(self, packet: bytes, on_output: OutputCallback = None) -> bytes:
+        """ Send @packet on an idle connection, or a new one if there is none
+            still open. Once sent it is never sent again: the daemon may have
+            acted on it even if the connection then fails
         """
-        return check_hmac(self.rawstr.encode('utf8'), daemon_key, self.digest)
+        sock = None
+        with self._lock:
+            while self._idle and sock is None:
+                sock = self._idle.pop()
+                if closed_by_peer(sock):
+                    log.debug("Pooled connection to %s was closed, dropping it", self.address)
+                    sock.close()
+                    sock = None
+        if sock is None:
+            sock = connect(self.address)
+        try:
+            ans = request(sock, packet, on_output)
+        except Exception:
+            sock.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(sock)
+                sock = None
+        if sock is not None:
+            sock.close()
+        return ans
+
+    def close(self) -> None:
+        with self._lock:
+            for sock in self._idle:
+                sock.close()
+            self._idle = []
 
 
-def send_message(msg_bytes: bytes) -> Tuple[str, bool]:
+# Pools per daemon address, only used once enabled with use_pooling()
+_pools: Dict[Optional[str], ConnectionPool] = {}
+_pool_size = 0
+_pools_lock = threading.Lock()
+
+
+def use_pooling(size: int) -> None:
+    """ Keep up to @size persistent connections to each daemon talked to """
+    global _pool_size
+    _pool_size = size
+
+
+def send_message(msg_bytes: bytes, address: Optional[str] = None,
+                 on_output: OutputCallback = None) -> Tuple[str, bool]:
     """ Act as a client to the daemon SyncServer, taking an encoded message
-        sending it to the daemon as configured
+        sending it to the daemon as configured, or at @address if given (see
+        util.parse_address). Postscript output is passed to @on_output as the
+        daemon streams it
 
         Returns the answer and status from the daemon
     """
 
+    if _pool_size:
+        with _pools_lock:
+            pool = _pools.get(address)
+            if pool is None:
+                pool = _pools[address] = ConnectionPool(address, _pool_size)
+        return parse_answer(pool.request(msg_bytes, on_output))
+
+    with connect(address) as s:
+        return parse_answer(request(s, msg_bytes, on_output))
+
+
+def send_legacy_message(msg_bytes: bytes, address: Optional[str] = None) -> Tuple[str, bool]:
+    """ send_message using the unframed one message per connection protocol,
+        for daemons predating the framed one
+    """
+
     # Connect send and signal we're done with the socket before
     # getting the reply from the daemon
-    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-        s.connect(socket_path)
-
+    with connect(address) as s:
         s.sendall(msg_bytes)
         s.shutdown(socket.SHUT_WR)
-        data = b''
+        return parse_answer(recv_all(s))
+
+
+def send_command(verb: str, *args: str, payload: str = '',
+                 address: Optional[str] = None) -> Tuple[str, bool]:
+    """ Sign and send a Command to the daemon, returning its answer and status """
+
+    return send_message(Command(verb, *args, payload=payload).as_bytes(), address)
+
+
+def send_to_all(msg_bytes: bytes, addresses: List[str],
+                parallel: int = 8) -> List[Tuple[str, str, bool]]:
+    """ Send the same packet to the daemons at each of @addresses, at most
+        @parallel at a time, returning (address, answer, status) for each
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def send(address: str) -> Tuple[str, str, bool]:
+        try:
+            return (address, *send_message(msg_bytes, address))
+        except Exception as e:
+            return address, f'Error talking to daemon: {e}', False
+
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel, len(addresses)))) as pool:
+        return list(pool.map(send, addresses))
+
+
+async def asend_message(msg_bytes: bytes, address: Optional[str] = None,
+                        on_output: OutputCallback = None) -> Tuple[str, bool]:
+    """ send_message for asyncio code, not blocking the event loop while the
+        daemon works. Uses a new framed connection each time
+    """
+    import asyncio
+
+    if address:
+        family, addr = parse_address(address)
+    else:
+        family, addr = socket.AF_UNIX, get_config()['DEFAULT']['socket']
+    if family == socket.AF_UNIX:
+        reader, writer = await asyncio.open_unix_connection(addr)
+    else:
+        reader, writer = await asyncio.open_connection(*addr)
+    try:
+        writer.write(FRAME_MAGIC + FRAME_HEADER.pack(FRAME_REQUEST, len(msg_bytes)) + msg_bytes)
+        await writer.drain()
         while True:
-            chunk = s.recv(4096)
-            if not chunk:
-                break
-            data += chunk
-        ans = data.decode('utf8').split('\n')
-    return '\n'.join(ans[1:]), ans[0] == 'OK'
+            try:
+                head = await reader.readexactly(len(FRAME_MAGIC) + FRAME_HEADER.size)
+                if head[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+                    raise ValueError('Bad frame magic / protocol version')
+                ftype, length = FRAME_HEADER.unpack(head[len(FRAME_MAGIC):])
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError as e:
+                raise ConnectionError('Daemon closed the connection') from e
+            if ftype == FRAME_REPLY:
+                return parse_answer(payload)
+            if ftype != FRAME_OUTPUT:
+                raise ValueError(f'Unexpected frame type {ftype} from daemon')
+            if on_output:
+                on_output(payload)
+    finally:
+        writer.close()
+
+
+async def asend_to_all(msg_bytes: bytes, addresses: List[str],
+                       parallel: int = 8) -> List[Tuple[str, str, bool]]:
+    """ send_to_all for asyncio code """
+    import asyncio
+
+    limit = asyncio.Semaphore(max(1, parallel))
+
+    async def send(address: str) -> Tuple[str, str, bool]:
+        async with limit:
+            try:
+                return (address, *await asend_message(msg_bytes, address))
+            except Exception as e:
+                return address, f'Error talking to daemon: {e}', False
+
+    return list(await asyncio.gather(*(send(a) for a in addresses)))
@@ -0,0 +1,165 @@
+# Counters, gauges and histograms kept in memory by each daemon, rendered in
+# the Prometheus text exposition format: by the webserver at /metrics, and by
+# the deploy daemon in answer to the stats command.
+
+from typing import Dict, Tuple, List, Optional, Sequence, Iterator
+from contextlib import contextmanager
+
+import threading
+import time
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'CONTENT_TYPE']
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast cat-file lookup to a slow clone or postscript
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+
+_registry: List['Metric'] = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labelstr(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _num(v: float) -> str:
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Metric(object):
+    """ Base of all metrics: a name, help text and a value per combination of
+        label values, registered for rendering on creation
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """ (name suffix, label string, value) of each sample """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', _labelstr(self.labels, key), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{self.name}{suffix}{labels} {_num(value)}'
+                  for suffix, labels, value in self.samples()]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        if not labels:
+            self._values[()] = 0
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels: str):
+        """ Count the enclosed block as in progress while it runs """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """ Distribution of observed values (seconds, usually) in cumulative
+        buckets, along with their sum and count
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._counts: Dict[LabelValues, List[int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = self._values.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str):
+        """ Observe the time the enclosed block takes, even if it raises """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            items = [(key, list(counts), self._values[key]) for key, counts in self._counts.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', _labelstr(self.labels + ('le',), key + (_num(bound),)), cumulative
+            labels = _labelstr(self.labels, key)
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+def render(metrics: Optional[Sequence[Metric]] = None) -> str:
+    """ All registered metrics (or just @metrics) in Prometheus text format """
+    if metrics is None:
+        with _registry_lock:
+            metrics = list(_registry)
+    return ''.join(m.render() for m in metrics)
@@ -0,0 +1,169 @@
+# Several postscripts per repo, each only run when the deploy changes files
+# matching its path filters, and ordered by "after" dependencies between them.
+# In the config section of a repo:
+#
+#   postscript.<name> = command to run
+#   postscript.<name>.paths = globs of files it cares about (default all)
+#   postscript.<name>.after = names of postscripts to run before it
+#
+# The plain postscript setting is kept as a postscript named "postscript" that
+# always runs. Postscripts not depending on each other may run in parallel,
+# and those depending on one that failed (or was skipped) are skipped.
+
+from typing import Optional, Dict, List, Tuple, Callable, Iterable
+
+import fnmatch
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Postscript', 'LinePrefixer', 'parse_postscripts', 'select', 'run_graph']
+
+PREFIX = 'postscript.'
+
+
+class Postscript(object):
+
+    name:  str          # From the postscript.<name> setting
+    cmd:   str          # Shell command
+    paths: List[str]    # Globs of files that make it run, empty for any
+    after: List[str]    # Postscripts it has to run after, if they run
+
+    def __init__(self, name: str, cmd: str, paths: Iterable[str] = (), after: Iterable[str] = ()):
+        self.name, self.cmd, self.paths, self.after = name, cmd, list(paths), list(after)
+
+    def __repr__(self) -> str:
+        return f'Postscript({self.name!r}, {self.cmd!r})'
+
+    def matches(self, changed: Optional[List[str]]) -> bool:
+        """ Whether a deploy changing the files @changed (None if unknown)
+            should run this. Globs follow fnmatch, where * also matches /, and
+            one ending in / matches everything under that directory
+        """
+        if not self.paths or changed is None:
+            return True
+        for pattern in self.paths:
+            if pattern.endswith('/'):
+                if any(f.startswith(pattern) for f in changed):
+                    return True
+            elif any(fnmatch.fnmatchcase(f, pattern) for f in changed):
+                return True
+        return False
+
+
+class LinePrefixer(object):
+    """ Pass output to @sink a line at a time, each prefixed with [@name], so
+        the output of postscripts running in parallel can be told apart
+    """
+
+    def __init__(self, sink: Callable[[bytes], None], name: str):
+        self.sink = sink
+        self.prefix = f'[{name}] '.encode('utf8')
+        self.partial = b''
+
+    def __call__(self, chunk: bytes) -> None:
+        *lines, self.partial = (self.partial + chunk).split(b'\n')
+        if lines:
+            self.sink(b''.join(self.prefix + line + b'\n' for line in lines))
+
+    def flush(self) -> None:
+        if self.partial:
+            self.sink(self.prefix + self.partial + b'\n')
+            self.partial = b''
+
+
+def parse_postscripts(sec) -> List[Postscript]:
+    """ The postscripts of config section @sec, in an order where each comes
+        after those it depends on. Raises ValueError on unknown dependencies
+        or cycles
+    """
+
+    scripts: Dict[str, Postscript] = {}
+    if sec.get('postscript'):
+        scripts['postscript'] = Postscript('postscript', sec['postscript'])
+    for key in sec:
+        if not key.startswith(PREFIX) or key.count('.') != 1:
+            continue
+        name = key[len(PREFIX):]
+        scripts[name] = Postscript(name, sec[key], sec.get(f'{key}.paths', '').split(),
+                                   sec.get(f'{key}.after', '').replace(',', ' ').split())
+
+    ordered: List[Postscript] = []
+    state: Dict[str, str] = {}
+
+    def visit(ps: Postscript, path: Tuple[str, ...]) -> None:
+        if state.get(ps.name) == 'done':
+            return
+        if state.get(ps.name) == 'visiting':
+            raise ValueError(f'postscripts of [{sec.name}] depend on each other: '
+                             + ' -> '.join(path + (ps.name,)))
+        state[ps.name] = 'visiting'
+        for dep in ps.after:
+            if dep not in scripts:
+                raise ValueError(f'postscript {ps.name} of [{sec.name}] is after unknown postscript {dep}')
+            visit(scripts[dep], path + (ps.name,))
+        state[ps.name] = 'done'
+        ordered.append(ps)
+
+    for ps in sorted(scripts.values(), key=lambda ps: ps.name):
+        visit(ps, ())
+    return ordered
+
+
+def select(scripts: List[Postscript], changed: Optional[List[str]]) -> List[Postscript]:
+    """ Those of @scripts to run for a deploy changing @changed """
+    return [ps for ps in scripts if ps.matches(changed)]
+
+
+def run_graph(scripts: List[Postscript], run: Callable[[Postscript], Tuple[bytes, int]],
+              workers: int = 1) -> Dict[str, Tuple[bytes, Optional[int]]]:
+    """ Call @run on each of @scripts (ordered as by parse_postscripts) with
+        up to @workers at a time, each only once those it is after are done.
+        Returns the output and exit code of each by name, with an exit code
+        of None for those skipped because one they are after did not succeed
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = {ps.name for ps in scripts}
+    results: Dict[str, Tuple[bytes, Optional[int]]] = {}
+    done = threading.Condition()
+
+    def ready(ps: Postscript) -> Optional[bool]:
+        """ True if @ps can run, False if it must be skipped, None if not yet """
+        deps = [results.get(d) for d in ps.after if d in names]
+        if any(r is None for r in deps):
+            return None
+        return all(rc == 0 for _, rc in deps)
+
+    def job(ps: Postscript) -> None:
+        try:
+            res = run(ps)
+        except Exception as e:
+            log.exception("Postscript %s failed to run", ps.name)
+            res = (f'{e}\n'.encode('utf8'), -1)
+        with done:
+            results[ps.name] = res
+            done.notify_all()
+
+    pending = list(scripts)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        with done:
+            while pending:
+                progress = False
+                for ps in list(pending):
+                    go = ready(ps)
+                    if go is None:
+                        continue
+                    pending.remove(ps)
+                    progress = True
+                    if go:
+                        pool.submit(job, ps)
+                    else:
+                        log.info("Skipping postscript %s, a postscript it is after failed", ps.name)
+                        results[ps.name] = (b'', None)
+                # Being in dependency order, something is running otherwise
+                if not progress:
+                    done.wait()
+    return results
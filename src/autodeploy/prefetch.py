@@ -0,0 +1,90 @@
+# Background prefetching: the daemon fetches repos with a prefetch_interval
+# every that many seconds (give or take some jitter, so they do not all go at
+# once), so that when a push is announced its commits are usually already
+# local and the deploy does not wait on the network. The config is looked at
+# again on every round, so reloads add, change or stop prefetching of repos.
+
+from typing import Callable, Dict, Set
+
+import logging
+import random
+import threading
+import time
+
+from . import get_config
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Prefetcher']
+
+
+class Prefetcher(object):
+    """ Calls @fetch with the config section of each repo to prefetch when it
+        is due, in a background thread, at most @concurrency at once. The
+        interval of a repo is varied by up to @jitter (a fraction) each time
+    """
+
+    # Look for config changes at least this often (seconds)
+    rescan = 60.0
+
+    def __init__(self, fetch: Callable, concurrency: int = 2, jitter: float = 0.1):
+        self.fetch = fetch
+        self.concurrency = max(1, concurrency)
+        self.jitter = jitter
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _next(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _run(self) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        due: Dict[str, float] = {}
+        running: Set[str] = set()
+        lock = threading.Lock()
+
+        def job(sec) -> None:
+            try:
+                self.fetch(sec)
+            except Exception as e:
+                log.error("Prefetch of %s failed: %s", sec.name, e)
+            finally:
+                with lock:
+                    running.discard(sec.name)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='prefetch') as pool:
+            while not self._stop.is_set():
+                config = get_config()
+                now = time.monotonic()
+                intervals = {name: config[name].getfloat('prefetch_interval', 0)
+                             for name in config.sections()}
+                for name in list(due):
+                    if not intervals.get(name):
+                        del due[name]
+                for name, interval in intervals.items():
+                    if interval <= 0:
+                        continue
+                    if name not in due:
+                        # Spread out the first round
+                        due[name] = now + random.uniform(0, interval)
+                        continue
+                    if due[name] > now:
+                        continue
+                    due[name] = now + self._next(interval)
+                    with lock:
+                        if name in running:
+                            continue
+                        running.add(name)
+                    pool.submit(job, config[name])
+                wait = min(due.values(), default=now + self.rescan) - now
+                self._stop.wait(min(max(wait, 0.1), self.rescan))
+            pool.shutdown(wait=True)
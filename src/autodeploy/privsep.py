@@ -0,0 +1,253 @@
+# Run git commands as the owner of a repo without sudo. A daemon running as
+# root keeps a few worker processes per owner, started with the uid, gid and
+# supplementary groups of that user (and an environment like sudo would give
+# it), which run the commands they are sent over a pipe and send back their
+# output and exit code. That saves sudo's session setup and auth log entry on
+# every git command of a deploy while the commands run with the same
+# privileges as before. Messages either way are a 4 byte length in network
+# order followed by that much JSON.
+#
+# Not running as root, commands go through sudo as before. So do those of an
+# owner whose workers cannot be started, eg because sys.executable is in a
+# virtualenv the owner cannot read.
+
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import base64
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+__all__ = ['use_workers', 'enabled', 'prestart', 'run', 'popen_args', 'close']
+
+LENGTH = struct.Struct('!I')
+
+# The worker, self-contained so that it needs nothing it may not be allowed
+# to read (the package, the config) and isolated from the environment
+WORKER = r'''
+import base64, json, os, shlex, struct, subprocess, sys
+inp, out = sys.stdin.buffer, sys.stdout.buffer
+LENGTH = struct.Struct('!I')
+while True:
+    head = inp.read(LENGTH.size)
+    if len(head) < LENGTH.size:
+        break
+    req = json.loads(inp.read(LENGTH.unpack(head)[0]))
+    try:
+        p = subprocess.run(shlex.split(req['cmd']), cwd=req['cwd'], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, rc = p.stdout, p.returncode
+    except OSError as e:
+        output, rc = str(e).encode(), 127
+    data = json.dumps({'out': base64.b64encode(output).decode(), 'rc': rc}).encode()
+    out.write(LENGTH.pack(len(data)) + data)
+    out.flush()
+'''
+
+
+def popen_args(owner: str) -> dict:
+    """ Keyword arguments for subprocess.Popen to run a command as @owner,
+        with its groups and an environment of its own
+    """
+    import pwd
+
+    pw = pwd.getpwnam(owner)
+    groups = os.getgrouplist(owner, pw.pw_gid)
+    env = {'HOME': pw.pw_dir, 'USER': owner, 'LOGNAME': owner, 'SHELL': pw.pw_shell,
+           'PATH': os.environ.get('PATH', '/usr/bin:/bin')}
+    env.update((k, v) for k, v in os.environ.items() if k == 'LANG' or k.startswith('LC_'))
+    if sys.version_info >= (3, 9):
+        return {'user': pw.pw_uid, 'group': pw.pw_gid, 'extra_groups': groups, 'env': env}
+
+    def demote():
+        os.setgroups(groups)
+        os.setgid(pw.pw_gid)
+        os.setuid(pw.pw_uid)
+    return {'preexec_fn': demote, 'env': env}
+
+
+class Worker(object):
+    """ A worker process running commands as @owner """
+
+    def __init__(self, owner: str):
+        import subprocess
+
+        self.owner = owner
+        try:
+            self.proc = subprocess.Popen([sys.executable, '-I', '-c', WORKER], cwd='/',
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         **popen_args(owner))
+        except (OSError, KeyError) as e:
+            raise RuntimeError(f'Cannot start a worker as {owner} with {sys.executable}: {e}') from e
+        self.used = False       # Whether it answered a command yet
+        log.debug("Started worker %d for %s", self.proc.pid, owner)
+
+    def run(self, cmd: str, cwd: str) -> Tuple[bytes, int]:
+        data = json.dumps({'cmd': cmd, 'cwd': os.path.abspath(cwd)}).encode('utf8')
+        self.proc.stdin.write(LENGTH.pack(len(data)) + data)
+        self.proc.stdin.flush()
+        head = self.proc.stdout.read(LENGTH.size)
+        if len(head) < LENGTH.size:
+            raise ConnectionError(f'Worker for {self.owner} exited')
+        res = json.loads(self.proc.stdout.read(LENGTH.unpack(head)[0]))
+        return base64.b64decode(res['out']), res['rc']
+
+    def close(self) -> None:
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class WorkerPool(object):
+    """ Up to @size workers for @owner, started as needed """
+
+    # How often callers waiting for an idle worker look again (seconds)
+    poll = 1.0
+
+    def __init__(self, owner: str, size: int):
+        self.owner = owner
+        self.size = size
+        self.started = 0
+        # Idle workers, and None for each worker dropped, to wake a caller
+        # waiting for one so that it starts another
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def prestart(self) -> None:
+        """ Start a worker ahead of the first command, unless one is """
+        with self._lock:
+            if self.started:
+                return
+            self.started += 1
+        self._idle.put(self._start())
+
+    def _start(self) -> Worker:
+        try:
+            return Worker(self.owner)
+        except Exception:
+            with self._lock:
+                self.started -= 1
+            raise
+
+    def _acquire(self) -> Worker:
+        """ An idle worker, a new one if there are less than @size, or else
+            the first to become idle
+        """
+        while True:
+            with self._lock:
+                start = self._idle.empty() and self.started < self.size
+                if start:
+                    self.started += 1
+            if start:
+                return self._start()
+            try:
+                worker = self._idle.get(timeout=self.poll)
+            except queue.Empty:
+                continue
+            if worker is not None:
+                return worker
+
+    def run(self, cmd: str, cwd: str) -> Tuple[bytes, int]:
+        worker = self._acquire()
+        try:
+            res = worker.run(cmd, cwd)
+        except (ConnectionError, OSError, ValueError) as e:
+            worker.proc.kill()
+            worker.close()
+            with self._lock:
+                self.started -= 1
+            self._idle.put(None)
+            if not worker.used:
+                raise RuntimeError(f'Worker as {self.owner} with {sys.executable} '
+                                   f'exited before its first answer: {e}') from e
+            log.error("Worker for %s failed, restarting it: %s", self.owner, e)
+            return f'Worker for {self.owner} failed: {e}\n'.encode('utf8'), 255
+        worker.used = True
+        self._idle.put(worker)
+        return res
+
+    def close(self) -> None:
+        while not self._idle.empty():
+            worker = self._idle.get()
+            if worker is not None:
+                worker.close()
+
+
+_pools: Dict[str, WorkerPool] = {}
+_pools_lock = threading.Lock()
+_size = 0
+_sudo: Set[str] = set()     # Owners whose workers cannot be started
+
+
+def use_workers(size: int) -> None:
+    """ Run commands as other users in up to @size workers per user, if
+        running as root. 0 to use sudo
+    """
+    global _size
+    _size = size if os.geteuid() == 0 else 0
+
+
+def enabled(owner: Optional[str] = None) -> bool:
+    """ Whether commands (as @owner) are run by workers, not through sudo """
+    return _size > 0 and owner not in _sudo
+
+
+def _use_sudo(owner: str, error: Exception) -> None:
+    log.error("%s; running commands as %s through sudo instead (owner_workers = 0 "
+              "always does)", error, owner)
+    with _pools_lock:
+        _sudo.add(owner)
+
+
+def _pool(owner: str) -> WorkerPool:
+    with _pools_lock:
+        pool = _pools.get(owner)
+        if pool is None:
+            pool = _pools[owner] = WorkerPool(owner, _size)
+    return pool
+
+
+def prestart(owners: Iterable[str]) -> None:
+    """ Start a worker for each of @owners now rather than on their first
+        command, if workers are used
+    """
+    if not enabled():
+        return
+    for owner in owners:
+        try:
+            _pool(owner).prestart()
+        except RuntimeError as e:
+            _use_sudo(owner, e)
+
+
+def run(owner: str, cmd: str, cwd: str = '.') -> Tuple[bytes, int]:
+    """ Run @cmd (interpreted via shlex) in @cwd as @owner, returning its
+        output and exit code like util.get_output. Runs it through sudo if
+        workers as @owner cannot be started
+    """
+    log.debug("Running %s (in %s) as %s", cmd, cwd, owner)
+    if enabled(owner):
+        try:
+            return _pool(owner).run(cmd, cwd)
+        except RuntimeError as e:
+            _use_sudo(owner, e)
+    from .util import get_output
+    return get_output(f'sudo -u {owner} {cmd}', cwd)
+
+
+def close() -> None:
+    """ Stop all workers """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,84 @@
+# Release directories: instead of updating a checkout in place, each deployed
+# state is checked out into a new directory (a git worktree of the repo, so
+# sharing its objects), and a symlink pointing at the live release is swapped
+# over to it in one atomic rename once it is ready. Readers of the symlink
+# never see a half-updated tree, and going back to an earlier release that is
+# still around is just another swap.
+
+from typing import List, Optional
+
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Releases']
+
+
+class Releases(object):
+    """ The releases of a repo, in directories under @root named after their
+        creation time and state so they sort in order, and the symlink @link
+        to the live one
+    """
+
+    def __init__(self, root: str, link: str):
+        self.root = root
+        self.link = link
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def new_name(self, state: str) -> str:
+        """ Name for a new release of @state """
+        now = time.time()
+        return time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + f'.{int(now % 1 * 1e6):06d}-{state[:12]}'
+
+    def list(self) -> List[str]:
+        """ Names of all releases, oldest first """
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if not n.startswith('.') and os.path.isdir(self.path(n))
+                      and not os.path.islink(self.path(n)))
+
+    def current(self) -> Optional[str]:
+        """ Name of the live release, if any """
+        try:
+            target = os.readlink(self.link)
+        except OSError:
+            return None
+        target = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(self.link)), target))
+        if os.path.dirname(target) != os.path.abspath(self.root):
+            return None
+        return os.path.basename(target)
+
+    def previous(self) -> Optional[str]:
+        """ The release before the live one """
+        names, current = self.list(), self.current()
+        if current not in names:
+            return None
+        i = names.index(current)
+        return names[i - 1] if i > 0 else None
+
+    def activate(self, name: str) -> None:
+        """ Atomically point the link at release @name """
+        if name not in self.list():
+            raise LookupError(f'No release {name} in {self.root}')
+        target = os.path.relpath(self.path(name), os.path.dirname(os.path.abspath(self.link)))
+        tmp = f'{self.link}.{os.getpid()}.tmp'
+        os.symlink(target, tmp)
+        try:
+            os.replace(tmp, self.link)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        log.info("Release %s is now live at %s", name, self.link)
+
+    def stale(self, keep: int) -> List[str]:
+        """ Releases to prune to keep only the @keep most recent ones, never
+            including the live release
+        """
+        names, current = self.list(), self.current()
+        return [n for n in names[:max(0, len(names) - keep)] if n != current]
@@ -1,12 +1,17 @@
 # Represent a Git repository checked out on disk with methods to clone/fetch/read
 # info about it.
 
-from typing import Optional
+from typing import Optional, Tuple, List, Dict
 
 import os
+import time
+import shlex
 import logging
+import threading
+import subprocess
 
 from .util import get_output
+from . import privsep
 
 log = logging.getLogger(__name__)
 
@@ -15,47 +20,243 @@ class GitExcept(Exception):
     pass
 
 
+class GitStats(object):
+    """ Count how git commands were run: as their own process or answered by
+        the persistent batch helper
+    """
+
+    def __init__(self):
+        self.spawned = 0        # Processes launched
+        self.spawn_time = 0.0   # Seconds spent in them
+        self.batched = 0        # Queries answered by the batch helper
+        self.batch_time = 0.0   # Seconds spent in those
+
+    def __str__(self) -> str:
+        s = f'{self.spawned} git processes in {self.spawn_time:.3f}s'
+        if self.batched:
+            # Estimate what the batched queries would have cost as processes
+            per_spawn = self.spawn_time / self.spawned if self.spawned else 0.0
+            saved = self.batched * per_spawn - self.batch_time
+            s += (f', {self.batched} batched queries in {self.batch_time:.3f}s'
+                  f' (~{saved:.3f}s saved)')
+        return s
+
+
+class CatFile(object):
+    """ A long-lived `git cat-file --batch-check` process answering object
+        and ref lookups over a pipe, one line per query
+    """
+
+    def __init__(self, cmd: str, cwd: str, owner: Optional[str] = None):
+        self.args = shlex.split(cmd)
+        self.cwd = cwd
+        self.owner = owner      # User to run as, without sudo
+        self.proc: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+
+    def _start(self) -> subprocess.Popen:
+        log.debug("Starting %s (in %s)", self.args, self.cwd)
+        extra = privsep.popen_args(self.owner) if self.owner else {}
+        return subprocess.Popen(self.args, cwd=self.cwd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, **extra)
+
+    def query(self, obj: str) -> Optional[Tuple[str, str]]:
+        """ Return (hash, type) of the object named by @obj, None if missing """
+
+        with self.lock:
+            for attempt in (1, 2):
+                if not self.proc or self.proc.poll() is not None:
+                    self.proc = self._start()
+                try:
+                    self.proc.stdin.write(obj.encode('utf8') + b'\n')
+                    self.proc.stdin.flush()
+                    line = self.proc.stdout.readline().decode('ascii')
+                except (BrokenPipeError, OSError):
+                    line = ''
+                if line:
+                    break
+                # The helper died, restart it once
+                self.close()
+            else:
+                raise GitExcept(f'git cat-file failed on {obj}')
+        fields = line.split()
+        if len(fields) < 2 or fields[1] in ('missing', 'ambiguous'):
+            return None
+        return fields[0], fields[1]
+
+    def close(self) -> None:
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
 class GitRepo(object):
     """ Represent a git repository as checked out on a server with an optional
         upstream url and possible bare
     """
 
     def __init__(self, dir: str, remote: Optional[str] = None, bare: bool = False,
-                       runas: Optional[str] = None):
-        """ Clone the repo in constructor if not exists and @remote is given """
+                       runas: Optional[str] = None, persistent: bool = False,
+                       depth: Optional[int] = None, filter: Optional[str] = None,
+                       checkout: bool = True, mirror: Optional[str] = None):
+        """ Clone the repo in constructor if not exists and @remote is given.
+            With @persistent, read-only lookups go through a long-lived
+            cat-file helper instead of a new git process each. A clone can be
+            made shallow with @depth or partial with @filter (eg blob:none),
+            and fetches keep to the same @depth. Without @checkout the clone
+            has no files checked out, eg when only worktrees of it are used.
+            With a local @mirror of @remote, the clone borrows its objects
+            and fetches from it instead, so @depth and @filter do not apply.
+        """
 
+        if mirror:
+            depth = filter = None
         self.dir = dir
         self.runas = runas
+        self.bare = bare
+        self.depth = depth
+        self.partial = filter is not None
+        self.mirror = mirror
+        self.stats = GitStats()
+        self._catfile = None
+        if persistent and self.runas and privsep.enabled(self.runas):
+            self._catfile = CatFile('git cat-file --batch-check', dir, owner=self.runas)
+        elif persistent:
+            self._catfile = CatFile(self._sudo('git cat-file --batch-check'), dir)
         if remote and not self.exists():
-            log.info("Cloning %s into %s", remote, dir)
+            log.info("Cloning %s into %s", mirror or remote, dir)
             parent = os.path.abspath(os.path.join(self.dir, os.pardir))
-            ifbare = '--bare ' if bare else ''
-            output, rc = self._runcmd('git clone {2}{0} {1}'.format(remote, dir, ifbare),
+            opts = '--bare ' if bare else ''
+            if depth:
+                opts += f'--depth {depth} --no-single-branch '
+            if filter:
+                opts += f'--filter={filter} '
+            if not checkout and not bare:
+                opts += '--no-checkout '
+            if mirror:
+                opts += '--shared '
+            output, rc = self._runcmd('git clone {2}{0} {1}'.format(mirror or remote, dir, opts),
                                       cwd=parent)
             if rc != 0:
-                log.error("Error cloning %s into %s\n%s", remote, parent, output)
+                log.error("Error cloning %s into %s\n%s", mirror or remote, parent, output)
                 raise GitExcept("Clone error")
+            if mirror:
+                self._runcmd(f'git remote set-url origin {remote}')
         elif bare and self.exists():
             if self.rev_parse('--is-bare-repository') != 'true':
                 raise GitExcept('Bare repo at {0} is not actually bare')
 
+    def _sudo(self, cmd: str) -> str:
+        return f'sudo -u {self.runas} {cmd}' if self.runas else cmd
+
     def _runcmd(self, cmd: str, cwd = None):
-        if self.runas:
-            cmd = f'sudo -u {self.runas} {cmd}'
         wd = cwd if cwd else self.dir
-        return get_output(cmd, cwd=wd)
+        start = time.monotonic()
+        if self.runas and privsep.enabled(self.runas):
+            out = privsep.run(self.runas, cmd, cwd=wd)
+        else:
+            out = get_output(self._sudo(cmd), cwd=wd)
+        self.stats.spawned += 1
+        self.stats.spawn_time += time.monotonic() - start
+        return out
+
+    def _batch(self, obj: str) -> Optional[Tuple[str, str]]:
+        start = time.monotonic()
+        ans = self._catfile.query(obj)
+        self.stats.batched += 1
+        self.stats.batch_time += time.monotonic() - start
+        return ans
 
     def rev_parse(self, ref: str) -> Optional[str]:
+        if self._catfile and not ref.startswith('-'):
+            ans = self._batch(ref)
+            return ans[0] if ans else None
         hash, rc = self._runcmd('git rev-parse {0}'.format(ref))
         return hash.decode('ascii').strip('\n') if rc == 0 else None
 
-    def fetch(self) -> None:
-        out, rc = self._runcmd('git fetch')
+    def has_commit(self, hash: str) -> bool:
+        """ Whether the commit @hash is present in the local repo. Never
+            lazily fetches it from the promisor remote of a partial clone
+        """
+        if self._catfile and not self.partial:
+            return self._batch(hash) is not None
+        _, rc = self._runcmd(f'git rev-list --missing=allow-any -n1 --no-walk {hash}')
+        return rc == 0
+
+    def close(self) -> None:
+        """ Stop the persistent helper, if any """
+        if self._catfile:
+            self._catfile.close()
+
+    def fetch(self, ref: Optional[str] = None, state: Optional[str] = None) -> None:
+        """ Fetch from origin (or the mirror), everything or just @ref (a full
+            refname) if given. A targeted fetch is skipped entirely when @state
+            is already present locally (a bare repo then has @ref set to it)
+        """
+        cmd = f'git fetch --depth {self.depth}' if self.depth else 'git fetch'
+        remote = self.mirror or 'origin'
+        if (self.mirror or self.bare) and not ref:
+            # Only origin has the refspecs to fetch everything configured, and
+            # not even it in a bare clone
+            if self.bare:
+                cmd += f' {remote} +refs/heads/*:refs/heads/* +refs/tags/*:refs/tags/*'
+            else:
+                cmd += f' {remote} +refs/heads/*:refs/remotes/origin/* +refs/tags/*:refs/tags/*'
+        if ref:
+            if self.bare:
+                if state and self.rev_parse(ref) == state:
+                    log.debug("Skip fetch of %s in %s, already at %s", ref, self.dir, state)
+                    return
+                if state and self.has_commit(state):
+                    # Eg prefetched: just point the branch at it
+                    out, rc = self._runcmd(f'git update-ref {ref} {state}')
+                    if rc == 0:
+                        log.debug("Skip fetch of %s in %s, have %s", ref, self.dir, state)
+                        return
+                dest = ref
+            else:
+                if state and self.has_commit(state):
+                    log.debug("Skip fetch of %s in %s, have %s", ref, self.dir, state)
+                    return
+                dest = 'refs/remotes/origin/' + ref.replace('refs/heads/', '', 1)
+            cmd += f' {remote} +{ref}:{dest}'
+        out, rc = self._runcmd(cmd)
         log.debug("git fetching in %s", self.dir)
         if rc != 0:
             log.error("Error running git-fetch: %s", out)
             raise GitExcept("Error running git-fetch")
 
+    def prefetch(self) -> None:
+        """ Fetch the branches of origin (or the mirror) under refs/prefetch/,
+            like git maintenance does, so their commits are here for the next
+            fetch without moving any ref a deploy looks at
+        """
+        cmd = f'git fetch --quiet --no-tags --depth {self.depth}' if self.depth \
+            else 'git fetch --quiet --no-tags'
+        out, rc = self._runcmd(f'{cmd} {self.mirror or "origin"} +refs/heads/*:refs/prefetch/heads/*')
+        log.debug("git prefetching in %s", self.dir)
+        if rc != 0:
+            log.error("Error prefetching in %s: %s", self.dir, out)
+            raise GitExcept("Error running git-fetch")
+
+    def remote_heads(self, remote: str, refs: Optional[List[str]] = None) -> Dict[str, str]:
+        """ The hash of each branch of @remote by refname, of only @refs (full
+            refnames) if given, asking it without fetching anything
+        """
+        names = ' '.join(shlex.quote(ref) for ref in refs or [])
+        out, rc = self._runcmd(f'git ls-remote --heads {remote} {names}')
+        if rc != 0:
+            log.error("Error listing the branches of %s: %s", remote, out)
+            raise GitExcept("Error running git-ls-remote")
+        heads = {}
+        for line in out.decode('utf8', 'replace').splitlines():
+            hash, _, ref = line.partition('\t')
+            # Patterns match the end of refnames, and git may warn
+            if ref.startswith('refs/heads/') and (not refs or ref in refs):
+                heads[ref] = hash
+        return heads
+
     def exists(self) -> bool:
         return os.path.exists(self.dir)
 
@@ -70,11 +271,115 @@ class GitRepo(object):
             log.error("Error resetting to %s:\n%s", hash, out)
             raise GitExcept("Error git hard-reset")
 
+    def update(self, hash: str) -> bool:
+        """ Move the checkout and current branch to @hash, only touching the
+            files that differ from HEAD (a two-tree merge) instead of checking
+            every file in the tree like reset does. Falls back to reset, and
+            returns False, if local changes or untracked files are in the way.
+            Local changes to files that do not differ are left alone
+        """
+        out, r = self._runcmd(f'git read-tree -m -u HEAD {hash}')
+        if r != 0:
+            log.warning("Local changes in %s in the way of updating to %s, resetting:\n%s",
+                        self.dir, hash, out.decode('utf8', 'replace'))
+            self.reset(hash)
+            return False
+        out, r = self._runcmd(f'git reset -q --soft {hash}')
+        log.debug("git updated to %s", hash)
+        if r != 0:
+            log.error("Error moving HEAD to %s:\n%s", hash, out)
+            raise GitExcept("Error git soft-reset")
+        return True
+
+    def add_worktree(self, path: str, hash: str) -> None:
+        """ Check out @hash into a new (detached) worktree at @path """
+        out, r = self._runcmd(f'git worktree add -q --detach {shlex.quote(path)} {hash}')
+        log.debug("git worktree of %s at %s", hash, path)
+        if r != 0:
+            log.error("Error adding worktree %s:\n%s", path, out)
+            raise GitExcept("Error git worktree add")
+
+    def remove_worktree(self, path: str) -> None:
+        """ Delete the worktree at @path, even with local changes """
+        out, r = self._runcmd(f'git worktree remove --force {shlex.quote(path)}')
+        if r != 0:
+            log.warning("Error removing worktree %s, pruning:\n%s", path, out)
+            self._runcmd('git worktree prune')
+
     def diff(self, first: str, second: str, stat: bool = True) -> str:
-        cmd = 'git diff' + ' --stat ' if stat else ' '
+        cmd = 'git diff --stat' if stat else 'git diff'
         out, r = self._runcmd(f'{cmd} {first} {second}')
         log.debug('%s %s %s', cmd, first, second)
         if r != 0:
             log.error("Error running git diff %s %s!", first, second)
             raise GitExcept('Error git-diff!')
         return out.decode('ascii').strip('\n')
+
+    def changed_files(self, first: str, second: str) -> Optional[List[str]]:
+        """ Paths of the files that differ between two commits (both the old
+            and new path of renames), or None if @first is not present
+        """
+        if not self.has_commit(first):
+            return None
+        out, r = self._runcmd(f'git diff --name-only --no-renames -z {first} {second}')
+        if r != 0:
+            log.error("Error listing files changed from %s to %s", first, second)
+            raise GitExcept('Error git-diff!')
+        return [f for f in out.decode('utf8', 'surrogateescape').split('\0') if f]
+
+
+class Mirror(GitRepo):
+    """ A mirror clone of @remote at @dir, which the repos deploying from the
+        same upstream borrow objects from and fetch from, so that a push is
+        only fetched over the network once
+    """
+
+    def __init__(self, dir: str, remote: str):
+        super().__init__(dir, bare=True)
+        self.remote = remote
+        self.lock = threading.Lock()
+
+    def refresh(self, state: Optional[str] = None) -> bool:
+        """ Clone the mirror if it does not exist yet, and fetch everything
+            unless @state is already in it. Returns whether it fetched
+        """
+        with self.lock:
+            if not self.exists():
+                log.info("Mirroring %s into %s", self.remote, self.dir)
+                parent = os.path.abspath(os.path.join(self.dir, os.pardir))
+                os.makedirs(parent, exist_ok=True)
+                out, rc = self._runcmd(f'git clone --mirror {self.remote} {self.dir}', cwd=parent)
+                if rc != 0:
+                    log.error("Error mirroring %s into %s\n%s", self.remote, self.dir, out)
+                    raise GitExcept("Mirror clone error")
+                # Repos borrowing from it may still use objects no ref here
+                # points to anymore, eg after a force push: never prune them
+                self._runcmd('git config gc.pruneExpire never')
+                return True
+            if state and self.has_commit(state):
+                log.debug("Mirror %s already has %s", self.dir, state)
+                return False
+            out, rc = self._runcmd('git fetch --prune origin')
+            if rc != 0:
+                log.error("Error fetching mirror %s: %s", self.dir, out)
+                raise GitExcept("Error running git-fetch")
+            return True
+
+
+class LazyDiff(object):
+    """ The diff(stat) between two commits of a repo, only computed when
+        first converted to str and remembered after
+    """
+
+    def __init__(self, git: GitRepo, first: str, second: str):
+        self.git, self.first, self.second = git, first, second
+        self._text: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self._text is None:
+            # A shallow clone may not have the old state to diff against
+            if self.git.has_commit(self.first):
+                self._text = self.git.diff(self.first, self.second, stat=True)
+            else:
+                self._text = f'(No diff, {self.first} not present locally)'
+        return self._text
@@ -1,24 +1,30 @@
-from typing import Tuple, List
-import subprocess
+# Heavier modules (subprocess, smtplib, email...) are imported by the functions
+# using them, so the CGI script does not pay for what only the daemons need
+
+from typing import Tuple, List, Union, Optional, Callable, TYPE_CHECKING
+import socket
 import signal
+import time
+import os
 import threading
-import shlex
 import enum
 import hmac
 
-import smtplib
-
-from email.message import EmailMessage
-
-from autodeploy import mail_host
+from autodeploy import get_config
 
 import logging
 
+if TYPE_CHECKING:
+    import subprocess
+    from email.message import EmailMessage
+
 log = logging.getLogger(__name__)
 
 
 def get_output(cmd: str, cwd: str = '.') -> Tuple[bytes, int]:
     """ Run a command (interpreted via shlex) and return output, exit-code """
+    import shlex
+    import subprocess
 
     args = shlex.split(cmd)
     log.debug("Running %s (in %s)", args, cwd)
@@ -27,6 +33,130 @@ def get_output(cmd: str, cwd: str = '.') -> Tuple[bytes, int]:
     return p.stdout, p.returncode
 
 
+def stream_output(cmd: str, cwd: str = '.', timeout: Optional[float] = None,
+                  cap: Optional[int] = None, sink: Optional[Callable[[bytes], None]] = None,
+                  spill: Optional[str] = None) -> Tuple[bytes, int]:
+    """ Like get_output, but pass output to @sink as it is produced and kill
+        the command (and its children) if it runs longer than @timeout seconds.
+        At most @cap bytes of output are kept and returned, with a summary of
+        what was cut; the full output then goes to the file @spill if given.
+    """
+    import selectors
+    import shlex
+    import subprocess
+
+    args = shlex.split(cmd)
+    log.debug("Running %s (in %s)", args, cwd)
+    p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.monotonic() + timeout if timeout else None
+    kept, size, spilled, timed_out = [], 0, None, False
+    fd = p.stdout.fileno()
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                wait = deadline - time.monotonic() if deadline else None
+                if wait is not None and wait <= 0:
+                    timed_out = True
+                    break
+                if not sel.select(wait):
+                    continue
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                if sink:
+                    sink(chunk)
+                if cap is None or size + len(chunk) <= cap:
+                    kept.append(chunk)
+                else:
+                    if spill and spilled is None:
+                        try:
+                            spilled = open(spill, 'wb')
+                        except OSError as e:
+                            log.warning("Cannot keep the full output of %s in %s: %s", args, spill, e)
+                            spill = None
+                        else:
+                            spilled.writelines(kept)
+                    if size < cap:
+                        kept.append(chunk[:cap - size])
+                    if spilled:
+                        spilled.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        # Never leave it running with nobody reading its output or waiting
+        log.warning("Killing command %s after an error", args)
+        _killpg(p, grace=1)
+        p.wait()
+        raise
+    finally:
+        if spilled:
+            spilled.close()
+        p.stdout.close()
+    if not timed_out:
+        try:
+            p.wait(deadline - time.monotonic() if deadline else None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+    if timed_out:
+        log.warning("Command %s timed out after %ss, killing it", args, timeout)
+        _killpg(p)
+    rc = p.wait()
+
+    out = b''.join(kept)
+    if cap is not None and size > cap:
+        out += (f'\n[... output truncated, {size - cap} of {size} bytes not shown'
+                + (f', full output in {spill}' if spilled else '') + ']\n').encode('utf8')
+    if timed_out:
+        out += f'\n[... killed after timeout of {timeout}s]\n'.encode('utf8')
+    return out, rc
+
+
+def _killpg(p: 'subprocess.Popen', grace: float = 5) -> None:
+    """ Terminate the process group of @p, forcefully after @grace seconds """
+    import subprocess
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(p.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            p.wait(grace)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def parse_address(addr: str) -> Tuple[int, Union[str, Tuple[str, int]]]:
+    """ Turn a daemon address, either unix:/path/to/socket (or just a path)
+        or tcp:host:port (or just host:port), into a socket family & address
+    """
+
+    kind, _, rest = addr.strip().partition(':')
+    if kind == 'unix':
+        return socket.AF_UNIX, rest
+    if kind == 'tcp':
+        addr = rest
+    elif addr.startswith('/'):
+        return socket.AF_UNIX, addr
+    host, _, port = addr.rpartition(':')
+    return socket.AF_INET, (host.strip('[]'), int(port))
+
+
+def parse_targets(value: str) -> List[Tuple[str, str]]:
+    """ The (branch, path) pairs of a targets setting, a comma-separated list
+        of branch:path. Raises ValueError if one is not
+    """
+    targets = []
+    for item in value.split(','):
+        branch, sep, path = item.strip().partition(':')
+        if not sep or not branch or not path:
+            raise ValueError(f'Invalid target {item.strip()!r}, should be branch:path')
+        targets.append((branch, path))
+    return targets
+
+
 def check_hmac(data: bytes, secret: str, signature: str) -> bool:
     """ Verify the signature of @data against the @key """
 
@@ -34,40 +164,266 @@ def check_hmac(data: bytes, secret: str, signature: str) -> bool:
     return hmac.compare_digest(h.hexdigest(), signature)
 
 
-def send_email(to: str, sub: str, message: str, sender: str = 'Deploy Daemon <root@localhost>'):
-    """ Send an email message to configured SMTP server """
+def make_email(to: str, sub: str, message: str, sender: str = 'Deploy Daemon <root@localhost>') -> 'EmailMessage':
+    from email.message import EmailMessage
 
     msg = EmailMessage()
     msg.set_content(message)
     msg['Subject'] = sub
     msg['From'] = sender
     msg['To'] = to
+    return msg
+
+
+def send_email(to: str, sub: str, message: str, sender: str = 'Deploy Daemon <root@localhost>'):
+    """ Send an email message to configured SMTP server """
+    import smtplib
 
-    s = smtplib.SMTP(mail_host)
+    msg = make_email(to, sub, message, sender)
+    s = smtplib.SMTP(get_config()['DEFAULT'].get('smtphost'))
     s.send_message(msg)
     s.quit()
 
 
+class ThreadPoolMixIn(object):
+    """ Mix-in for a socketserver server class that handles each request in
+        a bounded pool of worker threads instead of the serving thread. A
+        handler can park() its connection to have it handled again when more
+        input comes, without holding a worker in the meantime, or detach() it
+        to answer it from another thread later
+    """
+
+    max_workers: int = 1
+
+    # Requests beyond this many waiting for or being handled by a worker are
+    # answered with busy_answer and closed right away, 0 for no limit
+    max_pending: int = 0
+    busy_answer: bytes = b''
+
+    # Parked connections with no input for this long are closed (seconds)
+    idle_timeout: float = 60
+
+    def _setup_pool(self) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        import queue
+
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._active = set()
+        self._active_lock = threading.Lock()
+        self._pending = 0
+        self._parking = set()       # Requests whose handler called park()
+        self._detached = set()      # Requests whose handler called detach()
+        self._to_park: queue.Queue = queue.Queue()
+        self._watcher: Optional[threading.Thread] = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._closing = False
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_pool'):
+            self._setup_pool()
+        with self._active_lock:
+            busy = self.max_pending and self._pending >= self.max_pending
+            if not busy:
+                self._pending += 1
+        if busy:
+            log.warning("Busy, turning away request from %s", client_address or 'local client')
+            self.reject_request(request, client_address)
+            return
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def reject_request(self, request, client_address):
+        """ Answer @request with busy_answer and close it """
+        try:
+            request.sendall(self.busy_answer)
+            # Closing with unread input would reset the connection, possibly
+            # before the client reads the answer: take what already came
+            while request.recv(65536, socket.MSG_DONTWAIT):
+                pass
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        with self._active_lock:
+            self._active.add(request)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            with self._active_lock:
+                self._parking.discard(request)
+        finally:
+            with self._active_lock:
+                self._active.discard(request)
+                if request in self._detached:
+                    # Whoever answers it hands it back with resume()
+                    return
+                self._pending -= 1
+                parked = request in self._parking and not self._closing
+                self._parking.discard(request)
+                if parked:
+                    self._start_watcher()
+            self._release(request, client_address, parked)
+
+    def park(self, request) -> None:
+        """ Keep @request open once its handler returns, and handle it again
+            when there is more to read from it
+        """
+        with self._active_lock:
+            self._parking.add(request)
+
+    def detach(self, request) -> None:
+        """ Leave @request open once its handler returns, still counted as
+            pending, until resume() is called for it
+        """
+        with self._active_lock:
+            self._detached.add(request)
+
+    def resume(self, request, client_address, park: bool) -> None:
+        """ Take back @request detached by its handler, parking it if @park
+            or else closing it. Can be called from any thread, even before the
+            handler returned
+        """
+        with self._active_lock:
+            self._detached.discard(request)
+            if request in self._active:
+                # Its handler finishes it as usual when it returns
+                if park:
+                    self._parking.add(request)
+                return
+            self._pending -= 1
+            park = park and not self._closing
+            if park:
+                self._start_watcher()
+        self._release(request, client_address, park)
+
+    def _start_watcher(self) -> None:
+        """ Start the thread watching parked connections, with _active_lock
+            held, unless it is running
+        """
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_parked, daemon=True,
+                                             name='parked-connections')
+            self._watcher.start()
+
+    def _release(self, request, client_address, park: bool) -> None:
+        if park:
+            self._to_park.put((request, client_address))
+            self._wake_w.send(b'\0')
+        else:
+            self.shutdown_request(request)
+
+    def _watch_parked(self) -> None:
+        """ Watch the parked connections, handing those with input back to
+            the pool and closing those idle for too long or closed
+        """
+        import selectors
+
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        deadlines: dict = {}
+        while not self._closing:
+            now = time.monotonic()
+            timeout = min(deadlines.values(), default=now + self.idle_timeout) - now
+            for key, _ in selector.select(max(timeout, 0)):
+                if key.fileobj is self._wake_r:
+                    self._wake_r.recv(4096)
+                    continue
+                request = key.fileobj
+                selector.unregister(request)
+                del deadlines[request]
+                try:
+                    closed = not request.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    closed = False
+                except OSError:
+                    closed = True
+                if closed:
+                    self.shutdown_request(request)
+                else:
+                    self.process_request(request, key.data)
+            while not self._to_park.empty():
+                request, client_address = self._to_park.get()
+                selector.register(request, selectors.EVENT_READ, client_address)
+                deadlines[request] = time.monotonic() + self.idle_timeout
+            now = time.monotonic()
+            for request in [r for r, deadline in deadlines.items() if deadline <= now]:
+                log.debug("Closing idle connection")
+                selector.unregister(request)
+                del deadlines[request]
+                self.shutdown_request(request)
+        for request in deadlines:
+            self.shutdown_request(request)
+        selector.close()
+
+    def server_close(self):
+        super().server_close()
+        if hasattr(self, '_pool'):
+            # Wake up handlers waiting for more input, letting those in the
+            # middle of a request finish it, and close the parked connections
+            with self._active_lock:
+                self._closing = True
+                for request in self._active:
+                    try:
+                        request.shutdown(socket.SHUT_RD)
+                    except OSError:
+                        pass
+                watcher = self._watcher
+            self._wake_w.send(b'\0')
+            if watcher:
+                watcher.join()
+            self._pool.shutdown(wait=True)
+            while not self._to_park.empty():
+                self.shutdown_request(self._to_park.get()[0])
+            self._wake_r.close()
+            self._wake_w.close()
+
+
 class StopServer(Exception):
     pass
 
 
-def run_serverclass_thread(srv, stopsigs: List[enum.IntEnum] = [signal.SIGTERM, signal.SIGINT]):
-    """ Run a server in another thread while pause() in current thread to
-        handle signals to request a clean shutdown
+class ReloadServer(Exception):
+    pass
+
+
+def run_serverclass_thread(srv, stopsigs: List[enum.IntEnum] = [signal.SIGTERM, signal.SIGINT],
+                           reload: Optional[Callable[[], object]] = None):
+    """ Run a server (or a list of them) each in another thread while pause()
+        in current thread to handle signals to request a clean shutdown, or
+        to call @reload on SIGHUP
     """
+    srvs = srv if isinstance(srv, list) else [srv]
+
     def sighandle(signal, frame):
         raise StopServer()
 
+    def huphandle(signal, frame):
+        raise ReloadServer()
+
     for sig in stopsigs:
         signal.signal(sig, sighandle)
+    if reload:
+        signal.signal(signal.SIGHUP, huphandle)
 
-    srv_thread = threading.Thread(target=srv.serve_forever)
-    srv_thread.start()
+    threads = [threading.Thread(target=s.serve_forever) for s in srvs]
+    for t in threads:
+        t.start()
     while True:
         try:
             signal.pause()
+        except ReloadServer:
+            try:
+                reload()
+            except StopServer:
+                # Stop requested while reloading
+                break
+            except Exception as e:
+                log.error("Reload failed, keeping the current config: %s", e)
         except StopServer:
-            srv.shutdown()
             break
-    srv_thread.join()
+    for s in srvs:
+        s.shutdown()
+    for t, s in zip(threads, srvs):
+        t.join()
+        s.server_close()
@@ -1,46 +1,173 @@
 # Analyze a Gitea repository's webhook data (json) and check the signature and
 # if the repo and branch combo is valid
-from typing import Optional
+#
+# The signature is checked before the body is parsed, so unauthenticated
+# senders cannot make us parse anything: the HMAC is computed as the body is
+# read, with the secret of the repo named by the webhook URL, or for URLs not
+# naming one with each distinct secret of the config (optionally only up to
+# webhook_max_secrets of them). Webhooks naming an unknown repo with ?repo=
+# are refused before their body is read. Only a body signed with one of the
+# secrets is parsed, and it must then be for a repo with that secret.
+from typing import Optional, Dict, List, Tuple, Callable, TYPE_CHECKING
 
+import hmac
 import json
 import logging
 
-from . import config
-from .util import check_hmac
+from . import get_config
+from .util import parse_targets
+
+if TYPE_CHECKING:
+    from configparser import ConfigParser
 
 log = logging.getLogger(__name__)
 
-__all__ = ['process_webhook_output']
+__all__ = ['WebhookIngest', 'process_webhook_output', 'secret_index', 'url_repo', 'refusal']
+
+CHUNK = 65536
+
+# The index of the last config it was asked for
+_index: Tuple[object, Dict[str, List[str]]] = (None, {})
+
+
+def secret_index(config: 'ConfigParser') -> Dict[str, List[str]]:
+    """ The repos (sections) of @config by their secret """
+    global _index
+
+    cached, index = _index
+    if cached is not config:
+        index = {}
+        for name in config.sections():
+            index.setdefault(config[name]['secret'], []).append(name)
+        _index = (config, index)
+    return index
+
+
+def url_repo(url: str, config: 'ConfigParser') -> Optional[str]:
+    """ The repo named by the path and query of a webhook URL, if any: a repo
+        parameter (/?repo=org/repo), or a path ending in the name of a repo
+        of @config (/org/repo, or /prefix/org/repo behind a proxy). Other
+        paths name no repo
+    """
+    from urllib.parse import unquote
+
+    path, _, query = url.partition('?')
+    for param in query.split('&'):
+        key, _, value = param.partition('=')
+        if key == 'repo' and value:
+            return unquote(value)
+    parts = [p for p in unquote(path).split('/') if p]
+    for i in range(len(parts)):
+        name = '/'.join(parts[i:])
+        if config.has_section(name):
+            return name
+    return None
+
+
+def refusal(config: 'ConfigParser', repo: Optional[str]) -> Optional[str]:
+    """ Why a webhook for @repo (as named by its URL, None if not) is refused
+        before reading its body, or None if it is not: the repo is unknown, or
+        checking the signature would take more secrets than allowed
+    """
+    if repo:
+        return None if config.has_section(repo) else f'Unknown repo {repo}'
+    limit = config['DEFAULT'].getint('webhook_max_secrets', 0)
+    if limit and len(secret_index(config)) > limit:
+        return 'The webhook URL must name the repo, eg /org/repo'
+    return None
 
 
-def process_webhook_output(data: bytes, signature: str) -> Optional[dict]:
-    """ Parse the webhook data and validate it, returning the json if
-        it is valid or None if not
+def slim(js: dict) -> dict:
+    """ Only the fields of webhook @js that Message.from_json needs, raising
+        KeyError or TypeError if it does not have them
     """
-    try:
-        js = json.loads(data)
-    except json.JSONDecodeError:
-        log.exception("Invalid JSON!")
-        return None
-
-    repo = js['repository']['full_name']
-
-    # Allowed repos are cfgfile section names
-    if not config.has_section(repo):
-        log.warning('Not an allowed repo: %s', repo)
-        return None
-    cfg = config[repo]
-
-    # Validate signature
-    if not check_hmac(data, cfg['secret'], signature):
-        log.warning('Invalid signature detected on request for %s - %s', repo, js['ref'])
-        return None
-
-    # Check branch (depends on cfg[bare] which would allow all branches)
-    if cfg.getboolean('bare', False):
+    p = js['pusher']
+    return {'ref': str(js['ref']), 'before': str(js['before']), 'after': str(js['after']),
+            'repository': {'full_name': str(js['repository']['full_name'])},
+            'pusher': {'login': str(p['login']), 'full_name': str(p['full_name']),
+                       'email': str(p['email'])}}
+
+
+class WebhookIngest(object):
+    """ Take in the body of a webhook for @repo (None if not known) as it is
+        read, computing its signature on the way, and validate it against
+        @config (by default the current one) once complete
+    """
+
+    def __init__(self, config: Optional['ConfigParser'] = None, repo: Optional[str] = None):
+        if config is None:
+            config = get_config()
+        self.config = config
+        if repo:
+            index = {config[repo]['secret']: [repo]} if config.has_section(repo) else {}
+        else:
+            index = secret_index(config)
+        self._macs = [(hmac.new(secret.encode('utf8'), digestmod='sha256'), repos)
+                      for secret, repos in index.items()]
+        self._body = bytearray()
+
+    def feed(self, chunk: bytes) -> None:
+        for mac, _ in self._macs:
+            mac.update(chunk)
+        self._body += chunk
+
+    def read(self, read: Callable[[int], bytes], length: int) -> None:
+        """ Feed @length bytes from @read (eg the read method of a file) """
+        while length > 0:
+            chunk = read(min(CHUNK, length))
+            if not chunk:
+                raise ConnectionError('Request body shorter than its Content-Length')
+            self.feed(chunk)
+            length -= len(chunk)
+
+    def signed_for(self, signature: str) -> List[str]:
+        """ The repos whose secret the body is signed with """
+        for mac, repos in self._macs:
+            if hmac.compare_digest(mac.hexdigest(), signature):
+                return repos
+        return []
+
+    def result(self, signature: str) -> Optional[dict]:
+        """ The webhook, with only the fields needed for a deploy, if it is
+            signed with @signature by the secret of its repo and the branch
+            is one to deploy. None if not
+        """
+        repos = self.signed_for(signature)
+        if not repos:
+            log.warning('Invalid signature detected on request (%d bytes)', len(self._body))
+            return None
+        try:
+            js = slim(json.loads(self._body))
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning('Malformed webhook from %s: %s', ', '.join(repos), e)
+            return None
+        repo = js['repository']['full_name']
+        if repo not in repos:
+            log.warning('Not an allowed repo or not signed with its secret: %s', repo)
+            return None
+        cfg = self.config[repo]
+
+        # Check branch (depends on cfg[bare] which would allow all branches)
+        if cfg.getboolean('bare', False):
+            return js
+        if cfg.get('targets'):
+            branches = [branch for branch, _ in parse_targets(cfg['targets'])]
+        else:
+            branches = [cfg['branch']]
+        if js['ref'] not in [f'refs/heads/{branch}' for branch in branches]:
+            log.debug('Not an allowed branch on %s: %s', repo, js['ref'])
+            return None
+
         return js
-    elif js['ref'] != f"refs/heads/{cfg['branch']}":
-        log.debug('Not an allowed branch on %s: %s', repo, js['ref'])
-        return None
 
-    return js
+
+def process_webhook_output(data: bytes, signature: str,
+                           config: Optional['ConfigParser'] = None,
+                           repo: Optional[str] = None) -> Optional[dict]:
+    """ Check the signature of the webhook @data (for @repo if known) and
+        validate it against @config (by default the current one), returning
+        the json if it is valid or None if not
+    """
+    ingest = WebhookIngest(config, repo)
+    ingest.feed(data)
+    return ingest.result(signature)
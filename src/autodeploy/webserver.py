@@ -2,14 +2,28 @@
 # to a running deploy-daemon locally. Contrast with deploy-cgi.py for a version
 # that runs as a CGI script under an existing webserver. They do the same thing
 # but this has a standalone server.
+#
+# There are two flavors of server: the default is a plain http.server, and
+# with webd_mode = asyncio an asyncio based one handles many connections at
+# once with keep-alive and timeouts. Both share the request handling below.
 
-from autodeploy import webd_port
-from autodeploy.util import run_serverclass_thread
-from autodeploy.webhook import process_webhook_output
-from autodeploy.message import Message, send_message
+from autodeploy import get_config, reload_config
+from autodeploy.util import run_serverclass_thread, ThreadPoolMixIn
+from autodeploy.webhook import WebhookIngest, CHUNK, url_repo, refusal
+from autodeploy.message import Message, Command, send_message, send_to_all, use_pooling
+from autodeploy.message import asend_message, asend_to_all
+from autodeploy.metrics import Counter, Gauge, Histogram
+from autodeploy.admission import Admission, Rejection
+from autodeploy import metrics
 
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from configparser import ConfigParser
+from typing import Tuple, List, Dict, Union, Optional, NamedTuple
+
+import asyncio
+import math
+import time
 import sys
 import logging
 
@@ -17,60 +31,449 @@ log = logging.getLogger(__name__)
 
 DEFAULT_PORT = 6942
 
+WEBHOOKS = Counter('autodeploy_webhooks_total', 'Webhooks answered by HTTP status', ['code'])
+WEBHOOK_SECONDS = Histogram('autodeploy_webhook_seconds',
+                            'Time from receiving a webhook to answering it, by HTTP status. '
+                            'Unless async, this is until the repo is deployed', ['code'])
+WEBHOOK_STAGE_SECONDS = Histogram('autodeploy_webhook_stage_seconds',
+                                  'Time spent verifying webhooks and waiting for the daemon(s)',
+                                  ['stage'])
+WEBHOOKS_IN_FLIGHT = Gauge('autodeploy_webhooks_in_flight', 'Webhooks being handled')
+DAEMON_UP = Gauge('autodeploy_daemon_up', 'Whether the local daemon answered the last stats query')
+
+# Answer of a daemon turning a request away, see SyncServer
+DAEMON_BUSY = 'Daemon busy'
+
+admission = Admission()
+
+
+class Response(NamedTuple):
+    code: int
+    reason: str
+    body: str = ''
+    ctype: str = 'text/plain;charset=utf8'
+    headers: Dict[str, str] = {}
+
+
+def forward_targets(config: ConfigParser) -> List[str]:
+    """ Daemons (unix:/path or tcp:host:port) to fan out each webhook to
+        instead of just the local one
+    """
+    return [a.strip() for a in config['DEFAULT'].get('forward', '').split(',') if a.strip()]
+
+
+def combine(results: List[Tuple[str, str, bool]]) -> Tuple[str, bool]:
+    """ One answer from those of many daemons, only OK if OK everywhere """
+    body = ''.join(f"== {addr}: {'OK' if ok else 'FAILED'}\n{ans.rstrip()}\n"
+                   for addr, ans, ok in results)
+    log.info("Forwarded to %d daemons, %d OK", len(results), sum(r[2] for r in results))
+    return body, all(ok for _, _, ok in results)
+
+
+def deliver(packet: bytes, config: ConfigParser) -> Tuple[str, bool]:
+    """ Send @packet to the local daemon or to every forward target, in which
+        case the answers are combined and it is only OK if OK everywhere
+    """
+    forward = forward_targets(config)
+    with WEBHOOK_STAGE_SECONDS.time(stage='daemon'):
+        if not forward:
+            return send_message(packet, on_output=log_output)
+        return combine(send_to_all(packet, forward, config['DEFAULT'].getint('forward_parallel', 8)))
+
+
+async def adeliver(packet: bytes, config: ConfigParser) -> Tuple[str, bool]:
+    """ deliver for the asyncio server """
+    forward = forward_targets(config)
+    with WEBHOOK_STAGE_SECONDS.time(stage='daemon'):
+        if not forward:
+            return await asend_message(packet, on_output=log_output)
+        return combine(await asend_to_all(packet, forward, config['DEFAULT'].getint('forward_parallel', 8)))
+
+
+def log_output(chunk: bytes) -> None:
+    """ Log postscript output streamed by the daemon while it runs """
+    for line in chunk.decode('utf8', 'replace').splitlines():
+        log.debug("Daemon output: %s", line)
+
+
+def job_query(path: str, config: ConfigParser) -> Union[Response, Tuple[bytes, List[Optional[str]]]]:
+    """ The packet asking for the job at /jobs/<id> and the daemons to ask, or
+        a Response if @path is not such a URL
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) != 2 or parts[0] != 'jobs':
+        return Response(404, 'Not found')
+    packet = Command('job', parts[1]).as_bytes(config['DEFAULT']['daemonkey'])
+    return packet, forward_targets(config) or [None]
+
+
+def job_response(response: str, ok: bool) -> Response:
+    if not ok:
+        return Response(404, 'No such job', response)
+    return Response(200, 'OK', response, ctype='application/json')
+
+
+def stats_query(config: ConfigParser) -> Optional[bytes]:
+    """ The packet asking the local daemon for its metrics, or None if
+        forwarding to other daemons, whose metrics are theirs to report
+    """
+    if forward_targets(config):
+        return None
+    return Command('stats').as_bytes(config['DEFAULT']['daemonkey'])
+
+
+def metrics_response(daemon: Optional[Tuple[str, bool]]) -> Response:
+    """ Our own metrics followed by the @daemon answer to stats_query """
+    body = ''
+    if daemon:
+        DAEMON_UP.set(int(daemon[1]))
+        body = daemon[0] if daemon[1] else f'# Daemon stats unavailable: {daemon[0].strip()}\n'
+    return Response(200, 'OK', metrics.render() + body, ctype=metrics.CONTENT_TYPE)
+
+
+def rejection_response(rejected: Rejection) -> Response:
+    log.warning("Turned away webhook: %d %s", rejected.code, rejected.reason)
+    headers = {}
+    if rejected.retry_after:
+        headers['Retry-After'] = str(max(1, math.ceil(rejected.retry_after)))
+    return Response(rejected.code, rejected.reason, headers=headers)
+
+
+def record_webhook(start: float, resp: Response) -> None:
+    WEBHOOKS.inc(code=str(resp.code))
+    WEBHOOK_SECONDS.observe(time.monotonic() - start, code=str(resp.code))
+
+
+def prepare(ingest: WebhookIngest, signature: Optional[str],
+            config: ConfigParser) -> Union[Response, bytes]:
+    """ Validate a webhook read into @ingest, returning the packet to send to
+        the daemon or the Response rejecting it
+    """
+    if not signature:
+        return Response(401, 'No signature provided')
+    with WEBHOOK_STAGE_SECONDS.time(stage='verify'):
+        json = ingest.result(signature)
+    if not json:
+        return Response(403, 'Invalid signature, repo or branch')
+    key = config['DEFAULT']['daemonkey']
+    packet = Message.from_json(json).as_bytes(key)
+    # Answer 202 with a job id as soon as the daemon accepted the deploy
+    # instead of waiting for it to finish
+    if config['DEFAULT'].getboolean('async', False):
+        packet = Command('submit', payload=packet.decode('utf8')).as_bytes(key)
+    return packet
+
+
+def deploy_response(response: str, ok: bool, config: ConfigParser) -> Response:
+    """ Response for the answer of the daemon(s) to a webhook """
+    if config['DEFAULT'].getboolean('async', False):
+        log.info("Daemon accepted == %s", ok)
+        if not ok:
+            return Response(500, 'Error submitting job', response)
+        if forward_targets(config):
+            return Response(202, 'Accepted', response)
+        job = response.strip()
+        return Response(202, 'Accepted', f'{job}\n', headers={'Location': f'/jobs/{job}'})
+    log.info("Daemon success == %s", ok)
+    if not ok and response.startswith(DAEMON_BUSY):
+        retry = config['DEFAULT'].get('webd_retry_after', '5')
+        return Response(503, DAEMON_BUSY, response, headers={'Retry-After': retry})
+    if not ok:
+        return Response(500, 'Error processing repo', response)
+    return Response(200, 'Git repo sync OK', response)
+
+
 class WebhookHTTPRequestHandler(BaseHTTPRequestHandler):
 
     # Default error sends HTML
-    def answer(self, code, msg, body=''):
+    def answer(self, code, msg, body='', ctype='text/plain;charset=utf8', headers={}):
+        data = (body or msg).encode('utf8')
         self.send_response(code, msg)
         self.send_header('Connection', 'close')
-        self.send_header("Content-Type", 'text/plain;charset=utf8')
-        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
         self.end_headers()
-        if body:
-            self.wfile.write(body.encode('utf8'))
-        else:
-            self.wfile.write(msg.encode('utf8'))
+        self.wfile.write(data)
 
     def do_POST(self):
 
-        postlen = int(self.headers['content-length'])
-        webdata = self.rfile.read(postlen)
-        log.debug("Got %d bytes in request from %s", postlen, self.client_address)
-        sig = self.headers['X-Gitea-Signature']
-        if not sig:
-            self.answer(401, 'No signature provided')
+        start = time.monotonic()
+        # The whole request sees the config as it was when it came in
+        self.config = get_config()
+        try:
+            postlen = int(self.headers['content-length'])
+        except (TypeError, ValueError):
+            postlen = None
+        repo = url_repo(self.path, self.config)
+        refused = refusal(self.config, repo)
+        if postlen is None:
+            resp = Response(411, 'Length required')
+        elif refused:
+            log.warning("Refused webhook for %s: %s", self.path, refused)
+            resp = Response(403, 'Forbidden', refused + '\n')
+        else:
+            rejected = admission.admit(self.config, repo, postlen)
+            resp = rejection_response(rejected) if rejected else None
+        if resp:
+            self.answer(*resp)
+            record_webhook(start, resp)
             return
+
         try:
-            self.process_data(webdata, sig)
-        except Exception as e:
-            log.exception('Unexpected error processing request')
-            self.answer(500, 'Error processing request', str(e) + '\n')
+            # Signed with the secret of the repo in the URL, or any if none
+            ingest = WebhookIngest(self.config, repo)
+            with WEBHOOKS_IN_FLIGHT.track():
+                try:
+                    ingest.read(self.rfile.read, postlen)
+                    log.debug("Got %d bytes in request from %s", postlen, self.client_address)
+                    resp = self.process_data(ingest, self.headers['X-Gitea-Signature'])
+                except Exception as e:
+                    log.exception('Unexpected error processing request')
+                    resp = Response(500, 'Error processing request', str(e) + '\n')
+        finally:
+            admission.release()
+        self.answer(*resp)
+        record_webhook(start, resp)
 
-    def process_data(self, data, signature):
+    def do_GET(self):
 
-        json = process_webhook_output(data, signature)
-        if not json:
-            self.answer(403, 'Invalid signature or repo')
+        config = get_config()
+        if self.path == '/metrics':
+            packet = stats_query(config)
+            try:
+                daemon = send_message(packet) if packet else None
+            except Exception as e:
+                daemon = (str(e), False)
+            self.answer(*metrics_response(daemon))
             return
-        response, ok = send_message(Message.from_json(json).as_bytes())
-        log.info("Daemon success == %s", ok)
-        if not ok:
-            self.answer(500, 'Error processing repo', response)
-        else:
-            self.answer(200, 'Git repo sync OK', response)
+
+        query = job_query(self.path, config)
+        if isinstance(query, Response):
+            self.answer(*query)
+            return
+        packet, addresses = query
+        try:
+            for address in addresses:
+                response, ok = send_message(packet, address)
+                if ok:
+                    break
+        except Exception as e:
+            log.exception('Unexpected error querying job')
+            self.answer(500, 'Error querying job', str(e) + '\n')
+            return
+        self.answer(*job_response(response, ok))
+
+    def process_data(self, ingest: WebhookIngest, signature: Optional[str]) -> Response:
+
+        packet = prepare(ingest, signature, self.config)
+        if isinstance(packet, Response):
+            return packet
+        return deploy_response(*deliver(packet, self.config), self.config)
 
 
-class WebhookRecvServer(HTTPServer):
-    def __init__(self, port):
+class WebhookRecvServer(ThreadPoolMixIn, HTTPServer):
+    """ Handles up to @workers webhooks at once, and turns away connections
+        beyond webd_max_pending waiting for or being handled by a worker
+        before they are queued
+    """
+
+    def __init__(self, port, workers: int = 1):
+        self.max_workers = workers
         super().__init__(('', port), WebhookHTTPRequestHandler)
 
+    def process_request(self, request, client_address):
+        settings = get_config()['DEFAULT']
+        self.max_pending = settings.getint('webd_max_pending', 0)
+        if self.max_pending:
+            retry = max(1, math.ceil(settings.getfloat('webd_retry_after', 5)))
+            body = b'Too many pending deploys'
+            self.busy_answer = (f'HTTP/1.0 503 Too many pending deploys\r\nConnection: close\r\n'
+                                f'Content-Type: text/plain;charset=utf8\r\n'
+                                f'Content-Length: {len(body)}\r\nRetry-After: {retry}\r\n\r\n'
+                                ).encode('utf8') + body
+        super().process_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        super().reject_request(request, client_address)
+        WEBHOOKS.inc(code='503')
+
+
+class AsyncWebhookRecvServer(object):
+    """ Webhook receiver on asyncio: many concurrent connections, HTTP/1.1
+        keep-alive, timeouts on reading headers and bodies, and daemon calls
+        that do not block other requests. Runs its event loop in the thread
+        calling serve_forever, like a socketserver
+    """
+
+    max_header = 65536
+
+    def __init__(self, port: int, header_timeout: float = 10, read_timeout: float = 30):
+        self.header_timeout, self.read_timeout = header_timeout, read_timeout
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, port=port, limit=self.max_header))
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        try:
+            while await self.handle_one(reader, writer, peer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            log.exception('Unexpected error on connection from %s', peer)
+        finally:
+            writer.close()
+
+    async def handle_one(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         peer) -> bool:
+        """ Read and answer one request, returning whether to keep going """
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.header_timeout)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.LimitOverrunError:
+            await self.send(writer, Response(431, 'Request header too large'), False)
+            return False
+        except asyncio.IncompleteReadError:
+            return False
+
+        try:
+            line, *lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+            method, path, version = line.split(' ')
+            headers = {}
+            for h in lines:
+                k, v = h.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        except ValueError:
+            await self.send(writer, Response(400, 'Bad request'), False)
+            return False
+
+        conn = headers.get('connection', '').lower()
+        keep = conn == 'keep-alive' if version == 'HTTP/1.0' else conn != 'close'
+
+        # The whole request sees the config as it was when it came in
+        config = get_config()
+        if method == 'POST':
+            start = time.monotonic()
+            try:
+                length = int(headers.get('content-length', ''))
+            except ValueError:
+                await self.send(writer, Response(411, 'Length required'), False)
+                return False
+            repo = url_repo(path, config)
+            refused = refusal(config, repo)
+            if refused:
+                log.warning("Refused webhook for %s: %s", path, refused)
+                resp = Response(403, 'Forbidden', refused + '\n')
+            else:
+                rejected = admission.admit(config, repo, length)
+                resp = rejection_response(rejected) if rejected else None
+            if resp:
+                # The body is left unread, so the connection cannot be reused
+                record_webhook(start, resp)
+                await self.send(writer, resp, False)
+                return False
+            try:
+                ingest = WebhookIngest(config, repo)
+                try:
+                    await asyncio.wait_for(self.read_body(reader, ingest, length), self.read_timeout)
+                except asyncio.TimeoutError:
+                    await self.send(writer, Response(408, 'Request timeout'), False)
+                    return False
+                log.debug("Got %d bytes in request from %s", length, peer)
+                with WEBHOOKS_IN_FLIGHT.track():
+                    try:
+                        packet = prepare(ingest, headers.get('x-gitea-signature'), config)
+                        if not isinstance(packet, Response):
+                            packet = deploy_response(*await adeliver(packet, config), config)
+                        resp = packet
+                    except Exception as e:
+                        log.exception('Unexpected error processing request')
+                        resp = Response(500, 'Error processing request', str(e) + '\n')
+            finally:
+                admission.release()
+            record_webhook(start, resp)
+        elif method == 'GET':
+            resp = await self.get(path, config)
+        else:
+            resp = Response(405, 'Method not allowed')
+        await self.send(writer, resp, keep)
+        log.info('%s "%s %s %s" %d', peer, method, path, version, resp.code)
+        return keep
+
+    @staticmethod
+    async def read_body(reader: asyncio.StreamReader, ingest: WebhookIngest, length: int):
+        while length > 0:
+            chunk = await reader.read(min(CHUNK, length))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', length)
+            ingest.feed(chunk)
+            length -= len(chunk)
+
+    async def get(self, path: str, config: ConfigParser) -> Response:
+        if path == '/metrics':
+            packet = stats_query(config)
+            try:
+                daemon = await asend_message(packet) if packet else None
+            except Exception as e:
+                daemon = (str(e), False)
+            return metrics_response(daemon)
+
+        query = job_query(path, config)
+        if isinstance(query, Response):
+            return query
+        packet, addresses = query
+        try:
+            for address in addresses:
+                response, ok = await asend_message(packet, address)
+                if ok:
+                    break
+        except Exception as e:
+            log.exception('Unexpected error querying job')
+            return Response(500, 'Error querying job', str(e) + '\n')
+        return job_response(response, ok)
+
+    async def send(self, writer: asyncio.StreamWriter, resp: Response, keep: bool):
+        data = (resp.body or resp.reason).encode('utf8')
+        headers = {'Content-Type': resp.ctype, 'Content-Length': str(len(data)),
+                   'Connection': 'keep-alive' if keep else 'close'}
+        headers.update(resp.headers)
+        head = f'HTTP/1.1 {resp.code} {resp.reason}\r\n'
+        head += ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        writer.write(head.encode('latin-1') + data)
+        await writer.drain()
+
 
 def daemon_main():
+    settings = get_config()['DEFAULT']
     if '-p' in sys.argv:
         port = int(sys.argv[sys.argv.index('-p') + 1])
-    elif webd_port:
-        port = int(webd_port)
+    elif settings.get('webport'):
+        port = int(settings['webport'])
     else:
         port = DEFAULT_PORT
 
-    run_serverclass_thread(WebhookRecvServer(port))
+    if settings.get('webd_mode', 'http') == 'asyncio':
+        srv = AsyncWebhookRecvServer(port, settings.getfloat('webd_header_timeout', 10),
+                                     settings.getfloat('webd_read_timeout', 30))
+    else:
+        # Keep connections to the daemon(s) open between webhooks
+        use_pooling(settings.getint('daemon_connections', 0))
+        srv = WebhookRecvServer(port, settings.getint('webd_workers', 4))
+    run_serverclass_thread(srv, reload=reload_config)
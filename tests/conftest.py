@@ -0,0 +1,13 @@
+# The daemon module reads the config when imported: point it at a minimal one
+# before any test imports autodeploy.
+
+import os
+import tempfile
+
+_dir = tempfile.mkdtemp(prefix='autodeploy-tests-')
+_cfg = os.path.join(_dir, 'autodeploy.cfg')
+with open(os.open(_cfg, os.O_WRONLY | os.O_CREAT, 0o600), 'w') as fp:
+    fp.write(f'socket = {os.path.join(_dir, "autodeploy.sock")}\n'
+             'daemonkey = testkey\n'
+             'loglevel = warning\n')
+os.environ['AUTODEPLOYCFG'] = _cfg
@@ -0,0 +1,127 @@
+# Admission of webhooks by the receiver: body size, pending count and the
+# per-repo rate limits, and the daemons turning away requests when busy.
+
+import configparser
+import socket
+import socketserver
+import threading
+
+import pytest
+
+from autodeploy import admission
+from autodeploy.admission import Admission, TokenBucket
+from autodeploy.message import recv_all
+from autodeploy.util import ThreadPoolMixIn
+
+
+def make_config(defaults: str = '', repo: str = '') -> configparser.ConfigParser:
+    cfg = configparser.ConfigParser()
+    cfg.read_string(f'[DEFAULT]\n{defaults}\n[org/repo]\n{repo}\n')
+    return cfg
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_admits_by_default():
+    adm = Admission()
+    assert adm.admit(make_config(), 'org/repo', 100) is None
+    assert adm.pending == 1
+    adm.release()
+    assert adm.pending == 0
+
+
+def test_body_too_large():
+    cfg = make_config('webd_max_body = 10', 'webd_max_body = 1000')
+    adm = Admission()
+    assert adm.admit(cfg, None, 11).code == 413
+    assert adm.admit(cfg, 'org/repo', 11) is None
+    assert adm.admit(cfg, 'org/repo', 1001).code == 413
+    # Rejections are not pending
+    assert adm.pending == 1
+
+
+def test_too_many_pending():
+    cfg = make_config('webd_max_pending = 2\nwebd_retry_after = 7')
+    adm = Admission()
+    assert adm.admit(cfg, 'org/repo', 0) is None
+    assert adm.admit(cfg, None, 0) is None
+    rej = adm.admit(cfg, 'org/repo', 0)
+    assert (rej.code, rej.retry_after) == (503, 7)
+    adm.release()
+    assert adm.admit(cfg, 'org/repo', 0) is None
+
+
+def test_rate_limited(clock):
+    cfg = make_config(repo='webd_rate = 2\nwebd_burst = 3')
+    adm = Admission()
+    for _ in range(3):
+        assert adm.admit(cfg, 'org/repo', 0) is None
+    rej = adm.admit(cfg, 'org/repo', 0)
+    assert rej.code == 429
+    assert rej.retry_after == pytest.approx(0.5)
+    # Other repos (here those not known yet) have their own bucket
+    assert adm.admit(cfg, None, 0) is None
+    clock[0] += 0.5
+    assert adm.admit(cfg, 'org/repo', 0) is None
+
+
+def test_rate_change_takes_effect(clock):
+    adm = Admission()
+    cfg = make_config(repo='webd_rate = 1\nwebd_burst = 1')
+    assert adm.admit(cfg, 'org/repo', 0) is None
+    assert adm.admit(cfg, 'org/repo', 0).code == 429
+    cfg = make_config(repo='webd_rate = 1\nwebd_burst = 5')
+    assert adm.admit(cfg, 'org/repo', 0) is None
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() == pytest.approx(1)
+    clock[0] += 60
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() > 0
+
+
+class BlockingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.started.set()
+        self.server.release.wait(5)
+        self.request.sendall(b'done')
+
+
+class PoolServer(ThreadPoolMixIn, socketserver.TCPServer):
+    max_workers = 1
+    max_pending = 1
+    busy_answer = b'busy'
+    allow_reuse_address = True
+
+
+def test_server_turns_away_requests_beyond_max_pending():
+    srv = PoolServer(('127.0.0.1', 0), BlockingHandler)
+    srv.started, srv.release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        first = socket.create_connection(srv.server_address, timeout=5)
+        assert srv.started.wait(5)
+        second = socket.create_connection(srv.server_address, timeout=5)
+        # Answered and closed by the serving thread, without a worker
+        assert recv_all(second) == b'busy'
+        srv.release.set()
+        assert recv_all(first) == b'done'
+        # The pending count went back down
+        third = socket.create_connection(srv.server_address, timeout=5)
+        assert recv_all(third) == b'done'
+        for s in (first, second, third):
+            s.close()
+    finally:
+        srv.release.set()
+        srv.shutdown()
+        srv.server_close()
+        thread.join(5)
@@ -0,0 +1,114 @@
+# The config cache used by the CGI script: reused while the config file is
+# unchanged, rebuilt when it changes, and read back with the same values
+# configparser gives.
+
+import os
+
+import pytest
+
+from autodeploy import load_config, load_cached_config
+from autodeploy.cfgcache import CachedConfig
+
+CONFIG = """\
+socket = /run/autodeploy.sock
+daemonkey = key
+webd_max_body = 2048
+async = yes
+
+[org/repo]
+url = https://git.example.com/org/repo.git
+local = /srv/repo
+secret = s3cret
+branch = master
+"""
+
+
+def write(path, text: str, mode: int = 0o600) -> None:
+    with open(path, 'w') as fp:
+        fp.write(text)
+    os.chmod(path, mode)
+
+
+@pytest.fixture
+def files(tmp_path):
+    cfg, cache = tmp_path / 'autodeploy.cfg', tmp_path / 'cache.json'
+    write(cfg, CONFIG)
+    return str(cfg), str(cache)
+
+
+def test_cache_is_written_then_used(files):
+    cfg, cache = files
+    first = load_cached_config(cfg, cache)
+    assert not isinstance(first, CachedConfig)
+    assert os.stat(cache).st_mode & 0o777 == 0o600
+    second = load_cached_config(cfg, cache)
+    assert isinstance(second, CachedConfig)
+    assert second.sections() == ['org/repo']
+    assert second['org/repo']['secret'] == 's3cret'
+
+
+def test_same_values_as_configparser(files):
+    cfg, cache = files
+    load_cached_config(cfg, cache)
+    cached, parsed = load_cached_config(cfg, cache), load_config(cfg)
+    for name in ('DEFAULT', 'org/repo'):
+        c, p = cached[name], parsed[name]
+        assert {k: c[k] for k in c} == dict(p)
+        assert c.getint('webd_max_body') == p.getint('webd_max_body') == 2048
+        assert c.getboolean('async') is p.getboolean('async') is True
+        assert c.getint('missing', 5) == p.getint('missing', 5) == 5
+        assert c.get('missing') is p.get('missing') is None
+    assert 'org/repo' in cached and 'org/other' not in cached
+    assert cached.has_section('org/repo') and not cached.has_section('DEFAULT')
+    with pytest.raises(ValueError):
+        cached['org/repo'].getint('url')
+    with pytest.raises(KeyError):
+        cached['org/repo']['missing']
+
+
+def test_changed_config_is_reloaded(files):
+    cfg, cache = files
+    load_cached_config(cfg, cache)
+    write(cfg, CONFIG.replace('s3cret', 'changed secret'))
+    fresh = load_cached_config(cfg, cache)
+    assert not isinstance(fresh, CachedConfig)
+    assert fresh['org/repo']['secret'] == 'changed secret'
+    assert load_cached_config(cfg, cache)['org/repo']['secret'] == 'changed secret'
+
+
+def test_touched_config_is_reloaded(files):
+    cfg, cache = files
+    load_cached_config(cfg, cache)
+    st = os.stat(cfg)
+    os.utime(cfg, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert not isinstance(load_cached_config(cfg, cache), CachedConfig)
+
+
+def test_corrupt_cache_is_ignored(files):
+    cfg, cache = files
+    load_cached_config(cfg, cache)
+    write(cache, '{"version": 1, "sta')
+    assert load_cached_config(cfg, cache)['org/repo']['secret'] == 's3cret'
+    assert isinstance(load_cached_config(cfg, cache), CachedConfig)
+
+
+def test_shared_cache_is_ignored(files):
+    cfg, cache = files
+    load_cached_config(cfg, cache)
+    os.chmod(cache, 0o644)
+    assert not isinstance(load_cached_config(cfg, cache), CachedConfig)
+
+
+def test_world_readable_config(files):
+    cfg, cache = files
+    os.chmod(cfg, 0o644)
+    with pytest.raises(Warning):
+        load_cached_config(cfg, cache)
+
+
+def test_invalid_config_is_not_cached(files):
+    cfg, cache = files
+    write(cfg, CONFIG.replace('secret = s3cret\n', ''))
+    with pytest.raises(ValueError):
+        load_cached_config(cfg, cache)
+    assert not os.path.exists(cache)
@@ -0,0 +1,161 @@
+# Deploys in the daemon: queued per repo when accepted, coalesced to the
+# newest push while waiting, and run with at most one worker per repo.
+
+import configparser
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from autodeploy import daemon
+from autodeploy.daemon import RepoQueue, queue_deploy
+from autodeploy.message import Message
+
+
+def message(state: str, before: str, branch: str = 'refs/heads/master',
+            repo: str = 'org/repo') -> Message:
+    m = Message()
+    m.repo, m.branch, m.before, m.state = repo, branch, before, state
+    m.pusher, m.fullname, m.email = 'someone', 'Some One', ''
+    return m
+
+
+def test_newest_push_supersedes():
+    queue = RepoQueue()
+    msgs = [message('b', 'a'), message('c', 'b'), message('d', 'c')]
+    tickets = [queue.enqueue(m) for m in msgs]
+    assert queue.superseded_by(tickets[0], msgs[0]) is msgs[2]
+    assert queue.superseded_by(tickets[1], msgs[1]) is msgs[2]
+    assert queue.superseded_by(tickets[2], msgs[2]) is None
+
+
+def test_before_state_of_oldest_waiting():
+    queue = RepoQueue()
+    first, second, third = message('b', 'a'), message('c', 'b'), message('d', 'c')
+    queue.enqueue(first)
+    # The deploy of first starts, from its own before
+    assert queue.start(first) == 'a'
+    # While it runs, two more come in: the newest starts from where first left
+    queue.enqueue(second)
+    ticket = queue.enqueue(third)
+    assert queue.superseded_by(ticket, third) is None
+    assert queue.start(third) == 'b'
+    # Nothing is waiting any more
+    assert queue.start(message('e', 'd')) == 'd'
+
+
+def test_branches_are_separate():
+    queue = RepoQueue()
+    master, other = message('b', 'a'), message('y', 'x', 'refs/heads/other')
+    tm, to = queue.enqueue(master), queue.enqueue(other)
+    assert queue.superseded_by(tm, master) is None
+    assert queue.superseded_by(to, other) is None
+    assert queue.start(master) == 'a' and queue.start(other) == 'x'
+
+
+def test_run_one_at_a_time_in_order():
+    queue, pool = RepoQueue(), ThreadPoolExecutor(max_workers=4)
+    running, most, order = [0], [0], []
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def work(i: int):
+        def run():
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+                order.append(i)
+            if i == 9:
+                finished.set()
+        return run
+
+    for i in range(10):
+        queue.run(work(i), pool)
+    assert finished.wait(5)
+    pool.shutdown(wait=True)
+    assert order == list(range(10))
+    assert most[0] == 1
+
+
+def test_busy_repo_leaves_workers_to_others():
+    busy, idle, pool = RepoQueue(), RepoQueue(), ThreadPoolExecutor(max_workers=2)
+    release, done = threading.Event(), threading.Event()
+    for _ in range(5):
+        busy.run(lambda: release.wait(5), pool)
+    idle.run(done.set, pool)
+    assert done.wait(2)
+    release.set()
+    pool.shutdown(wait=True)
+
+
+def test_waiting_work_runs_at_shutdown():
+    queue, pool = RepoQueue(), ThreadPoolExecutor(max_workers=1)
+    release, ran = threading.Event(), []
+    queue.run(lambda: release.wait(5), pool)
+    for i in range(3):
+        queue.run(lambda i=i: ran.append(i), pool)
+    threading.Timer(0.1, release.set).start()
+    pool.shutdown(wait=True)
+    assert ran == [0, 1, 2]
+
+
+@pytest.fixture
+def fake_deploys(monkeypatch, tmp_path):
+    """ The daemon with one deploy worker and deploys that only record the
+        states they went from and to, the first one waiting for a go
+    """
+    deployed, go = [], threading.Event()
+
+    def make_repo_state(sec, ref, before, state):
+        deployed.append((before, state))
+        go.wait(5)
+
+    monkeypatch.setattr(daemon, 'deploy_pool', ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(daemon, 'journal', None)
+    monkeypatch.setattr(daemon, 'make_repo_state', make_repo_state)
+    monkeypatch.setattr(daemon, 'run_postscript_and_notify', lambda *args: (b'', 0, None))
+    cfg = configparser.ConfigParser()
+    for name in ('org/repo', 'org/other'):
+        cfg[name] = {'local': str(tmp_path / name), 'branch': 'master'}
+    yield cfg, deployed, go
+    go.set()
+    daemon.deploy_pool.shutdown(wait=True)
+
+
+def test_pushes_waiting_for_a_worker_coalesce(fake_deploys):
+    cfg, deployed, go = fake_deploys
+    sec = cfg['org/repo']
+    first = queue_deploy(message('b', 'a'), sec)
+    waiting = [queue_deploy(message(state, before), sec)
+               for before, state in (('b', 'c'), ('c', 'd'), ('d', 'e'))]
+    go.set()
+    assert b'updated to state b' in first.result(5)
+    assert all(b'superseded by queued deploy of e' in f.result(5) for f in waiting[:2])
+    assert b'updated to state e' in waiting[2].result(5)
+    # The newest deploy starts from where the first left the repo
+    assert deployed == [('a', 'b'), ('b', 'e')]
+
+
+def test_uncoalesced_pushes_all_deploy(fake_deploys):
+    cfg, deployed, go = fake_deploys
+    cfg['org/repo']['coalesce'] = 'false'
+    futures = [queue_deploy(message(state, before), cfg['org/repo'])
+               for before, state in (('a', 'b'), ('b', 'c'), ('c', 'd'))]
+    go.set()
+    assert all(b'updated' in f.result(5) for f in futures)
+    assert deployed == [('a', 'b'), ('b', 'c'), ('c', 'd')]
+
+
+def test_failed_deploy_fails_its_future(fake_deploys, monkeypatch):
+    cfg, deployed, go = fake_deploys
+    go.set()
+
+    def broken(*args):
+        raise RuntimeError('checkout failed')
+    monkeypatch.setattr(daemon, 'make_repo_state', broken)
+    with pytest.raises(RuntimeError, match='checkout failed'):
+        queue_deploy(message('b', 'a'), cfg['org/repo']).result(5)
@@ -0,0 +1,74 @@
+# Async deploy jobs: progress output kept up to the cap, and the final reply.
+
+import pytest
+
+from autodeploy.jobs import Job, JobTable
+from autodeploy.message import Message
+
+PUSH = {'repository': {'full_name': 'org/repo'}, 'ref': 'refs/heads/master',
+        'before': 'a' * 40, 'after': 'b' * 40,
+        'pusher': {'login': 'someone', 'full_name': 'Some One', 'email': 'some@one'}}
+
+
+@pytest.fixture
+def msg():
+    return Message.from_json(PUSH)
+
+
+def test_progress_is_kept(msg):
+    job = Job(msg)
+    for i in range(1000):
+        job.progress(b'line %d\n' % i)
+    assert job.output.splitlines()[-1] == 'line 999'
+    assert job.output.count('\n') == 1000
+
+
+def test_progress_is_capped(msg):
+    job = Job(msg, cap=10)
+    job.progress(b'123456')
+    job.progress(b'789012')
+    job.progress(b'345')
+    assert job.output == '1234567890\n[... output truncated, 5 bytes not shown]\n'
+
+
+def test_reply_replaces_progress(msg):
+    job = Job(msg, cap=4)
+    job.progress(b'too much output')
+    job.run(lambda: b'deployed')
+    assert (job.status, job.output) == ('done', 'deployed')
+    d = job.as_dict()
+    assert d['repo'] == 'org/repo' and d['state'] == 'b' * 40
+    assert d['queued_seconds'] >= 0 and d['run_seconds'] >= 0
+
+
+def test_failed_job(msg):
+    def fail():
+        raise RuntimeError('no checkout')
+    job = Job(msg)
+    job.run(fail)
+    assert (job.status, job.error) == ('failed', 'no checkout')
+
+
+def test_table_keeps_the_newest_finished(msg):
+    table = JobTable(keep=2)
+    jobs = [table.new(msg, cap=100) for _ in range(3)]
+    for job in jobs:
+        job.run(lambda: b'done')
+    jobs.append(table.new(msg))
+    assert table.get(jobs[0].id) is None
+    assert [table.get(j.id) for j in jobs[1:]] == jobs[1:]
+    assert jobs[2].cap == 100
+
+
+def test_table_keeps_unfinished_jobs(msg):
+    table = JobTable(keep=2)
+    jobs = [table.new(msg) for _ in range(5)]
+    jobs[1].start()
+    assert all(table.get(j.id) is j for j in jobs)
+    # Only finished jobs count towards keep, the oldest being forgotten first
+    jobs[3].finish(b'ok')
+    jobs[4].finish(error=RuntimeError('failed'))
+    jobs[0].finish(b'ok')
+    table.new(msg)
+    assert table.get(jobs[0].id) is None
+    assert all(table.get(j.id) is j for j in jobs[1:])
@@ -0,0 +1,118 @@
+# The deploy journal: which states count as applied (and so are skipped when
+# replayed), surviving a restart, torn lines and compaction.
+
+import json
+
+import pytest
+
+from autodeploy.journal import Journal
+
+REPO, BRANCH = 'org/repo', 'refs/heads/master'
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'journal.jsonl')
+
+
+def test_ok_is_applied(path):
+    j = Journal(path)
+    assert j.applied(REPO, BRANCH) is None
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    assert j.applied(REPO, BRANCH) == 'b'
+    assert j.applied(REPO, 'refs/heads/other') is None
+    assert j.applied('org/other', BRANCH) is None
+    j.close()
+
+
+def test_rollback_is_applied(path):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    j.record(REPO, BRANCH, 'b', 'a', 'rollback')
+    assert j.applied(REPO, BRANCH) == 'a'
+    j.close()
+
+
+@pytest.mark.parametrize('outcome', ['failed', 'postscript_failed'])
+def test_failure_is_not_applied(path, outcome):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    j.record(REPO, BRANCH, 'b', 'c', outcome)
+    # Neither b nor c can be skipped, the checkout is in neither state
+    assert j.applied(REPO, BRANCH) is None
+    j.close()
+
+
+@pytest.mark.parametrize('outcome', ['skipped', 'superseded'])
+def test_no_op_keeps_applied(path, outcome):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    j.record(REPO, BRANCH, 'b', 'c', outcome)
+    assert j.applied(REPO, BRANCH) == 'b'
+    j.close()
+
+
+def test_targets_are_separate(path):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok', target='/srv/one')
+    assert j.applied(REPO, BRANCH, '/srv/one') == 'b'
+    assert j.applied(REPO, BRANCH, '/srv/two') is None
+    assert j.applied(REPO, BRANCH) is None
+    j.close()
+
+
+def test_reloaded_after_restart(path):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok', pusher='someone')
+    j.record('org/other', BRANCH, 'a', 'b', 'ok')
+    j.record('org/other', BRANCH, 'b', 'c', 'postscript_failed')
+    j.close()
+    j = Journal(path)
+    assert j.applied(REPO, BRANCH) == 'b'
+    assert j.applied('org/other', BRANCH) is None
+    assert [r['outcome'] for r in j.history('org/other')] == ['ok', 'postscript_failed']
+    assert j.history(REPO)[0]['pusher'] == 'someone'
+    j.close()
+
+
+def test_torn_last_line(path):
+    j = Journal(path)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    j.close()
+    with open(path, 'a') as fp:
+        fp.write('{"time": 1, "repo": "org/re')
+    j = Journal(path)
+    assert j.applied(REPO, BRANCH) == 'b'
+    j.record(REPO, BRANCH, 'b', 'c', 'ok')
+    j.close()
+    j = Journal(path)
+    assert j.applied(REPO, BRANCH) == 'c'
+    j.close()
+
+
+def test_compaction_keeps_applied(path):
+    j = Journal(path, keep=2)
+    j.record(REPO, BRANCH, 'a', 'b', 'ok')
+    for i in range(10):
+        j.record('org/other', BRANCH, str(i), str(i + 1), 'ok')
+    j.close()
+    j = Journal(path, keep=2)
+    j.close()
+    with open(path) as fp:
+        records = [json.loads(line) for line in fp]
+    assert len(records) == 3
+    j = Journal(path, keep=2)
+    assert j.applied(REPO, BRANCH) == 'b'
+    assert j.applied('org/other', BRANCH) == '10'
+    assert len(j.history('org/other')) == 2
+    j.close()
+
+
+def test_history(path):
+    j = Journal(path)
+    for state in 'bcd':
+        j.record(REPO, BRANCH, 'a', state, 'ok')
+    assert [r['state'] for r in j.history(REPO)] == ['b', 'c', 'd']
+    assert [r['state'] for r in j.history(REPO, 2)] == ['c', 'd']
+    assert j.history('org/unknown') == []
+    j.close()
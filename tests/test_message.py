@@ -0,0 +1,94 @@
+# The framed daemon protocol, over a socketpair standing in for the daemon
+# connection.
+
+import socket
+import struct
+
+import pytest
+
+from autodeploy.message import (FRAME_MAGIC, FRAME_HEADER, FRAME_REQUEST, FRAME_REPLY,
+                                FRAME_OUTPUT, write_frame, read_frame, closed_by_peer)
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def test_frames_round_trip(pair):
+    a, b = pair
+    write_frame(a, FRAME_REQUEST, b'deploy me')
+    write_frame(a, FRAME_OUTPUT, b'')
+    write_frame(a, FRAME_REPLY, b'x' * 100000)
+    assert read_frame(b) == (FRAME_REQUEST, b'deploy me')
+    assert read_frame(b) == (FRAME_OUTPUT, b'')
+    assert read_frame(b) == (FRAME_REPLY, b'x' * 100000)
+
+
+def test_frame_without_magic(pair):
+    a, b = pair
+    write_frame(a, FRAME_REQUEST, b'payload')
+    assert b.recv(len(FRAME_MAGIC)) == FRAME_MAGIC
+    assert read_frame(b, magic=False) == (FRAME_REQUEST, b'payload')
+
+
+def test_frame_split_across_writes(pair):
+    a, b = pair
+    data = FRAME_MAGIC + FRAME_HEADER.pack(FRAME_REPLY, 6) + b'abcdef'
+    for i in range(0, len(data), 3):
+        a.sendall(data[i:i + 3])
+    assert read_frame(b) == (FRAME_REPLY, b'abcdef')
+
+
+def test_clean_eof_before_frame(pair):
+    a, b = pair
+    a.close()
+    assert read_frame(b) is None
+
+
+def test_bad_magic(pair):
+    a, b = pair
+    a.sendall(b'GET / HTTP/1.0\r\n')
+    with pytest.raises(ValueError):
+        read_frame(b)
+
+
+def test_frame_over_limit(pair):
+    a, b = pair
+    write_frame(a, FRAME_REQUEST, b'y' * 1000)
+    with pytest.raises(ValueError):
+        read_frame(b, limit=999)
+
+
+@pytest.mark.parametrize('data', [
+    FRAME_MAGIC + b'\x01\x00',
+    FRAME_MAGIC + FRAME_HEADER.pack(FRAME_REPLY, 10) + b'short',
+])
+def test_eof_inside_frame(pair, data):
+    a, b = pair
+    a.sendall(data)
+    a.close()
+    with pytest.raises(ConnectionError):
+        read_frame(b)
+
+
+def test_header_is_type_and_length():
+    assert FRAME_HEADER.pack(FRAME_REPLY, 5) == struct.pack('!BI', 2, 5)
+
+
+def test_closed_by_peer(pair):
+    a, b = pair
+    assert not closed_by_peer(b)
+    a.close()
+    assert closed_by_peer(b)
+
+
+def test_unasked_data_is_not_reusable(pair):
+    a, b = pair
+    a.sendall(b'stray')
+    assert closed_by_peer(b)
+    # Only peeked at
+    assert b.recv(5) == b'stray'
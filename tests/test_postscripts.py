@@ -0,0 +1,155 @@
+# Postscript graphs: dependency order, rejecting bad graphs, which scripts a
+# deploy runs, and running them in parallel where independent.
+
+import configparser
+import threading
+import time
+
+import pytest
+
+from autodeploy.postscripts import (Postscript, LinePrefixer, parse_postscripts,
+                                    run_graph, select)
+
+
+def section(text: str) -> configparser.SectionProxy:
+    cfg = configparser.ConfigParser()
+    cfg.read_string('[org/repo]\n' + text)
+    return cfg['org/repo']
+
+
+def names(scripts) -> list:
+    return [ps.name for ps in scripts]
+
+
+def test_dependencies_come_first():
+    scripts = parse_postscripts(section("""
+postscript.a = echo a
+postscript.a.after = c, b
+postscript.b = echo b
+postscript.b.after = d
+postscript.c = echo c
+postscript.d = echo d
+postscript.d.paths = src/ *.py
+"""))
+    order = names(scripts)
+    assert sorted(order) == ['a', 'b', 'c', 'd']
+    for ps in scripts:
+        assert all(order.index(dep) < order.index(ps.name) for dep in ps.after)
+    # Deterministic, not dependent on the order of the settings
+    assert order == ['c', 'd', 'b', 'a']
+    assert scripts[1].paths == ['src/', '*.py']
+    assert scripts[-1].after == ['c', 'b']
+
+
+def test_plain_postscript():
+    scripts = parse_postscripts(section('postscript = make install\n'))
+    assert [(ps.name, ps.cmd) for ps in scripts] == [('postscript', 'make install')]
+    assert parse_postscripts(section('branch = master\n')) == []
+
+
+def test_cycle_is_rejected():
+    with pytest.raises(ValueError, match='a -> b -> a'):
+        parse_postscripts(section("""
+postscript.a = echo a
+postscript.a.after = b
+postscript.b = echo b
+postscript.b.after = a
+"""))
+
+
+def test_unknown_dependency_is_rejected():
+    with pytest.raises(ValueError, match='unknown postscript c'):
+        parse_postscripts(section("""
+postscript.a = echo a
+postscript.a.after = c
+"""))
+
+
+def test_select_by_changed_paths():
+    scripts = [Postscript('any', 'x'), Postscript('docs', 'x', ['docs/']),
+               Postscript('py', 'x', ['*.py'])]
+    assert names(select(scripts, ['docs/index.md'])) == ['any', 'docs']
+    assert names(select(scripts, ['lib/deep/mod.py'])) == ['any', 'py']
+    assert names(select(scripts, ['README'])) == ['any']
+    # Not knowing what changed runs them all
+    assert names(select(scripts, None)) == ['any', 'docs', 'py']
+
+
+def run_recording(rcs: dict, delay: float = 0):
+    order, lock = [], threading.Lock()
+
+    def run(ps: Postscript):
+        with lock:
+            order.append(('start', ps.name))
+        time.sleep(delay)
+        with lock:
+            order.append(('end', ps.name))
+        return ps.name.encode(), rcs.get(ps.name, 0)
+    return run, order
+
+
+def test_run_graph_order():
+    scripts = parse_postscripts(section("""
+postscript.build = make
+postscript.test = make test
+postscript.test.after = build
+postscript.install = make install
+postscript.install.after = build test
+"""))
+    run, order = run_recording({}, 0.01)
+    results = run_graph(scripts, run, workers=4)
+    assert order == [('start', 'build'), ('end', 'build'), ('start', 'test'), ('end', 'test'),
+                     ('start', 'install'), ('end', 'install')]
+    assert results == {'build': (b'build', 0), 'test': (b'test', 0), 'install': (b'install', 0)}
+
+
+def test_independent_scripts_run_in_parallel():
+    scripts = [Postscript('a', 'x'), Postscript('b', 'x'), Postscript('c', 'x', after=['a', 'b'])]
+    run, order = run_recording({}, 0.1)
+    run_graph(scripts, run, workers=2)
+    assert set(order[:2]) == {('start', 'a'), ('start', 'b')}
+    assert order[-2:] == [('start', 'c'), ('end', 'c')]
+
+
+def test_failure_skips_dependents():
+    scripts = parse_postscripts(section("""
+postscript.a = false
+postscript.b = echo b
+postscript.b.after = a
+postscript.c = echo c
+postscript.c.after = b
+postscript.d = echo d
+"""))
+    run, order = run_recording({'a': 1})
+    results = run_graph(scripts, run, workers=2)
+    assert results['a'] == (b'a', 1)
+    assert results['b'] == results['c'] == (b'', None)
+    assert results['d'] == (b'd', 0)
+    assert ('start', 'b') not in order and ('start', 'c') not in order
+
+
+def test_exception_counts_as_failure():
+    def run(ps: Postscript):
+        if ps.name == 'a':
+            raise OSError('no such command')
+        return b'', 0
+    results = run_graph([Postscript('a', 'x'), Postscript('b', 'x', after=['a'])], run)
+    assert results == {'a': (b'no such command\n', -1), 'b': (b'', None)}
+
+
+def test_dependency_not_selected_does_not_block():
+    # b is after a, but a did not match the changed files so is not run
+    scripts = [Postscript('b', 'x', after=['a'])]
+    run, order = run_recording({})
+    assert run_graph(scripts, run) == {'b': (b'b', 0)}
+
+
+def test_line_prefixer():
+    out = []
+    prefix = LinePrefixer(out.append, 'build')
+    prefix(b'one\ntw')
+    prefix(b'o\n')
+    prefix(b'three')
+    prefix.flush()
+    prefix.flush()
+    assert b''.join(out) == b'[build] one\n[build] two\n[build] three\n'
@@ -0,0 +1,64 @@
+# Workers running commands as another user, and the fallback to sudo for an
+# owner whose workers cannot start. These need to run as root.
+
+import os
+import shutil
+import sys
+
+import pytest
+
+from autodeploy import privsep, util
+
+OWNER = 'nobody'
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason="needs to run as root")
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(privsep, '_pools', {})
+    monkeypatch.setattr(privsep, '_sudo', set())
+    privsep.use_workers(2)
+    yield
+    privsep.close()
+    privsep.use_workers(0)
+
+
+@pytest.fixture
+def sudo(monkeypatch):
+    """ The commands run through sudo, answered without running them """
+    cmds = []
+
+    def get_output(cmd, cwd=None):
+        cmds.append(cmd)
+        return b'from sudo\n', 0
+    monkeypatch.setattr(util, 'get_output', get_output)
+    return cmds
+
+
+def test_worker_runs_as_owner(workers, monkeypatch):
+    python = shutil.which('python3', path='/usr/local/bin:/usr/bin:/bin')
+    if python is None:
+        pytest.skip("no system python")
+    monkeypatch.setattr(sys, 'executable', python)
+    assert privsep.run(OWNER, 'id -un', '/') == (b'nobody\n', 0)
+    assert privsep.enabled(OWNER)
+
+
+@pytest.mark.parametrize('python', ['/nonexistent/python', '/bin/false'])
+def test_falls_back_to_sudo(workers, sudo, monkeypatch, python):
+    # Either the worker cannot be executed, or it exits before answering
+    monkeypatch.setattr(sys, 'executable', python)
+    assert privsep.run(OWNER, 'git status', '/') == (b'from sudo\n', 0)
+    assert not privsep.enabled(OWNER)
+    assert privsep.enabled()
+    assert privsep.run(OWNER, 'git log', '/') == (b'from sudo\n', 0)
+    assert sudo == [f'sudo -u {OWNER} git status', f'sudo -u {OWNER} git log']
+
+
+def test_prestart_falls_back_to_sudo(workers, sudo, monkeypatch):
+    monkeypatch.setattr(sys, 'executable', '/nonexistent/python')
+    privsep.prestart([OWNER])
+    assert not privsep.enabled(OWNER)
+    privsep.run(OWNER, 'git status', '/')
+    assert sudo == [f'sudo -u {OWNER} git status']
@@ -0,0 +1,125 @@
+# The worker pool of the daemon servers: connections detached by their
+# handler are answered later without holding a worker. And running commands
+# with streamed, capped output.
+
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from autodeploy.message import recv_all
+from autodeploy.util import ThreadPoolMixIn, stream_output
+
+
+class DeferringHandler(socketserver.BaseRequestHandler):
+    """ Answers 'now' right away, and 'later' from another thread once the
+        server's release event is set
+    """
+
+    def handle(self):
+        data = self.request.recv(100)
+        if data == b'now':
+            self.request.sendall(b'answered now')
+            return
+        self.server.detach(self.request)
+
+        def answer():
+            self.server.release.wait(5)
+            self.request.sendall(b'answered later')
+            self.server.resume(self.request, self.client_address, False)
+        threading.Thread(target=answer).start()
+
+
+class PoolServer(ThreadPoolMixIn, socketserver.TCPServer):
+    max_workers = 1
+    max_pending = 2
+    busy_answer = b'busy'
+    allow_reuse_address = True
+
+
+def test_detached_connection_holds_no_worker():
+    srv = PoolServer(('127.0.0.1', 0), DeferringHandler)
+    srv.release = threading.Event()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        later = socket.create_connection(srv.server_address, timeout=5)
+        later.sendall(b'later')
+        # The only worker is free for the next one meanwhile
+        now = socket.create_connection(srv.server_address, timeout=5)
+        now.sendall(b'now')
+        assert recv_all(now) == b'answered now'
+        # But the detached one still counts as pending
+        third = socket.create_connection(srv.server_address, timeout=5)
+        third.sendall(b'later')
+        fourth = socket.create_connection(srv.server_address, timeout=5)
+        assert recv_all(fourth) == b'busy'
+        srv.release.set()
+        assert recv_all(later) == b'answered later'
+        assert recv_all(third) == b'answered later'
+        for s in (later, now, third, fourth):
+            s.close()
+    finally:
+        srv.release.set()
+        srv.shutdown()
+        srv.server_close()
+        thread.join(5)
+
+
+def running(pid: int) -> bool:
+    """ Whether process @pid is alive (not gone or a zombie) """
+    try:
+        with open(f'/proc/{pid}/stat') as fp:
+            return fp.read().rpartition(')')[2].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_stream_output():
+    chunks = []
+    out, rc = stream_output('sh -c "echo one; echo two >&2; exit 3"', sink=chunks.append)
+    assert (out, rc) == (b'one\ntwo\n', 3)
+    assert b''.join(chunks) == out
+
+
+def test_capped_output_spills(tmp_path):
+    spill = tmp_path / 'full.log'
+    out, rc = stream_output('seq 1000', cap=10, spill=str(spill))
+    assert rc == 0
+    assert out.startswith(b'1\n2\n3\n4\n5\n')
+    assert f'bytes not shown, full output in {spill}]'.encode() in out
+    assert spill.read_bytes().split() == [str(i).encode() for i in range(1, 1001)]
+
+
+def test_spill_that_cannot_be_opened(tmp_path):
+    out, rc = stream_output('seq 1000', cap=10, spill=str(tmp_path / 'missing' / 'full.log'))
+    assert rc == 0
+    assert b'bytes not shown]' in out and b'full output' not in out
+
+
+def test_timeout_kills_children(tmp_path):
+    pidfile = tmp_path / 'pid'
+    start = time.monotonic()
+    out, rc = stream_output(f'sh -c "sleep 30 & echo $! > {pidfile}; wait"', timeout=0.5)
+    assert time.monotonic() - start < 10
+    assert b'killed after timeout' in out
+    assert rc != 0
+    assert not running(int(pidfile.read_text()))
+
+
+def test_error_kills_children(tmp_path):
+    pidfile = tmp_path / 'pid'
+
+    def broken_sink(chunk: bytes) -> None:
+        raise RuntimeError('client gone')
+    with pytest.raises(RuntimeError):
+        stream_output(f'sh -c "sleep 30 & echo $! > {pidfile}; echo started; wait"',
+                      sink=broken_sink)
+    pid = int(pidfile.read_text())
+    for _ in range(50):
+        if not running(pid):
+            break
+        time.sleep(0.1)
+    assert not running(pid)
@@ -0,0 +1,164 @@
+# Webhook ingest: the signature is checked with the right secrets before the
+# body is parsed, and only valid pushes for a configured repo and branch get
+# through. Also which repo a webhook URL names, and which are refused.
+
+import configparser
+import hashlib
+import hmac
+import io
+import json
+
+import pytest
+
+from autodeploy.webhook import WebhookIngest, process_webhook_output, url_repo, refusal
+
+CONFIG = """
+[org/repo]
+secret = s3cret
+branch = master
+
+[org/other]
+secret = other secret
+branch = master
+
+[org/shared]
+secret = s3cret
+branch = main
+
+[org/bare]
+secret = bare secret
+bare = true
+
+[org/targets]
+secret = targets secret
+targets = master:/srv/a, release:/srv/b
+"""
+
+
+@pytest.fixture
+def config():
+    cfg = configparser.ConfigParser()
+    cfg.read_string(CONFIG)
+    return cfg
+
+
+def push(repo: str = 'org/repo', branch: str = 'master') -> bytes:
+    return json.dumps({
+        'ref': f'refs/heads/{branch}', 'before': 'a' * 40, 'after': 'b' * 40,
+        'repository': {'full_name': repo, 'private': True},
+        'pusher': {'login': 'someone', 'full_name': 'Some One', 'email': 'some@one'},
+        'commits': [{'id': 'b' * 40}]}).encode()
+
+
+def sign(body: bytes, secret: str) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@pytest.mark.parametrize('repo', [None, 'org/repo'])
+def test_valid_push(config, repo):
+    body = push()
+    js = process_webhook_output(body, sign(body, 's3cret'), config, repo)
+    assert js['repository'] == {'full_name': 'org/repo'}
+    assert (js['ref'], js['after']) == ('refs/heads/master', 'b' * 40)
+    assert 'commits' not in js
+
+
+@pytest.mark.parametrize('repo', [None, 'org/repo'])
+def test_bad_signature(config, repo):
+    body = push()
+    assert process_webhook_output(body, sign(body, 'guess'), config, repo) is None
+    assert process_webhook_output(body, '', config, repo) is None
+    # Signed before being tampered with
+    sig = sign(body, 's3cret')
+    assert process_webhook_output(body.replace(b'someone', b'mallory'), sig, config, repo) is None
+
+
+def test_signed_for_another_repo(config):
+    # A push for org/other signed with the secret of org/repo
+    body = push('org/other')
+    assert process_webhook_output(body, sign(body, 's3cret'), config) is None
+    # Nor does the URL naming the repo of the secret help
+    assert process_webhook_output(body, sign(body, 's3cret'), config, 'org/repo') is None
+    # Signed with its own secret, but the URL names another repo
+    assert process_webhook_output(body, sign(body, 'other secret'), config, 'org/repo') is None
+
+
+def test_repos_sharing_a_secret(config):
+    body = push('org/shared', 'main')
+    assert process_webhook_output(body, sign(body, 's3cret'), config)
+    assert process_webhook_output(body, sign(body, 's3cret'), config, 'org/repo') is None
+
+
+def test_unknown_repo(config):
+    body = push('org/unknown')
+    assert process_webhook_output(body, sign(body, 's3cret'), config) is None
+    assert process_webhook_output(body, sign(body, 's3cret'), config, 'org/unknown') is None
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'{"ref": "refs/heads/master", ',
+    b'\xff\xfe not json',
+    b'[1, 2, 3]',
+    b'"a string"',
+    json.dumps({'ref': 'refs/heads/master', 'repository': {'full_name': 'org/repo'}}).encode(),
+    push().replace(b'"pusher": {', b'"pusher": ["x", {').replace(b'"some@one"}', b'"some@one"}]'),
+    push().replace(b'{"full_name": "org/repo", "private": true}', b'"org/repo"'),
+])
+def test_malformed_body(config, body):
+    assert process_webhook_output(body, sign(body, 's3cret'), config) is None
+
+
+def test_branches(config):
+    body = push(branch='develop')
+    assert process_webhook_output(body, sign(body, 's3cret'), config) is None
+    body = push('org/bare', 'anything')
+    assert process_webhook_output(body, sign(body, 'bare secret'), config)
+    for branch, ok in (('master', True), ('release', True), ('develop', False)):
+        body = push('org/targets', branch)
+        assert bool(process_webhook_output(body, sign(body, 'targets secret'), config)) is ok
+
+
+def test_read_in_chunks(config, monkeypatch):
+    monkeypatch.setattr('autodeploy.webhook.CHUNK', 7)
+    body = push()
+    ingest = WebhookIngest(config)
+    ingest.read(io.BytesIO(body).read, len(body))
+    assert ingest.result(sign(body, 's3cret'))['repository']['full_name'] == 'org/repo'
+
+
+def test_short_body(config):
+    body = push()
+    with pytest.raises(ConnectionError):
+        WebhookIngest(config).read(io.BytesIO(body).read, len(body) + 1)
+
+
+@pytest.mark.parametrize('url, repo', [
+    ('/', None),
+    ('', None),
+    ('/hook', None),
+    ('/autodeploy/', None),
+    ('/org/unknown', None),
+    ('/org/repo', 'org/repo'),
+    ('/org/repo/', 'org/repo'),
+    ('/autodeploy/org/repo', 'org/repo'),
+    ('/autodeploy/org%2Frepo?x=1', 'org/repo'),
+    ('/?repo=org/repo', 'org/repo'),
+    ('/hook?x=1&repo=org%2Fother', 'org/other'),
+    ('/org/repo?repo=org/unknown', 'org/unknown'),
+    ('/?repo=', None),
+])
+def test_url_repo(config, url, repo):
+    assert url_repo(url, config) == repo
+
+
+def test_refusal(config):
+    assert refusal(config, 'org/repo') is None
+    assert refusal(config, 'org/unknown') == 'Unknown repo org/unknown'
+    # Any number of secrets by default
+    assert refusal(config, None) is None
+    config['DEFAULT']['webhook_max_secrets'] = '4'
+    assert refusal(config, None) is None
+    config['DEFAULT']['webhook_max_secrets'] = '3'
+    assert refusal(config, None)
+    assert refusal(config, 'org/repo') is None